@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+__author__ = "Fernando Witt"
+__credits__ = ["Fernando Witt"]
+
+__license__ = "MIT"
+__maintainer__ = "Fernando Witt"
+__email__ = "ferawitt@gmail.com"
+
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from saklib.sakclient import get_daemon_socket_path, request
+from saklib.sakcmd import SakArg, SakCmd
+from saklib.sakconfig import SAK_GLOBAL
+from saklib.sakdaemon import get_daemon_log_path
+
+DAEMON_START_TIMEOUT = 30.0
+
+
+def _get_socket_path() -> Path:
+    socket_path = get_daemon_socket_path(str(SAK_GLOBAL))
+    if (SAK_GLOBAL is None) or (socket_path is None):
+        raise Exception("Could not define Sak location.")
+    return Path(socket_path)
+
+
+@SakCmd("start", helpmsg="Start the resident SAK daemon.")
+@SakArg("wait", helpmsg="Wait until the daemon is ready.")
+def start(wait: bool = False) -> str:
+    reply = request({"type": "ping"})
+    if reply is not None:
+        return "Daemon already running, pid: %d" % reply["pid"]
+
+    socket_path = _get_socket_path()
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(get_daemon_log_path(socket_path), "a") as log:
+        p = subprocess.Popen(
+            [sys.executable, "-m", "saklib.sakdaemon"],
+            cwd=SAK_GLOBAL,
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            start_new_session=True,
+        )
+
+    if not wait:
+        return "Daemon started, pid: %d" % p.pid
+
+    timeout = time.time() + DAEMON_START_TIMEOUT
+    while time.time() < timeout:
+        if p.poll() is not None:
+            raise Exception(
+                "Daemon failed to start, check %s" % get_daemon_log_path(socket_path)
+            )
+        reply = request({"type": "ping"})
+        if reply is not None:
+            return "Daemon ready, pid: %d" % reply["pid"]
+        time.sleep(0.1)
+    raise Exception("Timeout waiting for the daemon to start")
+
+
+@SakCmd("stop", helpmsg="Stop the resident SAK daemon.")
+def stop() -> str:
+    reply = request({"type": "stop"})
+    if reply is None:
+        return "Daemon not running"
+    return "Daemon stopped, pid: %d" % reply["pid"]
+
+
+@SakCmd("status", helpmsg="Show the resident SAK daemon status.")
+def status() -> str:
+    reply = request({"type": "ping"})
+    if reply is None:
+        return "Daemon not running"
+    return "Daemon running, pid: %d, socket: %s" % (reply["pid"], _get_socket_path())
+
+
+EXPOSE = {"start": start, "stop": stop, "status": status}
@@ -0,0 +1,14 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Resident SAK server, to avoid the interpreter startup on every call.
+"""
+from typing import List
+
+PLUGIN_NAME = "daemon"
+PLUGIN_VERSION = "0.5.0"
+
+# Specify a list of plugins that we depend and the version
+DEPENDS: List[str] = []
+
+EXPOSE_FILES = "daemon.py"
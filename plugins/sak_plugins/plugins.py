@@ -8,10 +8,16 @@ from saklib.sakexec import run_cmd
 
 
 @SakCmd("show", helpmsg="Show the list of plugins.")
-def show() -> str:
+@SakArg("timing", helpmsg="Show the time to load each plugin config.")
+def show(timing: bool = False) -> str:
     ret = ""
     if ctx.has_plugin_manager is None:
         raise Exception("No plugin manager specifief")
+    if timing:
+        ret += "%-40s %10s\n" % ("Plugin", "Time (ms)")
+        for name, duration in ctx.has_plugin_manager.get_timing_report():
+            ret += "%-40s %10.1f\n" % (name, duration)
+        return ret
     for plugin in ctx.has_plugin_manager.has_plugins:
         ret += "name: %s\n\tpath: %s\n" % (plugin._name, plugin._plugin_path)
     return ret
@@ -9,8 +9,11 @@ __maintainer__ = "Fernando Witt"
 __email__ = "ferawitt@gmail.com"
 
 
+from typing import Any, Dict, List, Optional
+
 from saklib.sak import plm
-from saklib.saktask import STORAGE
+from saklib.sakcmd import SakArg, SakCmd, SakCompleterArg
+from saklib.saktask import NAMESPACE, get_namespace, get_storages
 
 
 def _force_loading_plugin() -> None:
@@ -24,11 +27,71 @@ def sync() -> None:
 
     _force_loading_plugin()
 
-    for storage_name, storage in STORAGE.items():
+    for storage_name, storage in get_storages().items():
         storage.sync_ga()
         storage.sync_db()
 
 
+def _namespace_completer(completer_args: Optional[SakCompleterArg]) -> List[Any]:
+    _force_loading_plugin()
+    return sorted(NAMESPACE.keys())
+
+
+@SakCmd("run", helpmsg="Run the pending tasks of a namespace in parallel.")
+@SakArg(
+    "namespace",
+    required=True,
+    completercb=_namespace_completer,
+    helpmsg="The task namespace.",
+)
+@SakArg("jobs", short_name="j", helpmsg="Number of parallel tasks (default: CPUs).")
+@SakArg("limit", helpmsg="Maximum number of tasks to run.")
+def run(namespace: str, jobs: int = 0, limit: Optional[int] = None) -> Dict[str, int]:
+    """Run the pending tasks of a namespace in parallel.
+
+    The tasks are claimed in the DB, so several runners can share a namespace,
+    and executed by a pool of threads. Each task output is stored in its log.
+    On Ctrl-C, the tasks that did not start are released.
+    """
+    from saklib.saktask_run import run_tasks
+
+    _force_loading_plugin()
+
+    result = run_tasks(get_namespace(namespace), jobs=jobs, limit=limit)
+    if result.interrupted:
+        print("Interrupted.")
+    return result.counts
+
+
+@SakCmd(
+    "dag", helpmsg="Run the tasks of namespaces in the order of their dependencies."
+)
+@SakArg(
+    "namespaces",
+    required=True,
+    completercb=_namespace_completer,
+    helpmsg="The task namespaces.",
+)
+@SakArg("jobs", short_name="j", helpmsg="Number of parallel tasks (default: CPUs).")
+def dag(namespaces: List[str], jobs: int = 0) -> Dict[str, int]:
+    """Run the tasks of namespaces in the order of their dependencies.
+
+    The dependencies are declared by the task get_upstream_keys. Each task runs
+    as soon as its upstream tasks succeed, the up to date tasks are skipped, and
+    the tasks after a failure are cancelled.
+    """
+    from saklib.saktask_dag import build_dag, run_dag
+
+    _force_loading_plugin()
+
+    result = run_dag(build_dag([get_namespace(x) for x in namespaces]), jobs=jobs)
+    if result.interrupted:
+        print("Interrupted.")
+    return result.get_counts()
+
+
 EXPOSE = {
     "sync": sync,
+    "run": run,
+    "dag": dag,
 }
@@ -14,3 +14,10 @@ DEPENDS: List[str] = []
 # TODO(witt): That to put in this file?
 
 EXPOSE_FILES = "core.py"
+
+# The commands are listed from here, so the core.py is only imported when a
+# webapp command is executed.
+COMMANDS = {
+    "start": {"file": "core.py", "helpmsg": "Start webapp"},
+    "panel_register": {"file": "core.py"},
+}
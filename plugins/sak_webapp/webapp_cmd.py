@@ -8,10 +8,16 @@ __license__ = "MIT"
 __maintainer__ = "Fernando Witt"
 __email__ = "ferawitt@gmail.com"
 
+import asyncio
 import ctypes
+import inspect
+import itertools
 import os
+import sys
 import threading
 import time
+import traceback
+from collections.abc import AsyncIterator
 from datetime import date
 from functools import partial
 from pathlib import Path
@@ -22,26 +28,32 @@ import panel as pn
 import param  # type: ignore
 import tornado
 import tornado.gen
+from bokeh.document import without_document_lock
 
 from saklib.sak import plm, root_cmd
+from saklib.sakasync import is_async_callable
 from saklib.sakcmd import SakArg, SakCmd, SakCompleterArg, sak_arg_parser
 from saklib.sakio import (
     get_stdout_buffer_for_thread,
+    set_buffer_key,
     unregister_stderr_thread_id,
     unregister_stdout_thread_id,
 )
+from saklib.sakoutput import aiter_chunks, is_dataframe, is_stream, iter_chunks
+from saklib.saktable import SakTable
 
-has_pandas = False
-try:
-    import pandas as pd  # type: ignore
+SCRIPT_PATH = Path(__file__).resolve()
+RESOURCES_PATH = SCRIPT_PATH.parent / "web"
 
-    has_pandas = True
-except Exception as e:
-    print("WARNING! Failed to import pandas", str(e))
+# Period, in seconds, to show the new items of generator commands.
+STREAM_UPDATE_PERIOD = 1.0
 
+# Period, in seconds, to show the new stdout of the running commands.
+STDOUT_UPDATE_PERIOD = 2
 
-SCRIPT_PATH = Path(__file__).resolve()
-RESOURCES_PATH = SCRIPT_PATH.parent / "web"
+# The stdout buffer keys of the async commands, negative not to clash with
+# the thread ids.
+_ASYNC_BUFFER_KEYS = itertools.count(-1, -1)
 
 
 class StopableThread(threading.Thread):
@@ -244,7 +256,7 @@ class CallbackObject:
                     )
                 elif arg.completercb is not None:
                     completer_args = SakCompleterArg(None, None, None, None)
-                    choices = arg.completercb(completer_args)
+                    choices = arg.complete(completer_args)
                     params[name] = pn.widgets.Select(
                         name=name, options=choices, **_params
                     )
@@ -280,7 +292,7 @@ class CallbackObject:
                         _params["options"] = choices
                     if arg.completercb is not None:
                         completer_args = SakCompleterArg(None, None, None, None)
-                        _params["options"] = arg.completercb(completer_args)
+                        _params["options"] = arg.complete(completer_args)
 
                     if "options" in _params:
                         params[name] = pn.widgets.MultiChoice(name=name, **_params)
@@ -294,7 +306,7 @@ class CallbackObject:
                         _params["options"] = choices
                     if arg.completercb:
                         completer_args = SakCompleterArg(None, None, None, None)
-                        _params["options"] = arg.completercb(completer_args)
+                        _params["options"] = arg.complete(completer_args)
 
                     if "options" in _params:
                         params[name] = pn.widgets.CrossSelector(name=name, **_params)
@@ -328,6 +340,7 @@ class CallbackObject:
         self.abort_button.on_click(self.abort_callback)
 
         self.thread: Optional[StopableThread] = None
+        self.task: Optional["asyncio.Task[None]"] = None
 
     def stdout_view(self) -> pn.pane.Str:
         return self.stdout
@@ -374,6 +387,10 @@ class CallbackObject:
         self.output.append(new_output)
         self.stdout.object = stdout_str
 
+    @tornado.gen.coroutine
+    def update_stream(self, stream_output: pn.pane.Str, stream_str: str) -> None:
+        stream_output.object = stream_str
+
     @tornado.gen.coroutine
     def update_stdout(self, stdout_str: str) -> None:
         # TODO(witt): This coroutine is the one that will actually update the content
@@ -384,10 +401,20 @@ class CallbackObject:
         if self.thread:
             self.thread.raise_exception()
         self.thread = None
+        if self.task:
+            self.task.cancel()
+        self.task = None
 
     def start_callback(self, event: Any) -> None:
         vargs = {param_name: param.value for param_name, param in self.params.items()}
 
+        # The async commands run in the IOLoop, instead of a thread per click.
+        if is_async_callable(self.cmd.callback):
+            self.doc.add_next_tick_callback(
+                partial(self.async_callback, **vargs)  # type: ignore
+            )
+            return
+
         # Start thread in another callback.
         self.thread = StopableThread(target=self.callback, kwargs=vargs)
         # self.thread = threading.Thread(target=self.callback, kwargs=vargs)
@@ -413,7 +440,6 @@ class CallbackObject:
             do_update_stdout = True
 
             def simple_update_stdout() -> None:
-                UPDATE_PERIOD = 2
                 # MAX_SIZE = -1
                 MAX_SIZE = 10 * 1024
                 while do_update_stdout:
@@ -432,7 +458,7 @@ class CallbackObject:
                             partial(self.update_stdout, stdout_str=stdout_str)  # type: ignore
                         )
                     if do_update_stdout:
-                        time.sleep(UPDATE_PERIOD)
+                        time.sleep(STDOUT_UPDATE_PERIOD)
 
             update_stdout_thread = threading.Thread(target=simple_update_stdout)
             update_stdout_thread.start()
@@ -441,6 +467,27 @@ class CallbackObject:
             # Run callback code.
             new_output = self._callback(**vargs)
 
+            # Show the items of generator commands as they are produced.
+            if is_stream(new_output):
+                stream_output = pn.pane.Str("", sizing_mode="stretch_both")
+                self.doc.add_next_tick_callback(
+                    partial(
+                        self.update_doc, new_output=stream_output, stdout_str=None
+                    )  # type: ignore
+                )
+
+                lines: List[str] = []
+                for chunk in iter_chunks(new_output, max_delay=STREAM_UPDATE_PERIOD):
+                    lines += [str(x) for x in chunk]
+                    self.doc.add_next_tick_callback(
+                        partial(
+                            self.update_stream,
+                            stream_output=stream_output,
+                            stream_str="\n".join(lines),
+                        )  # type: ignore
+                    )
+                new_output = stream_output
+
             # Stop the update thread
             do_update_stdout = False
 
@@ -471,14 +518,94 @@ class CallbackObject:
 
         # TODO(witt): Should I do some thread cleaning?
 
-    def _callback(self, **vargs: Any) -> Any:
+    @without_document_lock
+    async def async_callback(self, **vargs: Any) -> None:
+        self.task = asyncio.current_task()  # type: ignore
+
+        # The coroutines share the IOLoop thread, each has its stdout buffer.
+        set_buffer_key(next(_ASYNC_BUFFER_KEYS))
+
+        def _get_stdout() -> str:
+            stdout_strio = get_stdout_buffer_for_thread()
+            return stdout_strio.getvalue() if stdout_strio is not None else ""
+
+        async def _update_stdout() -> None:
+            MAX_SIZE = 10 * 1024
+            while True:
+                await asyncio.sleep(STDOUT_UPDATE_PERIOD)
+                stdout_str = _get_stdout()[-MAX_SIZE:]
+                if self.stdout.object != stdout_str:
+                    self.doc.add_next_tick_callback(
+                        partial(self.update_stdout, stdout_str=stdout_str)  # type: ignore
+                    )
+
+        loading = pn.indicators.LoadingSpinner(value=True, width=100, height=100)
+        self.doc.add_next_tick_callback(
+            partial(
+                self.update_doc, new_output=loading, stdout_str=None
+            )  # type: ignore
+        )
+
+        new_output = None
+        update_stdout_task = asyncio.ensure_future(_update_stdout())
+        try:
+            new_output = self._callback(_run_async=False, **vargs)
+            if inspect.isawaitable(new_output):
+                new_output = _to_web_output(await new_output)
+
+            # Show the items of async generator commands as they are produced.
+            if isinstance(new_output, AsyncIterator):
+                stream_output = pn.pane.Str("", sizing_mode="stretch_both")
+                self.doc.add_next_tick_callback(
+                    partial(
+                        self.update_doc, new_output=stream_output, stdout_str=None
+                    )  # type: ignore
+                )
+
+                lines: List[str] = []
+                async for chunk in aiter_chunks(
+                    new_output, max_delay=STREAM_UPDATE_PERIOD
+                ):
+                    lines += [str(x) for x in chunk]
+                    self.doc.add_next_tick_callback(
+                        partial(
+                            self.update_stream,
+                            stream_output=stream_output,
+                            stream_str="\n".join(lines),
+                        )  # type: ignore
+                    )
+                new_output = stream_output
+        except Exception as e:
+            # Show the errors like the ones of the commands run by sak_arg_parser.
+            new_output = _to_web_error(e)
+        finally:
+            update_stdout_task.cancel()
+
+            if (new_output is not None) and hasattr(new_output, "panel"):
+                new_output = new_output.panel()
+
+            self.doc.add_next_tick_callback(
+                partial(
+                    self.update_doc,
+                    new_output=new_output,
+                    stdout_str=_get_stdout() + "\nDONE!",
+                )  # type: ignore
+            )
+
+            unregister_stdout_thread_id()
+            unregister_stderr_thread_id()
+            self.task = None
+
+    def _callback(self, _run_async: bool = True, **vargs: Any) -> Any:
         ret: Any = None
 
         param_args = []
         for arg in self.cmd.args:
             param_args += SakWebCmdArg(arg).getRequestArgList(vargs)
 
-        post_ret = sak_arg_parser(self.root_cmd, self.args + param_args)
+        post_ret = sak_arg_parser(
+            self.root_cmd, self.args + param_args, run_async=_run_async
+        )
 
         web_ret = {}
         web_ret["error"] = False
@@ -487,16 +614,38 @@ class CallbackObject:
             web_ret["error_message"] = post_ret["argparse"]["error"]
             ret = web_ret
         elif "value" in post_ret:
-            web_ret["result"] = post_ret["value"]
-            if not web_ret["error"]:
-                if has_pandas and isinstance(web_ret["result"], pd.DataFrame):
-                    ret = pn.pane.DataFrame(web_ret["result"])
-                else:
-                    ret = web_ret["result"]
+            ret = _to_web_output(post_ret["value"])
 
         return ret
 
 
+def _to_web_output(value: Any) -> Any:
+    """Convert a command value to what the webapp shows.
+
+    :param value: The value returned by the command.
+    :returns: A DataFrame pane for tables, otherwise the value itself.
+    """
+    if isinstance(value, SakTable):
+        return pn.pane.DataFrame(value.to_pandas())
+    if is_dataframe(value):
+        return pn.pane.DataFrame(value)
+    return value
+
+
+def _to_web_error(e: Exception) -> Dict[str, Any]:
+    """Describe an exception raised by a command, like sak_arg_parser does.
+
+    :param e: The exception.
+    :returns: The error, as shown by the webapp.
+    """
+    if os.environ.get("SAK_VERBOSE", False):
+        print("Exception in user code:")
+        print("-" * 60)
+        traceback.print_exc(file=sys.stdout)
+        print("-" * 60)
+    return {"error": True, "error_message": str(e)}
+
+
 def do_commands(doc, tmpl, **kwargs):  # type: ignore
 
     curr_cmd = root_cmd()
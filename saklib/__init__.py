@@ -11,6 +11,7 @@ import os
 import platform
 import subprocess
 import sys
+import time
 
 CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
 
@@ -26,6 +27,15 @@ SAK_PYTHON = os.path.join(SAK_GLOBAL, "python")
 SAK_PYTHON_BIN = os.path.join(SAK_PYTHON, "miniconda3", "bin", "python3")
 
 
+def get_sak_python_path(path: str) -> str:
+    """Get the PATH with the SAK python first, like the SAK commands have it.
+
+    :param path: The current PATH.
+    :returns: The new PATH.
+    """
+    return os.path.dirname(SAK_PYTHON_BIN) + ":" + path
+
+
 def check_python() -> bool:
     return os.path.exists(SAK_PYTHON_BIN)
 
@@ -75,7 +85,7 @@ def install_python(ask_confirm: bool = True) -> None:
         ["/usr/bin/env", "bash", miniconda_installer, "-b", "-p", instalation_prefix]
     )
 
-    os.environ["PATH"] = os.path.dirname(SAK_PYTHON_BIN) + ":" + os.environ["PATH"]
+    os.environ["PATH"] = get_sak_python_path(os.environ["PATH"])
     subprocess.check_call(
         [
             "/usr/bin/env",
@@ -95,15 +105,31 @@ def install() -> None:
 
 
 def run() -> None:
+    if (os.environ.get("SAK_PROFILE", None) == "startup") or (
+        os.environ.get("SAK_TRACE", "") not in ["", "0", "NO"]
+    ):
+        os.environ["SAK_LAUNCH_TIME_NS"] = str(time.time_ns())
+
+    from saklib.sakclient import run_in_daemon
+
     use_miniconda_flag = os.environ.get("SAK_USE_MINICONDA", "YES") == "YES"
 
     current_platform = platform.machine()
     is_supported_env = current_platform in MINICONDA_LINKS
 
+    # The daemon runs the command with the environment of the SAK python.
+    env = dict(os.environ)
+    if use_miniconda_flag and is_supported_env:
+        env["PATH"] = get_sak_python_path(env["PATH"])
+
+    ret = run_in_daemon(sys.argv[1:], env=env)
+    if ret is not None:
+        sys.exit(ret)
+
     if use_miniconda_flag and is_supported_env:
         install()
 
-        os.environ["PATH"] = os.path.dirname(SAK_PYTHON_BIN) + ":" + os.environ["PATH"]
+        os.environ["PATH"] = get_sak_python_path(os.environ["PATH"])
 
         cmd = [SAK_PYTHON_BIN, os.path.join(SAK_GLOBAL, "saklib", "sak.py")] + sys.argv[
             1:
@@ -115,4 +141,7 @@ def run() -> None:
         sys.path.append(os.path.join(SAK_GLOBAL, "saklib"))
         from saklib import sak
 
-        sak.main()
+        if os.environ.get("SAK_PROFILE", None) == "startup":
+            sak.run_startup_profile()
+        else:
+            sak.main()
@@ -9,24 +9,51 @@ __version__ = "0.5.0"
 __maintainer__ = "Fernando Witt"
 __email__ = "ferawitt@gmail.com"
 
+import json
 import os
+import shlex
 import subprocess
 import sys
+import tempfile
+import time
+import traceback
+from pathlib import Path
+from typing import Any, List
 
 sys.path.append(os.environ["SAK_GLOBAL"])
 os.environ["NUMEXPR_MAX_THREADS"] = "8"
 
+# Imported first, so the startup profile can time all the other imports.
+from saklib import saktiming  # noqa: E402
 
-from saklib.sakcmd import SakCmd, sak_arg_parser  # noqa: E402
+if saktiming.is_startup_profile():
+    saktiming.enable()
+elif saktiming.is_trace():
+    # Timing the imports is too slow for every run, only the spans.
+    saktiming.enable(imports=False)
+
+
+from saklib.sakcmd import SakArg, SakCmd, sak_arg_parser, wrap_cmd  # noqa: E402
+from saklib.sakconfig import SAK_CACHE, SAK_GLOBAL  # noqa: E402
+from saklib.sakmanifest import SakManifest  # noqa: E402
+from saklib.sakoutput import parse_output_args, render_value, write_value  # noqa: E402
 from saklib.sakplugin import SakContext, SakPlugin, SakPluginManager  # noqa: E402
+from saklib.saktiming import timing  # noqa: E402
 
 ctx = SakContext()
 plm = SakPluginManager()
+manifest = SakManifest((SAK_CACHE / "manifest") if SAK_CACHE is not None else None)
+complete_index = (SAK_CACHE / "complete" / "index") if SAK_CACHE is not None else None
+startup_history = (SAK_CACHE / "startup.jsonl") if SAK_CACHE is not None else None
+trace_path = (SAK_CACHE / "trace.jsonl") if SAK_CACHE is not None else None
 
 ctx.has_plugin_manager = plm
 plm.has_context = ctx
 
-IS_ARGCOMP_COMMAND = " ".join(sys.argv[1:]) == "show argcomp"
+IS_ARGCOMP_COMMAND = " ".join(sys.argv[1:]) in ["show argcomp", "show argcomp_index"]
+
+# The profiled command writes the startup report to this file.
+SAK_STARTUP_REPORT_ENV = "SAK_STARTUP_REPORT"
 
 
 class SakShow(SakPlugin):
@@ -40,19 +67,222 @@ class SakShow(SakPlugin):
 
     @SakCmd("argcomp", helpmsg="Show the autocomplete string")
     def show_argcomp(self) -> None:
+        sys.stdout.flush()
         subprocess.call(["register-python-argcomplete", "sak", "-s", "bash"])
+        if complete_index is not None and SAK_GLOBAL is not None:
+            from saklib.sakcomplete import get_bash_complete_script
+
+            sys.stdout.write(get_bash_complete_script(complete_index, SAK_GLOBAL))
+        return None
+
+    @SakCmd(
+        "argcomp_index",
+        helpmsg="Build the static autocomplete index used by the bash completion.",
+    )
+    def show_argcomp_index(self) -> None:
+        from saklib.sakcomplete import write_complete_index
+
+        if complete_index is None:
+            return None
+
+        # The manifests are updated while building the command tree.
+        root = root_cmd()
+
+        watch_paths = [Path(__file__).resolve().parent]
+        watch_files: List[Path] = []
+        for plugin in plm.has_plugins:
+            if plugin._has_plugin_path is not None:
+                watch_paths.append(plugin._has_plugin_path.resolve())
+                watch_paths.append(plugin._has_plugin_path.resolve().parent)
+                watch_files += manifest.get_plugin_files(plugin)
+
+        write_complete_index(
+            root,
+            complete_index,
+            watch_paths=list(dict.fromkeys(watch_paths)),
+            watch_files=list(dict.fromkeys(watch_files)),
+        )
         return None
 
+    @SakCmd("cache", helpmsg="Show or clear the cached command results.")
+    @SakArg("clear", helpmsg="Remove all the cached command and completer results.")
+    def show_cache(self, clear: bool = False) -> str:
+        from saklib.sakcache import get_cmd_cache, get_completer_cache
+
+        cmd_cache = get_cmd_cache()
+        if cmd_cache is None:
+            return "No cache location."
+        if clear:
+            cmd_cache.invalidate()
+            get_completer_cache().invalidate()
+        entries, size = cmd_cache.stats()
+        return "Cached results: %d (%.1f MB)" % (entries, size / (1024 * 1024))
+
+    @SakCmd("trace", helpmsg="Show the p50/p95 of the spans of the traced commands.")
+    @SakArg("cmd", helpmsg='Only the commands starting with this, like "sak show".')
+    @SakArg("last", helpmsg="Only the last N traced runs.")
+    @SakArg("clear", helpmsg="Remove the traced runs.")
+    def show_trace(self, cmd: str = "", last: int = 0, clear: bool = False) -> str:
+        """Show the p50/p95 of the spans of the traced commands.
+
+        Set SAK_TRACE=YES to record the spans of every command run.
+        """
+        if trace_path is None:
+            return "No cache location."
+        if clear:
+            saktiming.clear_trace(trace_path)
+            return "Trace cleared."
+
+        entries = saktiming.load_trace(trace_path)
+        if cmd:
+            entries = [x for x in entries if x["cmd"].startswith(cmd)]
+        if last:
+            entries = entries[-last:]
+        if not entries:
+            return "No traced runs, set %s=YES to trace." % saktiming.SAK_TRACE_ENV
+        return saktiming.trace_to_table(entries)
+
+    @SakCmd("startup", helpmsg="Profile the SAK startup of a command.")
+    @SakArg("cmd", helpmsg='The SAK command to profile (default: "-h").')
+    @SakArg("json_format", helpmsg="Show the report as JSON.")
+    @SakArg("history", helpmsg="Show the last N profiled commands.")
+    def show_startup(
+        self, cmd: str = "-h", json_format: bool = False, history: int = 0
+    ) -> str:
+        if history:
+            if startup_history is None:
+                return ""
+            lines = [
+                "%-19s %10s %10s %10s  %s"
+                % ("Time", "Total", "Plugins", "Imports", "Command")
+            ]
+            for entry in saktiming.load_history(startup_history)[-history:]:
+                lines.append(
+                    "%-19s %10.1f %10.1f %10.1f  sak %s"
+                    % (
+                        entry["time"],
+                        entry["total"],
+                        sum(entry["plugins"].values()),
+                        entry["imports_total"],
+                        " ".join(entry["argv"]),
+                    )
+                )
+            return "\n".join(lines)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_path = Path(tmp_dir) / "report.json"
+
+            env = dict(os.environ)
+            env["SAK_PROFILE"] = "startup"
+            env["SAK_DAEMON"] = "NO"
+            env[SAK_STARTUP_REPORT_ENV] = str(report_path)
+            env[saktiming.SAK_LAUNCH_TIME_ENV] = str(time.time_ns())
+
+            subprocess.call(
+                [sys.executable, os.path.abspath(__file__)] + shlex.split(cmd),
+                env=env,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+
+            if not report_path.exists():
+                raise Exception("Failed to profile the command: sak %s" % cmd)
+            with open(report_path) as f:
+                report = json.load(f)
+
+        if json_format:
+            return json.dumps(report, indent=2)
+        return saktiming.report_to_table(report)
+
 
 plm.addPlugin(SakShow(ctx, "show"))
 # plm.addPlugin(SakPlugins(ctx, 'plugins'))
 
 if ctx.sak_global:
     sys.path.append(str(ctx.sak_global / "plugins"))
-    plm.loadPlugins(ctx.sak_global / "plugins")
+    with timing("startup", "loadPlugins global"):
+        plm.loadPlugins(ctx.sak_global / "plugins")
 if ctx.sak_local and ctx.sak_local != ctx.sak_global:
     sys.path.append(str(ctx.sak_local / "plugins"))
-    plm.loadPlugins(ctx.sak_local / "plugins")
+    with timing("startup", "loadPlugins local"):
+        plm.loadPlugins(ctx.sak_local / "plugins")
+
+
+@SakCmd("batch", helpmsg="Execute SAK commands read from a file, one per line.")
+@SakArg("file", helpmsg='File with one command per line, "-" for stdin.')
+@SakArg("continue_on_error", helpmsg="Keep executing after a command fails.")
+def batch(file: str = "-", continue_on_error: bool = False) -> None:
+    """Execute SAK commands read from a file, one per line.
+
+    The commands share the loaded plugins, so this is much faster than calling
+    sak once per command. Each line is a command line, like "qa black -h", or a
+    JSON list with the arguments. The result of each command is written to the
+    output as a JSON line, with its exit "status".
+    """
+    from saklib.sakbatch import run_batch
+
+    root = root_cmd()
+    if file == "-":
+        exit_status = run_batch(root, sys.stdin, sys.stdout, continue_on_error)
+    else:
+        with open(file) as f:
+            exit_status = run_batch(root, f, sys.stdout, continue_on_error)
+
+    if exit_status != 0:
+        sys.exit(exit_status)
+
+
+@SakCmd("map", helpmsg="Execute a command over many sets of arguments in parallel.")
+@SakArg("cmd", required=True, helpmsg='The command to execute, like "plugin cmd".')
+@SakArg(
+    "args_file",
+    helpmsg='File with the arguments of each job, one JSON object per line, "-" for stdin.',
+)
+@SakArg("jobs", short_name="j", helpmsg="Number of parallel jobs (default: CPUs).")
+@SakArg("threads", helpmsg="Execute the jobs in threads instead of processes.")
+@SakArg("unordered", helpmsg="Output the results as soon as they finish.")
+def map_cmd(
+    cmd: str,
+    args_file: str = "-",
+    jobs: int = 0,
+    threads: bool = False,
+    unordered: bool = False,
+) -> None:
+    """Execute a command over many sets of arguments in parallel.
+
+    The command is resolved once and executed by a pool of forked processes,
+    which share the loaded plugins. Each line of the arguments file is a JSON
+    object with the command arguments, like {"name": "foo"}, or a command line,
+    like "--name foo". The result of each job is written as a JSON line, with
+    the job "index" in the arguments file.
+    """
+    from saklib.sakmap import run_map
+
+    root = root_cmd()
+    path = shlex.split(cmd)
+    if path[:1] == ["sak"]:
+        path = path[1:]
+
+    def _run(lines: Any) -> int:
+        return run_map(
+            root,
+            path,
+            lines,
+            sys.stdout,
+            jobs=jobs,
+            threads=threads,
+            unordered=unordered,
+        )
+
+    if args_file == "-":
+        exit_status = _run(sys.stdin)
+    else:
+        with open(args_file) as f:
+            exit_status = _run(f)
+
+    if exit_status != 0:
+        sys.exit(exit_status)
 
 
 def root_cmd() -> SakCmd:
@@ -60,15 +290,44 @@ def root_cmd() -> SakCmd:
         "sak", helpmsg="Group everyday developer's tools in a swiss-army-knife command."
     )
     for plugin in plm.has_plugins:
-        root.subcmds.append(plugin)
+        root.subcmds.append(manifest.wrap_plugin(plugin))
+    root.subcmds.append(wrap_cmd(batch))
+    root.subcmds.append(wrap_cmd(map_cmd))
     return root
 
 
-def main() -> None:
-    root = root_cmd()
+def report_startup() -> None:
+    report = saktiming.get_report()
+    report["versions"] = {"sak": __version__}
+    for plugin in plm.has_plugins:
+        report["versions"][plugin._name] = plugin._get_config().get(
+            "PLUGIN_VERSION", None
+        )
+
+    if startup_history is not None:
+        saktiming.save_report(startup_history, report)
+
+    report_path = os.environ.get(SAK_STARTUP_REPORT_ENV, None)
+    if report_path is not None:
+        with open(report_path, "w") as f:
+            json.dump(report, f)
+    else:
+        sys.stderr.write(saktiming.report_to_table(report))
 
-    args = sys.argv[1:]
-    ret = sak_arg_parser(root, args)
+
+def run_cmd() -> None:
+    with timing("startup", "root_cmd"):
+        root = root_cmd()
+
+    try:
+        output_format, output_file, args = parse_output_args(sys.argv[1:])
+    except ValueError as e:
+        sys.stderr.write(f"ERROR: {e}\n")
+        sys.exit(-1)
+
+    with timing("argparse", "sak_arg_parser"):
+        ret = sak_arg_parser(root, args)
+    saktiming.timings.command = ret.get("prog", None)
 
     if "error" in ret["argparse"]:
         sys.stderr.write(f'ERROR: {ret["argparse"]["error"]}\n')
@@ -79,15 +338,40 @@ def main() -> None:
         sys.exit(0)
 
     if ret["value"] is not None:
+        with timing("output", "render"):
+            try:
+                if output_format is not None:
+                    write_value(ret["value"], output_format, output_file)
+                else:
+                    render_value(ret["value"])
+            except Exception as e:
+                # Generator commands fail while their output is rendered.
+                if os.environ.get("SAK_VERBOSE", False):
+                    traceback.print_exc()
+                sys.stderr.write(f"ERROR: {e}\n")
+                sys.exit(-1)
 
-        if hasattr(ret["value"], "show"):
-            ret["value"].show()
-        elif "bokeh" in str(type(ret["value"])):
-            from bokeh.plotting import show
 
-            show(ret["value"])
-        else:
-            print(ret["value"])
+def main() -> None:
+    if not saktiming.is_trace():
+        run_cmd()
+        return
+
+    # The daemon requests can enable the trace.
+    saktiming.enable(imports=False)
+
+    status = 1
+    try:
+        run_cmd()
+        status = 0
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else int(e.code is not None)
+        raise
+    finally:
+        if trace_path is not None:
+            saktiming.save_trace(
+                trace_path, saktiming.get_trace_entry(sys.argv[1:], status)
+            )
 
 
 def run_pdb() -> None:
@@ -99,9 +383,18 @@ def run_pdb() -> None:
         main()
 
 
+def run_startup_profile() -> None:
+    try:
+        run_pdb()
+    finally:
+        report_startup()
+
+
 if __name__ == "__main__":
     profile = os.environ.get("SAK_PROFILE", False) is not False
-    if not profile:
+    if saktiming.is_startup_profile():
+        run_startup_profile()
+    elif not profile:
         run_pdb()
     else:
         import cProfile
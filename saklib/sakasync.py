@@ -0,0 +1,80 @@
+# -*- coding: UTF-8 -*-
+
+__author__ = "Fernando Witt"
+__credits__ = ["Fernando Witt"]
+
+__license__ = "MIT"
+__maintainer__ = "Fernando Witt"
+__email__ = "ferawitt@gmail.com"
+
+import asyncio
+import inspect
+from collections.abc import AsyncIterator
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+def is_async_callable(func: Any) -> bool:
+    """Check if a command callback is a coroutine or async generator function.
+
+    :param func: The command callback, possibly decorated.
+    :returns: True for the async callbacks.
+    """
+    func = inspect.unwrap(func)
+    func = getattr(func, "__func__", func)
+    return inspect.iscoroutinefunction(func) or inspect.isasyncgenfunction(func)
+
+
+async def _await(aw: Awaitable[T]) -> T:
+    return await aw
+
+
+def run_coroutine(aw: Awaitable[T]) -> T:
+    """Wait for an awaitable from synchronous code.
+
+    :param aw: The awaitable, like the coroutine of an async command.
+    :returns: Its result.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(_await(aw))
+
+    # Called from a coroutine, whose loop can not be blocked or re-entered.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, _await(aw)).result()
+
+
+def iter_async(items: "AsyncIterator[T]") -> Iterator[T]:
+    """Iterate an async iterator, like the ones of async generator commands.
+
+    :param items: The async iterator.
+    :returns: The items, produced by a private event loop.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(items.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        aclose: Optional[Callable[[], Awaitable[Any]]] = getattr(items, "aclose", None)
+        if aclose is not None:
+            loop.run_until_complete(aclose())
+        loop.close()
+
+
+def resolve_async(value: Any) -> Any:
+    """Turn the result of an async command into a synchronous one.
+
+    :param value: The command result.
+    :returns: The awaited result, or an iterator for async iterators.
+    """
+    if inspect.isawaitable(value):
+        return run_coroutine(value)
+    if isinstance(value, AsyncIterator):
+        return iter_async(value)
+    return value
@@ -0,0 +1,128 @@
+# -*- coding: UTF-8 -*-
+
+__author__ = "Fernando Witt"
+__credits__ = ["Fernando Witt"]
+
+__license__ = "MIT"
+__maintainer__ = "Fernando Witt"
+__email__ = "ferawitt@gmail.com"
+
+import json
+import shlex
+from contextlib import redirect_stdout
+from io import StringIO
+from typing import Any, Dict, Iterable, List, Optional, TextIO
+
+from saklib.sakcmd import sak_arg_parser
+from saklib.sakoutput import is_stream
+from saklib.saktable import SakTable
+
+
+def parse_batch_line(line: str) -> Optional[List[str]]:
+    """Get the SAK arguments from a batch line.
+
+    The line can be a shell like command line, a JSON list with the arguments
+    or a JSON object with the arguments in "argv". A leading "sak" is ignored.
+
+    :param line: The batch line.
+    :returns: The arguments, or None for empty and comment lines.
+    """
+    line = line.strip()
+    if (not line) or line.startswith("#"):
+        return None
+
+    if line.startswith("[") or line.startswith("{"):
+        data = json.loads(line)
+        if isinstance(data, dict):
+            data = data.get("argv", None)
+        if not isinstance(data, list):
+            raise ValueError("Expected a list of arguments")
+        argv = [str(x) for x in data]
+    else:
+        argv = shlex.split(line)
+
+    if argv[:1] == ["sak"]:
+        argv = argv[1:]
+    return argv
+
+
+def run_batch_line(root: Any, argv: List[str]) -> Dict[str, Any]:
+    """Execute a single SAK command and describe its result.
+
+    :param root: The root command.
+    :param argv: The command arguments.
+    :returns: The JSON serializable result, with the exit "status".
+    """
+    result: Dict[str, Any] = {"argv": argv, "status": 0}
+
+    stdout = StringIO()
+    try:
+        with redirect_stdout(stdout):
+            ret = sak_arg_parser(root, list(argv))
+    except SystemExit as e:
+        ret = {"argparse": {}}
+        if isinstance(e.code, int):
+            result["status"] = e.code
+        elif e.code is not None:
+            result["status"] = 1
+            result["error"] = str(e.code)
+
+    if stdout.getvalue():
+        result["stdout"] = stdout.getvalue()
+
+    if "error" in ret["argparse"]:
+        result["status"] = 1
+        result["error"] = ret["argparse"]["error"]
+    elif "help" in ret["argparse"]:
+        result["help"] = ret["argparse"]["help"]
+        if ("-h" not in argv) and ("--help" not in argv):
+            # The command line did not reach a command callback.
+            result["status"] = 1
+            result["error"] = "Unknown or incomplete command"
+    elif ret.get("value", None) is not None:
+        result["value"] = ret["value"]
+        if is_stream(result["value"]):
+            result["value"] = list(result["value"])
+        elif isinstance(result["value"], SakTable):
+            result["value"] = result["value"].to_rows()
+    return result
+
+
+def run_batch(
+    root: Any,
+    lines: Iterable[str],
+    output: TextIO,
+    continue_on_error: bool = False,
+) -> int:
+    """Execute SAK commands, one per line, writing one JSON result per line.
+
+    :param root: The root command, shared by all the commands.
+    :param lines: The batch lines, see parse_batch_line.
+    :param output: Where to write the results.
+    :param continue_on_error: Keep executing the commands after a failure.
+    :returns: The exit status, 0 if all the commands succeeded.
+    """
+    exit_status = 0
+    for line_number, line in enumerate(lines, start=1):
+        try:
+            argv = parse_batch_line(line)
+        except ValueError as e:
+            result: Dict[str, Any] = {
+                "argv": None,
+                "status": 1,
+                "error": f"Invalid batch line: {e}",
+            }
+        else:
+            if argv is None:
+                continue
+            result = run_batch_line(root, argv)
+
+        result["line"] = line_number
+        output.write(json.dumps(result, default=str) + "\n")
+        output.flush()
+
+        if result["status"] != 0:
+            exit_status = 1
+            if not continue_on_error:
+                break
+    return exit_status
@@ -0,0 +1,482 @@
+# -*- coding: UTF-8 -*-
+
+__author__ = "Fernando Witt"
+__credits__ = ["Fernando Witt"]
+
+__license__ = "MIT"
+__maintainer__ = "Fernando Witt"
+__email__ = "ferawitt@gmail.com"
+
+import inspect
+import os
+import pickle
+import shutil
+import threading
+import time
+from argparse import Namespace
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional, Sequence, Set, Tuple
+
+from saklib.sakconfig import SAK_CACHE
+from saklib.sakhash import make_hash_sha256
+
+# Maximum size, in bytes, of all the cached results.
+CMD_CACHE_MAX_SIZE = int(
+    os.environ.get("SAK_CMD_CACHE_MAX_SIZE", str(100 * 1024 * 1024))
+)
+
+# The whole cache folder is scanned for the eviction at least once every this
+# number of results stored by the process, since other processes share it.
+CMD_CACHE_EVICT_WRITES = 100
+
+# Set to "YES" to ignore the cached results, like the --no_cache argument.
+SAK_NO_CACHE_ENV = "SAK_NO_CACHE"
+
+# Seconds that the completer results are reused, unless the argument sets its
+# own completer_ttl. 0 disables the completer cache.
+COMPLETER_CACHE_TTL = float(os.environ.get("SAK_COMPLETER_CACHE_TTL", "60"))
+
+# Expired completer results are still used, while they are refreshed in the
+# background, until they are this number of TTLs old.
+COMPLETER_CACHE_STALE_FACTOR = 10
+
+# Maximum number of completer results kept in memory.
+COMPLETER_CACHE_MAX_ENTRIES = 1024
+
+_MISSING = object()
+
+
+def get_func_key(func: Callable[..., Any]) -> str:
+    """Identify a command callback, by its file and qualified name.
+
+    :param func: The command callback.
+    :returns: The key.
+    """
+    # The decorated commands are identified by the original function.
+    func = inspect.unwrap(func)
+    try:
+        file_name = inspect.getfile(func)
+    except TypeError:
+        file_name = ""
+    return make_hash_sha256(
+        [str(Path(file_name).resolve()) if file_name else "", func.__qualname__]
+    )
+
+
+def get_func_version(func: Callable[..., Any]) -> str:
+    """Identify the version of a command callback source.
+
+    :param func: The command callback.
+    :returns: The modification time and size of its file, or the hash of its
+        code if it has no file.
+    """
+    func = inspect.unwrap(func)
+    try:
+        stat = os.stat(inspect.getfile(func))
+        return f"{stat.st_mtime_ns}:{stat.st_size}"
+    except (TypeError, OSError):
+        pass
+
+    code = getattr(func, "__code__", None)
+    if code is None:
+        return ""
+    # The nested code objects repr has their address.
+    consts = [x for x in code.co_consts if not inspect.iscode(x)]
+    return make_hash_sha256([code.co_code.hex(), consts])
+
+
+def get_args_key(args: Sequence[Any], vargs: Dict[str, Any]) -> str:
+    from saklib.sakplugin import SakPlugin
+
+    # The plugin of the method commands is not part of the arguments.
+    args = [x for x in args if not isinstance(x, SakPlugin)]
+    return make_hash_sha256({"args": args, "vargs": vargs})
+
+
+class SakCmdCache:
+    """On disk cache of the commands results.
+
+    Each command has a folder, with one pickle file per arguments. The least
+    recently used results are removed when the cache is bigger than max_size.
+    """
+
+    def __init__(self, path: Path, max_size: int = CMD_CACHE_MAX_SIZE) -> None:
+        self.path = path
+        self.max_size = max_size
+
+        # The size of the cached results, None until the folder is scanned.
+        self._size: Optional[int] = None
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def _entry_path(self, func_key: str, args_key: str) -> Path:
+        return self.path / func_key / f"{args_key}.pk"
+
+    def get(self, func_key: str, args_key: str, ttl: Optional[float] = None) -> Any:
+        """Get a cached result.
+
+        :param func_key: The command key, from get_func_key.
+        :param args_key: The arguments key, from get_args_key.
+        :param ttl: The maximum age, in seconds, of the result.
+        :returns: The result, or _MISSING.
+        """
+        entry_path = self._entry_path(func_key, args_key)
+        try:
+            with open(entry_path, "rb") as f:
+                created, value = pickle.load(f)
+        except FileNotFoundError:
+            return _MISSING
+        except Exception:
+            # Corrupted or from an incompatible version.
+            entry_path.unlink(missing_ok=True)
+            return _MISSING
+
+        if (ttl is not None) and (time.time() - created > ttl):
+            entry_path.unlink(missing_ok=True)
+            return _MISSING
+
+        # The modification time tracks the last use, for the eviction.
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return value
+
+    def set(self, func_key: str, args_key: str, value: Any) -> bool:
+        """Store a result.
+
+        :param func_key: The command key, from get_func_key.
+        :param args_key: The arguments key, from get_args_key.
+        :param value: The result.
+        :returns: False if the result can not be cached.
+        """
+        try:
+            data = pickle.dumps((time.time(), value))
+        except Exception:
+            return False
+        if len(data) > self.max_size:
+            return False
+
+        entry_path = self._entry_path(func_key, args_key)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            old_size = entry_path.stat().st_size
+        except FileNotFoundError:
+            old_size = 0
+        tmp_path = entry_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, entry_path)
+
+        # Only scan the folder when the tracked size is over the limit.
+        with self._lock:
+            self._writes += 1
+            if self._size is not None:
+                self._size += len(data) - old_size
+            need_evict = (
+                (self._size is None)
+                or (self._size > self.max_size)
+                or (self._writes >= CMD_CACHE_EVICT_WRITES)
+            )
+        if need_evict:
+            self.evict()
+        return True
+
+    def _entries(self) -> Dict[Path, Tuple[float, int]]:
+        ret: Dict[Path, Tuple[float, int]] = {}
+        if not self.path.is_dir():
+            return ret
+        for func_dir in os.scandir(self.path):
+            if not func_dir.is_dir():
+                continue
+            for entry in os.scandir(func_dir.path):
+                if entry.name.endswith(".pk"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    ret[Path(entry.path)] = (stat.st_mtime, stat.st_size)
+        return ret
+
+    def evict(self) -> None:
+        """Remove the least recently used results above the maximum size."""
+        entries = self._entries()
+        size = sum(x[1] for x in entries.values())
+        for entry_path, (_, entry_size) in sorted(
+            entries.items(), key=lambda x: x[1][0]
+        ):
+            if size <= self.max_size:
+                break
+            entry_path.unlink(missing_ok=True)
+            size -= entry_size
+
+        with self._lock:
+            self._size = size
+            self._writes = 0
+
+    def invalidate(self, func: Optional[Callable[..., Any]] = None) -> None:
+        """Remove the cached results.
+
+        :param func: The command callback, or None to remove all the results.
+        """
+        path = self.path if func is None else self.path / get_func_key(func)
+        shutil.rmtree(path, ignore_errors=True)
+        with self._lock:
+            self._size = None
+
+    def stats(self) -> Tuple[int, int]:
+        """Get the number and the total size, in bytes, of the cached results."""
+        entries = self._entries()
+        return len(entries), sum(x[1] for x in entries.values())
+
+    def call(
+        self,
+        func: Callable[..., Any],
+        args: Sequence[Any],
+        vargs: Dict[str, Any],
+        ttl: Optional[float] = None,
+        no_cache: bool = False,
+    ) -> Any:
+        """Call a command callback, reusing its cached result.
+
+        :param func: The command callback.
+        :param args: The positional arguments.
+        :param vargs: The keyword arguments.
+        :param ttl: The maximum age, in seconds, of the cached result.
+        :param no_cache: Do not use the cached result, but update it.
+        :returns: The result.
+        """
+        func_key, args_key, value = self._lookup(func, args, vargs, ttl, no_cache)
+        if value is not _MISSING:
+            return value
+
+        value = func(*args, **vargs)
+        self._store(func_key, args_key, value)
+        return value
+
+    async def call_async(
+        self,
+        func: Callable[..., Awaitable[Any]],
+        args: Sequence[Any],
+        vargs: Dict[str, Any],
+        ttl: Optional[float] = None,
+        no_cache: bool = False,
+    ) -> Any:
+        """Call a coroutine command callback, reusing its cached result.
+
+        :param func: The command callback.
+        :param args: The positional arguments.
+        :param vargs: The keyword arguments.
+        :param ttl: The maximum age, in seconds, of the cached result.
+        :param no_cache: Do not use the cached result, but update it.
+        :returns: The result.
+        """
+        func_key, args_key, value = self._lookup(func, args, vargs, ttl, no_cache)
+        if value is not _MISSING:
+            return value
+
+        value = await func(*args, **vargs)
+        self._store(func_key, args_key, value)
+        return value
+
+    def _lookup(
+        self,
+        func: Callable[..., Any],
+        args: Sequence[Any],
+        vargs: Dict[str, Any],
+        ttl: Optional[float],
+        no_cache: bool,
+    ) -> Tuple[str, str, Any]:
+        func_key = get_func_key(func)
+        # The results of the older versions of the command are not reused, but
+        # are kept in the same folder, to be invalidated or evicted with it.
+        args_key = make_hash_sha256([get_func_version(func), get_args_key(args, vargs)])
+
+        value = _MISSING
+        if not (no_cache or os.environ.get(SAK_NO_CACHE_ENV, "NO") == "YES"):
+            value = self.get(func_key, args_key, ttl=ttl)
+        return func_key, args_key, value
+
+    def _store(self, func_key: str, args_key: str, value: Any) -> None:
+        from saklib.sakoutput import is_stream
+
+        # The streams are consumed by the caller, they can not be stored.
+        if not is_stream(value):
+            self.set(func_key, args_key, value)
+
+
+_CMD_CACHE: Optional[SakCmdCache] = None
+
+
+def get_cmd_cache() -> Optional[SakCmdCache]:
+    global _CMD_CACHE
+    if (_CMD_CACHE is None) and (SAK_CACHE is not None):
+        _CMD_CACHE = SakCmdCache(SAK_CACHE / "results")
+    return _CMD_CACHE
+
+
+def get_completer_key(
+    name: str, completercb: Callable[..., Any], parsed_args: Optional[Namespace]
+) -> str:
+    """Identify the results of an argument completer, except for the prefix.
+
+    :param name: The argument name.
+    :param completercb: The completer callback.
+    :param parsed_args: The already parsed arguments, that the completer may use.
+    :returns: The key.
+    """
+    values: Dict[str, Any] = {}
+    if parsed_args is not None:
+        for key, value in vars(parsed_args).items():
+            if (key == name) or key.startswith("sak_") or callable(value):
+                continue
+            values[key] = value
+    return make_hash_sha256(
+        [get_func_key(completercb), get_func_version(completercb), name, values]
+    )
+
+
+def filter_completions(values: Any, prefix: str) -> Any:
+    if isinstance(values, dict):
+        return {k: v for k, v in values.items() if str(k).startswith(prefix)}
+    return [x for x in values if str(x).startswith(prefix)]
+
+
+class SakCompleterCache:
+    """Cache of the argument completer results.
+
+    The results are kept in memory and on disk, since each TAB press is a new
+    process. The results of a prefix also serve the longer prefixes, filtered.
+    Expired results are still returned while they are refreshed in the
+    background.
+    """
+
+    def __init__(self, path: Optional[Path]) -> None:
+        self.path = path
+        self._entries: Dict[Tuple[str, str], Tuple[float, Any]] = {}
+        self._refreshing: Set[Tuple[str, str]] = set()
+        self._lock = threading.Lock()
+
+    def _entry_path(self, key: str, prefix: str) -> Optional[Path]:
+        if self.path is None:
+            return None
+        return self.path / key / f"{make_hash_sha256(prefix)}.pk"
+
+    def _load(self, key: str, prefix: str) -> Optional[Tuple[float, Any]]:
+        with self._lock:
+            entry = self._entries.get((key, prefix), None)
+        if entry is not None:
+            return entry
+
+        entry_path = self._entry_path(key, prefix)
+        if entry_path is None:
+            return None
+        try:
+            with open(entry_path, "rb") as f:
+                entry = pickle.load(f)
+        except Exception:
+            return None
+
+        self._remember(key, prefix, entry)
+        return entry
+
+    def _remember(self, key: str, prefix: str, entry: Tuple[float, Any]) -> None:
+        with self._lock:
+            self._entries.pop((key, prefix), None)
+            self._entries[(key, prefix)] = entry
+            if len(self._entries) > COMPLETER_CACHE_MAX_ENTRIES:
+                # The oldest stored entry.
+                del self._entries[next(iter(self._entries))]
+
+    def _store(self, key: str, prefix: str, values: Any) -> Any:
+        if not isinstance(values, (list, dict)):
+            values = list(values)
+        entry = (time.time(), values)
+        self._remember(key, prefix, entry)
+
+        entry_path = self._entry_path(key, prefix)
+        if entry_path is not None:
+            try:
+                entry_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = entry_path.with_suffix(
+                    f".{os.getpid()}.{threading.get_ident()}.tmp"
+                )
+                with open(tmp_path, "wb") as f:
+                    pickle.dump(entry, f)
+                os.replace(tmp_path, entry_path)
+            except Exception:
+                # The results are still cached in memory.
+                pass
+        return values
+
+    def _refresh(self, key: str, prefix: str, compute: Callable[[str], Any]) -> None:
+        try:
+            self._store(key, prefix, compute(prefix))
+        except Exception:
+            # Keep using the expired results.
+            pass
+        finally:
+            with self._lock:
+                self._refreshing.discard((key, prefix))
+
+    def _refresh_in_background(
+        self, key: str, prefix: str, compute: Callable[[str], Any]
+    ) -> None:
+        with self._lock:
+            if (key, prefix) in self._refreshing:
+                return
+            self._refreshing.add((key, prefix))
+        threading.Thread(
+            target=self._refresh, args=(key, prefix, compute), daemon=True
+        ).start()
+
+    def get(
+        self, key: str, prefix: str, ttl: float, compute: Callable[[str], Any]
+    ) -> Any:
+        """Get the completer results, computing them only when not cached.
+
+        :param key: The completer key, from get_completer_key.
+        :param prefix: The prefix being completed.
+        :param ttl: The number of seconds that the results are fresh.
+        :param compute: Compute the completer results of a prefix.
+        :returns: The completer results.
+        """
+        now = time.time()
+        # Look for the longest cached prefix.
+        for size in range(len(prefix), -1, -1):
+            cached_prefix = prefix[:size]
+            entry = self._load(key, cached_prefix)
+            if entry is None:
+                continue
+
+            created, values = entry
+            age = now - created
+            if age > ttl * COMPLETER_CACHE_STALE_FACTOR:
+                continue
+            if age > ttl:
+                self._refresh_in_background(key, cached_prefix, compute)
+
+            if cached_prefix == prefix:
+                return values
+            return filter_completions(values, prefix)
+
+        return self._store(key, prefix, compute(prefix))
+
+    def invalidate(self) -> None:
+        """Remove all the cached completer results."""
+        with self._lock:
+            self._entries.clear()
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+_COMPLETER_CACHE: Optional[SakCompleterCache] = None
+
+
+def get_completer_cache() -> SakCompleterCache:
+    global _COMPLETER_CACHE
+    if _COMPLETER_CACHE is None:
+        _COMPLETER_CACHE = SakCompleterCache(
+            SAK_CACHE / "completers" if SAK_CACHE is not None else None
+        )
+    return _COMPLETER_CACHE
@@ -0,0 +1,185 @@
+# -*- coding: UTF-8 -*-
+
+__author__ = "Fernando Witt"
+__credits__ = ["Fernando Witt"]
+
+__license__ = "MIT"
+__maintainer__ = "Fernando Witt"
+__email__ = "ferawitt@gmail.com"
+
+# NOTE: This module is imported by the sak launcher before choosing the python
+# interpreter, so it must only depend on the standard library.
+
+import array
+import json
+import os
+import socket
+import struct
+from typing import Any, Dict, List, Optional, Tuple
+
+DAEMON_SOCKET_NAME = "daemon.sock"
+DAEMON_CONNECT_TIMEOUT = 1.0
+
+# The maximum number of file descriptors in a single message.
+MAX_FDS = 8
+
+
+def get_daemon_socket_path(sak_global: Optional[str] = None) -> Optional[str]:
+    if sak_global is None:
+        sak_global = os.environ.get("SAK_GLOBAL", None)
+    if sak_global is None:
+        return None
+    return os.path.join(sak_global, "cache", DAEMON_SOCKET_NAME)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> Tuple[bytes, List[int]]:
+    data = b""
+    fds: List[int] = []
+    fds_size = socket.CMSG_SPACE(MAX_FDS * array.array("i").itemsize)
+    while len(data) < size:
+        chunk, ancdata, _, _ = sock.recvmsg(size - len(data), fds_size)
+        for level, kind, cmsg_data in ancdata:
+            if (level == socket.SOL_SOCKET) and (kind == socket.SCM_RIGHTS):
+                fds_array = array.array("i")
+                fds_array.frombytes(
+                    cmsg_data[: len(cmsg_data) - (len(cmsg_data) % fds_array.itemsize)]
+                )
+                fds += list(fds_array)
+        if not chunk:
+            for fd in fds:
+                os.close(fd)
+            raise EOFError("Connection closed")
+        data += chunk
+    return data, fds
+
+
+def send_msg(
+    sock: socket.socket, msg: Dict[str, Any], fds: Optional[List[int]] = None
+) -> None:
+    """Send a length prefixed JSON message, optionally with file descriptors.
+
+    :param sock: The unix socket.
+    :param msg: The message.
+    :param fds: The file descriptors to send together with the message.
+    """
+    data = json.dumps(msg).encode("utf-8")
+    data = struct.pack("!I", len(data)) + data
+
+    ancdata = []
+    if fds:
+        ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))]
+
+    sent = sock.sendmsg([data], ancdata)
+    if sent < len(data):
+        sock.sendall(data[sent:])
+
+
+def recv_msg(sock: socket.socket) -> Tuple[Optional[Dict[str, Any]], List[int]]:
+    """Receive a message sent by send_msg.
+
+    :param sock: The unix socket.
+    :returns: The message, or None if the connection was closed, and the
+        received file descriptors.
+    """
+    try:
+        header, fds = _recv_exact(sock, 4)
+        (size,) = struct.unpack("!I", header)
+        data, more_fds = _recv_exact(sock, size)
+    except EOFError:
+        return None, []
+    return json.loads(data.decode("utf-8")), fds + more_fds
+
+
+def connect(socket_path: str) -> Optional[socket.socket]:
+    if not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(DAEMON_CONNECT_TIMEOUT)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    sock.settimeout(None)
+    return sock
+
+
+def request(msg: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Send a single control message to the daemon and wait for the reply.
+
+    :param msg: The message.
+    :returns: The reply, or None if the daemon is not running.
+    """
+    socket_path = get_daemon_socket_path()
+    if socket_path is None:
+        return None
+
+    sock = connect(socket_path)
+    if sock is None:
+        return None
+
+    with sock:
+        try:
+            send_msg(sock, msg)
+            reply, _ = recv_msg(sock)
+        except OSError:
+            return None
+    return reply
+
+
+def run_in_daemon(
+    argv: List[str], env: Optional[Dict[str, str]] = None
+) -> Optional[int]:
+    """Execute a SAK command in the resident daemon, if it is running.
+
+    The stdin, stdout and stderr file descriptors are sent to the daemon, so
+    the command output goes directly to the caller terminal or pipes.
+
+    :param argv: The SAK command arguments.
+    :param env: The command environment, the current one by default.
+    :returns: The command exit code, or None if the command must be executed
+        without the daemon.
+    """
+    if os.environ.get("SAK_DAEMON", "YES") != "YES":
+        return None
+    if "_ARGCOMPLETE" in os.environ:
+        return None
+    if argv[:1] == ["daemon"]:
+        # The daemon commands can not be served by the daemon itself.
+        return None
+
+    socket_path = get_daemon_socket_path()
+    if socket_path is None:
+        return None
+
+    sock = connect(socket_path)
+    if sock is None:
+        return None
+
+    with sock:
+        msg = {
+            "type": "run",
+            "argv": argv,
+            "cwd": os.getcwd(),
+            "env": dict(os.environ) if env is None else env,
+        }
+        try:
+            send_msg(sock, msg, fds=[0, 1, 2])
+        except OSError:
+            return None
+
+        try:
+            reply, _ = recv_msg(sock)
+        except KeyboardInterrupt:
+            send_msg(sock, {"type": "interrupt"})
+            reply, _ = recv_msg(sock)
+        except OSError:
+            reply = None
+
+    if reply is None:
+        # The daemon died while executing the command. We cannot know if the
+        # command had side effects, so do not try again.
+        return -1
+    if reply.get("fallback", False):
+        return None
+    return int(reply["exit_code"])
@@ -10,12 +10,15 @@ __email__ = "ferawitt@gmail.com"
 import functools
 import inspect
 import os
+import weakref
 from argparse import ArgumentParser, Namespace, RawTextHelpFormatter
-from collections.abc import Iterable
+from collections import OrderedDict
+from collections.abc import Iterable, Mapping
 from contextlib import redirect_stderr, redirect_stdout
 from io import StringIO
-from types import ModuleType
-from typing import Any, Callable, Dict, List, Optional, Union
+from pathlib import Path
+from types import MethodType, ModuleType
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar, Union
 
 try:
     from typing import get_args
@@ -44,7 +47,10 @@ except ImportError as e:
 
     install_core_requirements()
 
-from saklib.sakplugin import SakPlugin
+from saklib.sakasync import resolve_async
+from saklib.sakoutput import parse_output_args
+from saklib.sakplugin import SakPlugin, register_reload_callback
+from saklib.saktiming import timing
 
 hasArgcomplete = False
 try:
@@ -123,6 +129,7 @@ class SakArg(SakDecorator):
         helpmsg: str = "",
         short_name: Optional[str] = None,
         completercb: Optional[Callable[[Optional[SakCompleterArg]], List[Any]]] = None,
+        completer_ttl: Optional[float] = None,
         **vargs: Any,
     ) -> None:
         super(SakArg, self).__init__()
@@ -132,9 +139,46 @@ class SakArg(SakDecorator):
         self.vargs = vargs
         self.completercb = completercb
 
+        # Seconds that the completer results are reused, 0 to always call the
+        # completer. None uses the SAK_COMPLETER_CACHE_TTL default.
+        self.completer_ttl = completer_ttl
+
         # Store the original type when a type_init is specified.
         self.orig_type: Optional[type] = None
 
+    def complete(self, arg: SakCompleterArg) -> List[Any]:
+        """Call the completer callback, reusing its cached results.
+
+        :param arg: The completer arguments.
+        :returns: The completer results.
+        """
+        from saklib.sakcache import (
+            COMPLETER_CACHE_TTL,
+            get_completer_cache,
+            get_completer_key,
+        )
+
+        completercb = self.completercb
+        assert completercb is not None, "Completer Calback is supposed to be not None"
+
+        ttl = COMPLETER_CACHE_TTL if self.completer_ttl is None else self.completer_ttl
+        if ttl <= 0:
+            return completercb(arg)
+
+        def compute(prefix: str) -> List[Any]:
+            assert completercb is not None
+            # Keep the None prefix of the callers without one, like the webapp.
+            _prefix = prefix if (prefix or arg.prefix is not None) else None
+            return completercb(
+                SakCompleterArg(_prefix, arg.action, arg.parser, arg.parsed_args)
+            )
+
+        key = get_completer_key(self.name, completercb, arg.parsed_args)
+        values: List[Any] = get_completer_cache().get(
+            key, arg.prefix or "", ttl, compute
+        )
+        return values
+
     def addToArgParser(self, parser: ArgumentParser) -> None:
         pargs = []
         pargs += ["--%s" % self.name]
@@ -161,10 +205,7 @@ class SakArg(SakDecorator):
                     parser=vargs["parser"],
                     parsed_args=vargs["parsed_args"],
                 )
-                assert (
-                    completercb is not None
-                ), "Completer Calback is supposed to be not None"
-                return completercb(arg)
+                return self.complete(arg)
 
             aux.completer = completercbWrapper  # type: ignore
 
@@ -174,13 +215,17 @@ class SakCmd(SakDecorator):
     EXP_WEB = "web"
 
     def __init__(
-        self, name: str = "", expose: List[str] = [], helpmsg: str = ""
+        self,
+        name: str = "",
+        expose: List[str] = [],
+        helpmsg: str = "",
+        cache: Union[bool, float, None] = None,
     ) -> None:
         super(SakCmd, self).__init__()
 
         self.name = name
         self.callback = None
-        self.subcmds: List[Union[SakCmd, SakPlugin]] = []
+        self.subcmds: List[Union[SakCmd, SakPlugin, "SakCmdWrapper"]] = []
 
         # TODO(witt): Can this be more specific?
         self.args: List[Any] = []
@@ -188,6 +233,69 @@ class SakCmd(SakDecorator):
         self.helpmsg = helpmsg
         self.description = None
 
+        # Cache the results on disk for this number of seconds, or forever if
+        # True. The command also gets a --no_cache argument.
+        self.cache = cache
+
+    def __call__(self, _sak_func: Callable[..., Any]) -> Callable[..., Any]:
+        wrapper = super(SakCmd, self).__call__(_sak_func)
+        if (self.cache is None) or (self.cache is False):
+            return wrapper
+
+        ttl = None if self.cache is True else float(self.cache)
+
+        if inspect.iscoroutinefunction(_sak_func):
+
+            @functools.wraps(_sak_func)
+            async def async_cached_wrapper(
+                *args: Any, no_cache: bool = False, **vargs: Any
+            ) -> Any:
+                from saklib.sakcache import get_cmd_cache
+
+                cmd_cache = get_cmd_cache()
+                if cmd_cache is None:
+                    return await _sak_func(*args, **vargs)
+                return await cmd_cache.call_async(
+                    _sak_func, args, vargs, ttl=ttl, no_cache=no_cache
+                )
+
+            async_cached_wrapper._sak_dec_chain = self  # type: ignore
+            return async_cached_wrapper
+
+        @functools.wraps(_sak_func)
+        def cached_wrapper(*args: Any, no_cache: bool = False, **vargs: Any) -> Any:
+            from saklib.sakcache import get_cmd_cache
+
+            cmd_cache = get_cmd_cache()
+            if cmd_cache is None:
+                return _sak_func(*args, **vargs)
+            return cmd_cache.call(_sak_func, args, vargs, ttl=ttl, no_cache=no_cache)
+
+        cached_wrapper._sak_dec_chain = self  # type: ignore
+        return cached_wrapper
+
+
+T = TypeVar("T")
+
+# The wrappers of the objects that can not store them, by object id and name.
+# Only while the wrappers are used, and they keep their objects alive, so the
+# ids are not reused.
+_WRAPPERS: "weakref.WeakValueDictionary[Tuple[int, Optional[str]], SakCmdWrapper]" = (
+    weakref.WeakValueDictionary()
+)
+# The generation of the cached wrappers and wrapper properties.
+_CMD_CACHE_GENERATION = 0
+# The attribute with the wrappers of an object, by name.
+_WRAPPERS_ATTR = "__sak_wrappers__"
+# Number of subcommand prefixes cached per wrapper.
+SUBCMDS_PREFIX_MEMO_SIZE = 64
+
+
+class _SakWrappers(Dict[Optional[str], Tuple[int, "SakCmdWrapper"]]):
+    # The wrappers are not pickled, or copied, with their object.
+    def __reduce__(self) -> Any:
+        return (dict, ())
+
 
 class SakCmdWrapper:
     def __init__(
@@ -203,6 +311,11 @@ class SakCmdWrapper:
     ):
         assert name != "0"
 
+        self._memo_values: Dict[str, Any] = {}
+        self._memo_generation = _CMD_CACHE_GENERATION
+
+        # The wrapped object, as given to wrap_cmd.
+        self._wrap_source = wrapped_content
         self._wrapped_content = wrapped_content
         self._name = name
         self._callback = callback
@@ -234,6 +347,30 @@ class SakCmdWrapper:
         if self.name is None:
             raise Exception("I failed to infer the name")
 
+    def _memo(self, key: str, compute: Callable[[], T]) -> T:
+        # The computed properties are cached until clear_cmd_cache is called.
+        if self._memo_generation != _CMD_CACHE_GENERATION:
+            self._memo_values = {}
+            self._memo_generation = _CMD_CACHE_GENERATION
+        if key not in self._memo_values:
+            self._memo_values[key] = compute()
+        return self._memo_values[key]  # type: ignore
+
+    def _memo_subcmds(
+        self, prefix: str, compute: Callable[[], List["SakCmdWrapper"]]
+    ) -> List["SakCmdWrapper"]:
+        # The least recently used prefixes are forgotten, there can be many.
+        memo: "OrderedDict[str, List[SakCmdWrapper]]" = self._memo(
+            "subcmds_by_prefix", OrderedDict
+        )
+        if prefix in memo:
+            memo.move_to_end(prefix)
+            return memo[prefix]
+        ret = memo[prefix] = compute()
+        if len(memo) > SUBCMDS_PREFIX_MEMO_SIZE:
+            memo.popitem(last=False)
+        return ret
+
     def __str__(self) -> str:
         return f"<{self.name} {self.callback}>"
 
@@ -242,6 +379,9 @@ class SakCmdWrapper:
 
     @property
     def name(self) -> Optional[str]:
+        return self._memo("name", self._get_name)
+
+    def _get_name(self) -> Optional[str]:
         cmd = self.cmd
         if cmd:
             if cmd.name:
@@ -293,35 +433,38 @@ class SakCmdWrapper:
 
     @property
     def subcmds(self) -> List["SakCmdWrapper"]:
+        # The SakCmd subcommands can still be changed after the wrapper was
+        # created, so only their wrappers are cached.
         if self._subcmds:
-            return [SakCmdWrapper(x) for x in self._subcmds]
+            return [wrap_cmd(x) for x in self._subcmds]
 
         cmd = self.cmd
         if cmd:
-            if cmd.subcmds:
-                return [SakCmdWrapper(x) for x in cmd.subcmds]
-            else:
-                return []
+            return [wrap_cmd(x) for x in cmd.subcmds]
+
+        return self._memo("subcmds", self._get_subcmds)
 
+    def _get_subcmds(self) -> List["SakCmdWrapper"]:
         if self._wrapped_content:
             d = self._wrapped_content
 
+            hook = _get_subcmds_hook(d)
+            if hook is not None:
+                return _wrap_hook_subcmds(hook(""))
+
             if isinstance(d, ModuleType):
                 if hasattr(d, "EXPOSE"):
-                    return [SakCmdWrapper(wrapped_content=d.EXPOSE, name=d.__name__)]
+                    return [wrap_cmd(d.EXPOSE, name=d.__name__)]
 
             if isinstance(d, dict):
                 subcmds = []
                 for k, v in d.items():
                     if k == "sak_subcmds":
                         if isinstance(v, dict):
-                            subcmds += [
-                                SakCmdWrapper(wrapped_content=y, name=x)
-                                for x, y in v.items()
-                            ]
+                            subcmds += [wrap_cmd(y, name=x) for x, y in v.items()]
                             continue
                         elif isinstance(v, list):
-                            subcmds += [SakCmdWrapper(wrapped_content=x) for x in v]
+                            subcmds += [wrap_cmd(x) for x in v]
                             continue
 
                     if hasattr(v, "_sak_dec_chain"):
@@ -335,7 +478,7 @@ class SakCmdWrapper:
                         #             was failing because it tried to add the __doc__.
                         # subcmds.append(SakCmdWrapper(wrapped_content=v))
                     else:
-                        subcmds.append(SakCmdWrapper(wrapped_content=v, name=k))
+                        subcmds.append(wrap_cmd(v, name=k))
 
                 if subcmds:
                     return subcmds
@@ -355,51 +498,107 @@ class SakCmdWrapper:
                                 f"WARNING! I am trying to access the name attribute of '{v}' but failed.",
                                 str(e),
                             )
-                    subcmds.append(SakCmdWrapper(wrapped_content=v, name=k))
+                    subcmds.append(wrap_cmd(v, name=k))
                 if subcmds:
                     return subcmds
 
-            if True:
-                subcmds = []
-                for k in dir(d):
-                    if k.startswith("_sak_unamed_expose_"):
-                        dd = getattr(d, k)
-                        subcmds.append(SakCmdWrapper(wrapped_content=dd))
-                        continue
+            subcmds = [x for _, x in get_dir_subcmds(d)]
+            if subcmds:
+                return subcmds
 
-                    if k.startswith("_"):
-                        continue
+        return []
 
-                    try:
-                        dd = getattr(d, k)
+    @property
+    def has_lazy_subcmds(self) -> bool:
+        """Check if the subcommands are only enumerated on demand, by prefix."""
+        return _get_subcmds_hook(self._wrapped_content) is not None
 
-                        dd = SakCmdWrapper(wrapped_content=dd, name=k)
-                        subcmds.append(dd)
-                        continue
-                    except Exception as e:
-                        # TODO(witt): Just does not add because of failure.
-                        verbose = False
-                        if verbose:
-                            print("skip", k, str(e))
-                            import sys
-                            import traceback
-
-                            print("Exception in user code:")
-                            print("-" * 60)
-                            traceback.print_exc(file=sys.stdout)
-                            print("-" * 60)
-                        continue
+    def get_subcmds(self, prefix: str = "") -> List["SakCmdWrapper"]:
+        """Get the subcommands whose name starts with prefix.
 
-                if subcmds:
-                    return subcmds
+        The objects with the __sak_subcmds__ hook, and the ones whose
+        subcommands are their attributes, are only asked for the matching
+        subcommands, instead of enumerating all of them.
 
-        return []
+        :param prefix: The subcommand name prefix.
+        :returns: The matching subcommands.
+        """
+        d = self._wrapped_content
+        hook = _get_subcmds_hook(d)
+        if hook is not None:
+            get_subcmds: Callable[[str], Any] = hook
+            return self._memo_subcmds(
+                prefix, lambda: _wrap_hook_subcmds(get_subcmds(prefix))
+            )
+
+        if (
+            prefix
+            and not (self._subcmds or self.cmd)
+            and ("subcmds" not in self._memo_values)
+            and _has_dir_subcmds(d)
+        ):
+            return self._memo_subcmds(
+                prefix, lambda: [x for _, x in get_dir_subcmds(d, prefix=prefix)]
+            )
+
+        return [
+            x
+            for x in self.subcmds
+            if (x is not None) and (x.name is not None) and x.name.startswith(prefix)
+        ]
+
+    def get_subcmd(self, name: str) -> Optional["SakCmdWrapper"]:
+        """Find a subcommand by its exact name.
+
+        :param name: The subcommand name.
+        :returns: The subcommand, or None if there is no subcommand with this name.
+        """
+        if self._subcmds or self.cmd:
+            # The SakCmd subcommands can still change, so they are not indexed.
+            for subcmd in self.subcmds:
+                if (subcmd is not None) and (subcmd.name == name):
+                    return subcmd
+            return None
+
+        if self.has_lazy_subcmds or (
+            ("subcmds" not in self._memo_values)
+            and _has_dir_subcmds(self._wrapped_content)
+        ):
+            for subcmd in self.get_subcmds(name):
+                if subcmd.name == name:
+                    return subcmd
+            return None
+
+        return self._memo("subcmds_index", self._get_subcmds_index).get(name, None)
+
+    def _get_subcmds_index(self) -> Dict[str, "SakCmdWrapper"]:
+        ret: Dict[str, SakCmdWrapper] = {}
+        for subcmd in self.subcmds:
+            if (subcmd is not None) and subcmd.name:
+                ret.setdefault(subcmd.name, subcmd)
+        return ret
 
     @property
     def args(self) -> List[SakArg]:
         if self._args:
             return self._args
+        return self._memo("args", self._get_cmd_args)
 
+    def _get_cmd_args(self) -> List[SakArg]:
+        args = self._get_args()
+        cmd = self.cmd
+        if (cmd is not None) and getattr(cmd, "cache", None):
+            args = args + [
+                SakArg(
+                    "no_cache",
+                    helpmsg="Do not use the cached result.",
+                    action="store_true",
+                    default=False,
+                )
+            ]
+        return args
+
+    def _get_args(self) -> List[SakArg]:
         if self._wrapped_content:
             d = self._wrapped_content
 
@@ -503,6 +702,10 @@ class SakCmdWrapper:
                                     _params[chain.name].short_name = chain.short_name
                                 if chain.completercb is not None:
                                     _params[chain.name].completercb = chain.completercb
+                                if chain.completer_ttl is not None:
+                                    _params[
+                                        chain.name
+                                    ].completer_ttl = chain.completer_ttl
 
                                 vargs = dict(chain.vargs)
                                 if "type_init" in vargs:
@@ -535,6 +738,9 @@ class SakCmdWrapper:
 
     @property
     def helpmsg(self) -> str:
+        return self._memo("helpmsg", self._get_helpmsg)
+
+    def _get_helpmsg(self) -> str:
         if self._helpmsg:
             return self._helpmsg
 
@@ -578,6 +784,9 @@ class SakCmdWrapper:
 
     @property
     def description(self) -> Optional[str]:
+        return self._memo("description", self._get_description)
+
+    def _get_description(self) -> Optional[str]:
         if self._description:
             return self._description
 
@@ -606,6 +815,9 @@ class SakCmdWrapper:
 
     @property
     def cmd(self) -> Optional[SakCmd]:
+        return self._memo("cmd", self._get_cmd)
+
+    def _get_cmd(self) -> Optional[SakCmd]:
         if self._cmd:
             return self._cmd
 
@@ -631,6 +843,148 @@ class SakCmdWrapper:
         return None
 
 
+def _get_object_wrappers(content: Any) -> Optional[_SakWrappers]:
+    # The methods share the __dict__ of their function, and the classes the one
+    # of their parents.
+    if isinstance(content, (type, MethodType)):
+        return None
+    attrs = getattr(content, "__dict__", None)
+    if not isinstance(attrs, dict):
+        return None
+    wrappers = attrs.get(_WRAPPERS_ATTR, None)
+    if isinstance(wrappers, _SakWrappers):
+        return wrappers
+    ret = attrs[_WRAPPERS_ATTR] = _SakWrappers()
+    return ret
+
+
+def wrap_cmd(content: Any, name: Optional[str] = None) -> SakCmdWrapper:
+    """Get the wrapper of an object, the same object gets the same wrapper.
+
+    The wrappers are stored in their objects when possible, so they live as
+    long as them, or else only while they are used.
+
+    :param content: The object to wrap.
+    :param name: The command name, if it is not inferred from the object.
+    :returns: The wrapper.
+    """
+    if isinstance(content, SakCmdWrapper) and (name is None):
+        return content
+
+    wrappers = _get_object_wrappers(content)
+    wrapper: Optional[SakCmdWrapper] = None
+    if wrappers is not None:
+        entry = wrappers.get(name, None)
+        if (entry is not None) and (entry[0] == _CMD_CACHE_GENERATION):
+            wrapper = entry[1]
+    else:
+        wrapper = _WRAPPERS.get((id(content), name), None)
+    if (wrapper is not None) and (wrapper._wrap_source is content):
+        return wrapper
+
+    wrapper = SakCmdWrapper(wrapped_content=content, name=name)
+    if wrappers is not None:
+        wrappers[name] = (_CMD_CACHE_GENERATION, wrapper)
+    else:
+        _WRAPPERS[(id(content), name)] = wrapper
+    return wrapper
+
+
+def clear_cmd_cache(path: Optional[Path] = None) -> None:
+    """Forget the wrappers and their computed properties.
+
+    :param path: The reloaded file, if called as a reload callback.
+    """
+    global _CMD_CACHE_GENERATION
+    _CMD_CACHE_GENERATION += 1
+    _WRAPPERS.clear()
+
+
+register_reload_callback(clear_cmd_cache)
+
+
+def _get_subcmds_hook(d: Any) -> Optional[Callable[[str], Any]]:
+    if (d is None) or isinstance(d, type):
+        return None
+    hook = getattr(d, "__sak_subcmds__", None)
+    return hook if callable(hook) else None
+
+
+def _wrap_hook_subcmds(subcmds: Any) -> List[SakCmdWrapper]:
+    if isinstance(subcmds, Mapping):
+        subcmds = subcmds.items()
+    return [wrap_cmd(v, name=str(k)) for k, v in subcmds]
+
+
+def _has_dir_subcmds(d: Any) -> bool:
+    # The objects whose subcommands are their attributes, see get_dir_subcmds.
+    if (not d) or isinstance(d, (dict, Iterable)):
+        return False
+    return not (isinstance(d, ModuleType) and hasattr(d, "EXPOSE"))
+
+
+def _is_sak_decorated(d: Any, k: str) -> bool:
+    # Without getattr, so the properties are not evaluated.
+    attr = inspect.getattr_static(d, k, None)
+    attr = getattr(attr, "__func__", attr)
+    return hasattr(attr, "_sak_dec_chain")
+
+
+def get_dir_subcmds(d: Any, prefix: str = "") -> List[Tuple[str, SakCmdWrapper]]:
+    """Get the subcommands of an object from its public attributes.
+
+    :param d: The object to inspect.
+    :param prefix: Only get the attributes whose name starts with prefix.
+    :returns: List of attribute name and subcommand wrapper.
+    """
+    subcmds = []
+    for k in dir(d):
+        if k.startswith("_sak_unamed_expose_"):
+            dd = getattr(d, k)
+            subcmd = wrap_cmd(dd)
+            if (subcmd.name is not None) and subcmd.name.startswith(prefix):
+                subcmds.append((k, subcmd))
+            continue
+
+        if k.startswith("_"):
+            continue
+
+        # The decorated attributes can have another command name, like the
+        # "version" command of a show_version method.
+        is_decorated = _is_sak_decorated(d, k)
+        if not (k.startswith(prefix) or is_decorated):
+            continue
+
+        if isinstance(d, SakPlugin):
+            lazy_cmd = d._get_declared_cmd(k)
+            if lazy_cmd is not None:
+                subcmds.append((k, lazy_cmd))
+                continue
+
+        try:
+            dd = getattr(d, k)
+
+            subcmd = wrap_cmd(dd, name=k)
+            if is_decorated and not (subcmd.name or "").startswith(prefix):
+                continue
+            subcmds.append((k, subcmd))
+            continue
+        except Exception as e:
+            # TODO(witt): Just does not add because of failure.
+            verbose = False
+            if verbose:
+                print("skip", k, str(e))
+                import sys
+                import traceback
+
+                print("Exception in user code:")
+                print("-" * 60)
+                traceback.print_exc(file=sys.stdout)
+                print("-" * 60)
+            continue
+    return subcmds
+
+
 def argcomplete_args() -> List[str]:
     args: List[str] = []
     # Check if its auto completion
@@ -643,13 +997,28 @@ def argcomplete_args() -> List[str]:
         _, _, _, comp_words, _ = argcomplete.split_line(comp_line, comp_point)
         if not args:
             args = comp_words[1:]
+            # Complete the command after the global output options.
+            try:
+                args = parse_output_args(args)[2]
+            except ValueError:
+                pass
     return args
 
 
-def sak_arg_parser(root: Any, args: Optional[List[str]] = None) -> Dict[str, Any]:
+def sak_arg_parser(
+    root: Any, args: Optional[List[str]] = None, run_async: bool = True
+) -> Dict[str, Any]:
+    """Parse the arguments and execute the selected command.
+
+    :param root: The root command.
+    :param args: The command line arguments, from argcomplete or sys.argv.
+    :param run_async: Run the async commands to completion in an event loop,
+        otherwise their coroutine or async iterator is returned as the value.
+    :returns: The parse result, with the command "value".
+    """
     args = args or argcomplete_args()
 
-    base_cmd = SakCmdWrapper(wrapped_content=root)
+    base_cmd = wrap_cmd(root)
 
     # Remove the help flag from args and set show_help
     args = args or []
@@ -673,30 +1042,47 @@ def sak_arg_parser(root: Any, args: Optional[List[str]] = None) -> Dict[str, Any
 
     ret: Dict[str, Any] = {"argparse": {}, "ret": None}
 
+    # The argcomplete needs the parsers of all the levels, linked to the root.
+    fast_descend = ("_ARGCOMPLETE" not in os.environ) and ("--" not in args)
+
     while True:
         if not isinstance(cmd, SakCmdWrapper):
-            cmd = SakCmdWrapper(cmd)
+            cmd = wrap_cmd(cmd)
 
         for arg in cmd.args:
             arg.addToArgParser(parser)
 
-        # Register only the next level of the subcommands
-        subparsers = None
-        for subcmd in cmd.subcmds:
-            if subcmd is None:
+        # Lazy commands are only resolved when selected, so refresh what was
+        # registered in the parent level.
+        if cmd is not base_cmd:
+            nm.sak_callback = cmd.callback
+            parser.description = cmd.description or cmd.helpmsg
+
+        # Go straight down while the next argument is the name of a subcommand
+        # of a level without arguments, the parser of that level is not needed.
+        if fast_descend and args and not cmd.args:
+            next_cmd = cmd.get_subcmd(args[0])
+            if next_cmd is not None:
+                parser = ArgumentParser(
+                    prog=f"{parser.prog} {args[0]}",
+                    description=next_cmd.description or next_cmd.helpmsg,
+                    formatter_class=RawTextHelpFormatter,
+                )
+                cmd = next_cmd
+                args = args[1:]
+                nm = Namespace(
+                    sak_callback=cmd.callback, sak_cmd=cmd, sak_parser=parser
+                )
                 continue
 
-            # TODO(witt): I can activate something like this is the tree is too big...
-            if args:
-                # TODO(witt): Does it make sense at all to have a command with null name?
-                if subcmd.name is not None:
-                    if not subcmd.name.startswith(args[0]):
-                        continue
-
+        # Register only the next level of the subcommands, that match the next
+        # argument, or the prefix being completed.
+        subparsers = None
+        for subcmd in cmd.get_subcmds(args[0] if args else ""):
             subcmdname = subcmd.name
 
             if not isinstance(subcmd, SakCmdWrapper):
-                subcmd = SakCmdWrapper(subcmd)
+                subcmd = wrap_cmd(subcmd)
 
             if not subcmdname:
                 # TODO(witt): It makes no sense to have a subcmd without name....
@@ -727,7 +1113,7 @@ def sak_arg_parser(root: Any, args: Optional[List[str]] = None) -> Dict[str, Any
                 nm, rargs = parser.parse_known_args(args, namespace=nm)
 
             # Go a level down in the tree
-            if (nm.sak_parser != parser) and (len(cmd.subcmds) > 0):
+            if (nm.sak_parser != parser) and (subparsers is not None):
                 args = rargs
                 parser = nm.sak_parser
                 cmd = nm.sak_cmd
@@ -754,6 +1140,7 @@ def sak_arg_parser(root: Any, args: Optional[List[str]] = None) -> Dict[str, Any
 
         ret["cmd"] = cmd
         ret["nm"] = nm
+        ret["prog"] = parser.prog
 
         # We reached the leaf in the tree, but only want to get the help
         if nm.sak_callback is None:
@@ -792,7 +1179,10 @@ def sak_arg_parser(root: Any, args: Optional[List[str]] = None) -> Dict[str, Any
         if callback:
             # import pdb; pdb.set_trace()
             try:
-                ret["value"] = callback(**nm_dict)
+                with timing("callback", str(cmd.name)):
+                    ret["value"] = callback(**nm_dict)
+                    if run_async:
+                        ret["value"] = resolve_async(ret["value"])
             except Exception as e:
                 # TODO(witt): Implement some verbose option that allows to view the whole stack call
                 verbose = os.environ.get("SAK_VERBOSE", False)
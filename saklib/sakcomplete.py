@@ -0,0 +1,298 @@
+# -*- coding: UTF-8 -*-
+
+__author__ = "Fernando Witt"
+__credits__ = ["Fernando Witt"]
+
+__license__ = "MIT"
+__maintainer__ = "Fernando Witt"
+__email__ = "ferawitt@gmail.com"
+
+import os
+import sys
+import time
+import traceback
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from saklib.sakcmd import SakCmdWrapper
+from saklib.sakmanifest import (
+    MANIFEST_MAX_DEPTH,
+    MANIFEST_MAX_NODES,
+    SakLazyCmd,
+    arg_to_manifest,
+)
+
+COMPLETE_INDEX_VERSION = 3
+
+# Separator of the command path words and of the values, it is not typed in
+# the command lines, so the values can have spaces.
+INDEX_SEP = "\x1f"
+
+# The characters that can not be in the index words, the ones that have them
+# are completed by python.
+INDEX_RESERVED = ["\t", "\n", "\r", INDEX_SEP]
+
+# Index entry kinds.
+INDEX_CMDS = "C"  # The subcommands of a command.
+INDEX_OPTS = "O"  # The options of a command.
+INDEX_CHOICES = "V"  # The static choices of an option.
+INDEX_VALUE = "A"  # Option that takes a value without static choices.
+INDEX_DYNAMIC = "D"  # Option with a completer callback, handled by python.
+INDEX_FALLBACK = "F"  # Unknown command subtree, handled by python.
+INDEX_WATCH = "W"  # Directory with python files that invalidate the index.
+INDEX_WATCH_FILE = "P"  # Python file, in any folder, that invalidates the index.
+
+NO_VALUE_ACTIONS = ["store_true", "store_false", "store_const", "count", "help"]
+
+
+def _is_indexable(word: str) -> bool:
+    return not any(x in word for x in INDEX_RESERVED)
+
+
+def _get_args(cmd: SakCmdWrapper) -> Optional[List[Dict[str, Any]]]:
+    if isinstance(cmd, SakLazyCmd):
+        return cmd.get_manifest_args()
+    return [arg_to_manifest(x) for x in cmd.args]
+
+
+class _IndexBuilder:
+    def __init__(self) -> None:
+        self.lines: List[str] = []
+        self.nodes_left = MANIFEST_MAX_NODES
+
+    def add(self, kind: str, path: List[str], values: List[str]) -> None:
+        line = "\t".join([kind, INDEX_SEP.join(path), INDEX_SEP.join(values)])
+        self.lines.append(line)
+
+    def walk(self, cmd: SakCmdWrapper, path: List[str], depth: int) -> None:
+        self.nodes_left -= 1
+        if (
+            (depth > MANIFEST_MAX_DEPTH)
+            or (self.nodes_left <= 0)
+            or cmd.has_lazy_subcmds
+        ):
+            self.add(INDEX_FALLBACK, path, [])
+            return
+
+        try:
+            args = _get_args(cmd)
+            subcmds = [x for x in cmd.subcmds if x.name]
+        except Exception as e:
+            if os.environ.get("SAK_VERBOSE", False):
+                print("-" * 60)
+                traceback.print_exc(file=sys.stdout)
+                print("-" * 60)
+                print(str(e))
+            self.add(INDEX_FALLBACK, path, [])
+            return
+
+        if args is None:
+            self.add(INDEX_FALLBACK, path, [])
+            return
+
+        opts = ["-h", "--help"]
+        for arg in args:
+            arg_opts = ["--%s" % arg["name"]]
+            if arg["short_name"]:
+                arg_opts.append("-%s" % arg["short_name"])
+            opts += arg_opts
+
+            for arg_opt in arg_opts:
+                if arg["completer"]:
+                    self.add(INDEX_DYNAMIC, path + [arg_opt], [])
+                elif arg["choices"]:
+                    choices = [str(x) for x in arg["choices"]]
+                    if all(_is_indexable(x) for x in choices):
+                        self.add(INDEX_CHOICES, path + [arg_opt], choices)
+                    else:
+                        self.add(INDEX_DYNAMIC, path + [arg_opt], [])
+                elif arg["action"] not in NO_VALUE_ACTIONS:
+                    self.add(INDEX_VALUE, path + [arg_opt], [])
+        self.add(INDEX_OPTS, path, opts)
+
+        names = [str(x.name) for x in subcmds]
+        if not all(_is_indexable(x) for x in names):
+            self.add(INDEX_FALLBACK, path, [])
+            return
+        if names:
+            self.add(INDEX_CMDS, path, names)
+
+        for subcmd in subcmds:
+            self.walk(subcmd, path + [str(subcmd.name)], depth + 1)
+
+
+def build_complete_index(
+    root: Any,
+    watch_paths: Optional[List[Path]] = None,
+    watch_files: Optional[List[Path]] = None,
+) -> str:
+    """Build the static completion index for a command tree.
+
+    The index has one tab separated entry per line, with the entry kind, the
+    command path (starting with the root command name) and the values. The
+    path words and the values are separated by INDEX_SEP.
+
+    :param root: The root command.
+    :param watch_paths: Directories whose python files invalidate the index.
+    :param watch_files: Files that invalidate the index, like the plugin
+        files loaded from subfolders.
+    :returns: The index content.
+    """
+    cmd = root if isinstance(root, SakCmdWrapper) else SakCmdWrapper(root)
+
+    builder = _IndexBuilder()
+    builder.lines.append(
+        f"# sak-complete-index {COMPLETE_INDEX_VERSION} {time.time_ns()}"
+    )
+    for watch_path in watch_paths or []:
+        builder.add(INDEX_WATCH, [str(watch_path)], [])
+    for watch_file in watch_files or []:
+        builder.add(INDEX_WATCH_FILE, [str(watch_file)], [])
+    builder.walk(cmd, [str(cmd.name)], 0)
+
+    return "\n".join(builder.lines) + "\n"
+
+
+def write_complete_index(
+    root: Any,
+    index_path: Path,
+    watch_paths: Optional[List[Path]] = None,
+    watch_files: Optional[List[Path]] = None,
+) -> None:
+    content = build_complete_index(
+        root, watch_paths=watch_paths, watch_files=watch_files
+    )
+
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_index_path = index_path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_index_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_index_path, index_path)
+
+
+BASH_COMPLETE_SCRIPT = r"""
+_sak_complete_python() {
+    _python_argcomplete "$@"
+}
+
+_sak_complete_words() {
+    # The index values are separated by \x1f, and can have spaces.
+    local -a words
+    local word
+    IFS=$'\x1f' read -r -a words <<< "$1"
+    COMPREPLY=()
+    for word in "${words[@]}"; do
+        [[ "$word" == "$2"* ]] && COMPREPLY+=("$(printf '%q' "$word")")
+    done
+}
+
+_sak_complete_load() {
+    local index="$1" header kind key value
+    [[ -f "$index" ]] || return 1
+
+    IFS= read -r header < "$index" || return 1
+    if [[ "$header" != "$_SAK_INDEX_HEADER" ]]; then
+        unset _SAK_INDEX _SAK_INDEX_WATCH _SAK_INDEX_WATCH_FILES
+        declare -gA _SAK_INDEX=()
+        declare -ga _SAK_INDEX_WATCH=() _SAK_INDEX_WATCH_FILES=()
+        while IFS=$'\t' read -r kind key value; do
+            if [[ "$kind" == "W" ]]; then
+                _SAK_INDEX_WATCH+=("$key")
+            elif [[ "$kind" == "P" ]]; then
+                _SAK_INDEX_WATCH_FILES+=("$key")
+            else
+                _SAK_INDEX["$kind|$key"]="$value"
+            fi
+        done < "$index"
+        _SAK_INDEX_HEADER="$header"
+    fi
+
+    local dir f
+    for dir in "${_SAK_INDEX_WATCH[@]}"; do
+        [[ "$dir" -nt "$index" ]] && return 2
+        for f in "$dir"/*.py; do
+            [[ "$f" -nt "$index" ]] && return 2
+        done
+    done
+    for f in "${_SAK_INDEX_WATCH_FILES[@]}"; do
+        [[ -f "$f" && ! "$f" -nt "$index" ]] || return 2
+    done
+    return 0
+}
+
+_sak_complete() {
+    local index="__SAK_INDEX__" global="__SAK_GLOBAL__"
+
+    # Local SAK folders change the command tree, let python handle it.
+    local d="$PWD"
+    while [[ -n "$d" && "$d" != "/" ]]; do
+        if [[ -d "$d/.sak" ]]; then
+            [[ "$d/.sak" -ef "$global" ]] || { _sak_complete_python "$@"; return; }
+            break
+        fi
+        d="${d%/*}"
+    done
+
+    _sak_complete_load "$index"
+    case $? in
+        0) ;;
+        *)
+            ( "$1" show argcomp_index < /dev/null > /dev/null 2>&1 & )
+            _sak_complete_python "$@"
+            return
+            ;;
+    esac
+
+    local cur="${COMP_WORDS[COMP_CWORD]}" prev="" path="sak" word i sep=$'\x1f'
+    ((COMP_CWORD > 1)) && prev="${COMP_WORDS[COMP_CWORD-1]}"
+
+    for ((i = 1; i < COMP_CWORD; i++)); do
+        if [[ -n "${_SAK_INDEX["F|$path"]+x}" ]]; then
+            _sak_complete_python "$@"
+            return
+        fi
+        word="${COMP_WORDS[i]}"
+        if [[ "$sep${_SAK_INDEX["C|$path"]}$sep" == *"$sep$word$sep"* ]]; then
+            path="$path$sep$word"
+        fi
+    done
+
+    if [[ -n "${_SAK_INDEX["F|$path"]+x}" ]]; then
+        _sak_complete_python "$@"
+        return
+    fi
+
+    if [[ "$prev" == -* ]]; then
+        local key="$path$sep$prev"
+        if [[ -n "${_SAK_INDEX["D|$key"]+x}" ]]; then
+            _sak_complete_python "$@"
+            return
+        elif [[ -n "${_SAK_INDEX["V|$key"]+x}" ]]; then
+            _sak_complete_words "${_SAK_INDEX["V|$key"]}" "$cur"
+            return
+        elif [[ -n "${_SAK_INDEX["A|$key"]+x}" ]]; then
+            COMPREPLY=()
+            return
+        fi
+    fi
+
+    if [[ "$cur" == -* ]]; then
+        _sak_complete_words "${_SAK_INDEX["O|$path"]}" "$cur"
+    else
+        _sak_complete_words "${_SAK_INDEX["C|$path"]}" "$cur"
+    fi
+}
+complete -o default -o bashdefault -F _sak_complete sak
+"""
+
+
+def get_bash_complete_script(index_path: Path, sak_global: Path) -> str:
+    """Get the bash function that completes from the static index.
+
+    :param index_path: The completion index path.
+    :param sak_global: The SAK global path.
+    :returns: The bash script.
+    """
+    return BASH_COMPLETE_SCRIPT.replace("__SAK_INDEX__", str(index_path)).replace(
+        "__SAK_GLOBAL__", str(sak_global)
+    )
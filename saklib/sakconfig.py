@@ -34,6 +34,9 @@ else:
 
 SAK_LOCAL = find_in_parent(CURRENT_DIR, Path(".sak"))
 
+# Files generated by SAK, like the command manifest, go to the cache folder.
+SAK_CACHE = (SAK_GLOBAL / "cache") if SAK_GLOBAL is not None else None
+
 
 def install_core_requirements(ask_confirm: bool = True) -> None:
     if SAK_GLOBAL is None:
@@ -0,0 +1,395 @@
+# -*- coding: UTF-8 -*-
+
+__author__ = "Fernando Witt"
+__credits__ = ["Fernando Witt"]
+
+__license__ = "MIT"
+__maintainer__ = "Fernando Witt"
+__email__ = "ferawitt@gmail.com"
+
+import _thread
+import os
+import queue
+import signal
+import socket
+import struct
+import sys
+import threading
+import traceback
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from saklib import saktiming
+from saklib.sakclient import get_daemon_socket_path, recv_msg, send_msg
+from saklib.sakconfig import find_in_parent
+
+DAEMON_PID_NAME = "daemon.pid"
+DAEMON_LOG_NAME = "daemon.log"
+
+# Period, in seconds, to check if the daemon has to stop.
+DAEMON_POLL_PERIOD = 0.5
+
+
+def get_daemon_pid_path(socket_path: Path) -> Path:
+    return socket_path.parent / DAEMON_PID_NAME
+
+
+def get_daemon_log_path(socket_path: Path) -> Path:
+    return socket_path.parent / DAEMON_LOG_NAME
+
+
+def files_snapshot(watch_paths: List[Path]) -> Dict[str, int]:
+    """Get the state of the python files and folders in the watched paths.
+
+    :param watch_paths: The directories to watch.
+    :returns: The modification time of each python file, folders map to zero.
+    """
+    ret: Dict[str, int] = {}
+    for watch_path in watch_paths:
+        if not watch_path.is_dir():
+            continue
+        for path in watch_path.iterdir():
+            try:
+                if path.is_dir():
+                    if not path.name.startswith(("_", ".")):
+                        ret[str(path)] = 0
+                elif path.suffix == ".py":
+                    ret[str(path)] = path.stat().st_mtime_ns
+            except FileNotFoundError:
+                pass
+    return ret
+
+
+class _SakRequestContext:
+    """Swap the process cwd, environment, argv and standard streams."""
+
+    def __init__(
+        self, cwd: str, env: Dict[str, str], argv: List[str], fds: List[int]
+    ) -> None:
+        self.cwd = cwd
+        self.env = env
+        self.argv = argv
+        self.fds = fds
+
+    def __enter__(self) -> None:
+        self.old_cwd = os.getcwd()
+        self.old_env = dict(os.environ)
+        self.old_argv = sys.argv
+        self.old_streams = (sys.stdin, sys.stdout, sys.stderr)
+
+        for stream in self.old_streams[1:]:
+            stream.flush()
+
+        self.old_fds = [os.dup(fd) for fd in range(3)]
+        for fd, new_fd in enumerate(self.fds[:3]):
+            os.dup2(new_fd, fd)
+
+        sys.stdin = open(0, "r", closefd=False)
+        sys.stdout = open(1, "w", buffering=(1 if os.isatty(1) else -1), closefd=False)
+        sys.stderr = open(2, "w", buffering=1, closefd=False)
+
+        os.chdir(self.cwd)
+        os.environ.clear()
+        os.environ.update(self.env)
+        sys.argv = self.argv
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        for stream in [sys.stdout, sys.stderr]:
+            try:
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+        sys.stdin, sys.stdout, sys.stderr = self.old_streams
+
+        for fd, old_fd in enumerate(self.old_fds):
+            os.dup2(old_fd, fd)
+            os.close(old_fd)
+
+        sys.argv = self.old_argv
+        os.environ.clear()
+        os.environ.update(self.old_env)
+        os.chdir(self.old_cwd)
+
+
+class SakDaemon:
+    """Resident SAK server that executes the commands sent by the sak client.
+
+    The commands are executed one at a time, in the daemon main thread, so the
+    loaded plugins, the storage engines and the git-annex batch processes are
+    reused between the calls. The commands sent while another one runs are
+    sent back to the client, to run without the daemon.
+    """
+
+    def __init__(
+        self,
+        socket_path: Path,
+        run_callback: Callable[[], None],
+        watch_paths: Optional[List[Path]] = None,
+        sak_global: Optional[Path] = None,
+        sak_local: Optional[Path] = None,
+    ) -> None:
+        self.socket_path = socket_path
+        self.run_callback = run_callback
+        self.watch_paths = watch_paths or []
+        self.sak_global = sak_global.resolve() if sak_global is not None else None
+        self.sak_local = self._get_effective_local(sak_local)
+
+        self.snapshot = files_snapshot(self.watch_paths)
+        self.should_stop = False
+        self.should_restart = False
+
+        self._running = False
+        self._running_lock = threading.Lock()
+
+        # The connections accepted for the main thread, at most one at a time.
+        self._conns: "queue.Queue[socket.socket]" = queue.Queue()
+        self._busy = False
+        self._busy_lock = threading.Lock()
+
+    def is_stale(self) -> bool:
+        return files_snapshot(self.watch_paths) != self.snapshot
+
+    def _get_effective_local(self, sak_local: Optional[Path]) -> Optional[Path]:
+        # SAK only loads the local plugins when they are not the global ones.
+        if sak_local is None:
+            return None
+        sak_local = sak_local.resolve()
+        if sak_local == self.sak_global:
+            return None
+        return sak_local
+
+    def _is_same_local(self, cwd: str) -> bool:
+        sak_local = find_in_parent(Path(cwd).resolve(), Path(".sak"))
+        return self._get_effective_local(sak_local) == self.sak_local
+
+    def _is_same_user(self, conn: socket.socket) -> bool:
+        if not hasattr(socket, "SO_PEERCRED"):
+            return True
+        creds = conn.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+        )
+        _, uid, _ = struct.unpack("3i", creds)
+        return bool(uid == os.getuid())
+
+    def _watch_interrupt(self, conn: socket.socket) -> None:
+        # Any message or a closed connection while the command is running
+        # means that the client was interrupted.
+        try:
+            recv_msg(conn)
+        except OSError:
+            pass
+        with self._running_lock:
+            if self._running:
+                _thread.interrupt_main()
+
+    def _run(self, msg: Dict[str, Any], fds: List[int]) -> int:
+        exit_code = 0
+        with _SakRequestContext(msg["cwd"], msg["env"], ["sak"] + msg["argv"], fds):
+            try:
+                try:
+                    self.run_callback()
+                finally:
+                    with self._running_lock:
+                        self._running = False
+            except SystemExit as e:
+                if e.code is None:
+                    exit_code = 0
+                elif isinstance(e.code, int):
+                    exit_code = e.code
+                else:
+                    sys.stderr.write(f"{e.code}\n")
+                    exit_code = 1
+            except KeyboardInterrupt:
+                exit_code = 130
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+        return exit_code
+
+    def handle(self, conn: socket.socket) -> None:
+        msg, fds = recv_msg(conn)
+        try:
+            if msg is None:
+                return
+
+            if msg["type"] == "ping":
+                send_msg(conn, {"pid": os.getpid()})
+            elif msg["type"] == "stop":
+                self.should_stop = True
+                send_msg(conn, {"pid": os.getpid()})
+            elif msg["type"] == "run":
+                if (
+                    (len(fds) < 3)
+                    or ("_ARGCOMPLETE" in msg["env"])
+                    or ("SAK_PDB" in msg["env"])
+                    or ("SAK_PROFILE" in msg["env"])
+                    or (not self._is_same_local(msg["cwd"]))
+                ):
+                    send_msg(conn, {"fallback": True})
+                    return
+
+                if self.is_stale():
+                    # Let the client run the new code, and restart to load it.
+                    self.should_restart = True
+                    send_msg(conn, {"fallback": True})
+                    return
+
+                with self._running_lock:
+                    self._running = True
+                watcher = threading.Thread(
+                    target=self._watch_interrupt, args=(conn,), daemon=True
+                )
+                watcher.start()
+
+                try:
+                    exit_code = self._run(msg, fds)
+                except KeyboardInterrupt:
+                    exit_code = 130
+                send_msg(conn, {"exit_code": exit_code})
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def handle_busy(self, conn: socket.socket) -> None:
+        """Reply to a client while the main thread handles another one.
+
+        :param conn: The client connection.
+        """
+        msg, fds = recv_msg(conn)
+        for fd in fds:
+            os.close(fd)
+        if msg is None:
+            return
+
+        if msg["type"] == "ping":
+            send_msg(conn, {"pid": os.getpid(), "busy": True})
+        elif msg["type"] == "stop":
+            # Stop after the running command.
+            self.should_stop = True
+            send_msg(conn, {"pid": os.getpid()})
+        else:
+            send_msg(conn, {"fallback": True})
+
+    def _accept_loop(self, server: socket.socket) -> None:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                # The server was closed.
+                return
+
+            with self._busy_lock:
+                busy = self._busy
+                self._busy = True
+            if not busy:
+                self._conns.put(conn)
+                continue
+
+            with conn:
+                try:
+                    if self._is_same_user(conn):
+                        self.handle_busy(conn)
+                except OSError:
+                    traceback.print_exc()
+
+    def serve_forever(self) -> None:
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(str(self.socket_path))
+        finally:
+            os.umask(old_umask)
+        server.listen(16)
+
+        pid_path = get_daemon_pid_path(self.socket_path)
+        pid_path.write_text(str(os.getpid()))
+
+        def _sigterm(signum: int, frame: Any) -> None:
+            self.should_stop = True
+            raise SystemExit(0)
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, _sigterm)
+
+        # The connections are accepted in another thread, to reply to the
+        # clients while the main thread runs a command.
+        acceptor = threading.Thread(
+            target=self._accept_loop, args=(server,), daemon=True
+        )
+        acceptor.start()
+
+        try:
+            while not (self.should_stop or self.should_restart):
+                try:
+                    conn = self._conns.get(timeout=DAEMON_POLL_PERIOD)
+                except queue.Empty:
+                    continue
+                except KeyboardInterrupt:
+                    # Late interruption from a client that already finished.
+                    continue
+
+                with conn:
+                    try:
+                        if self._is_same_user(conn):
+                            self.handle(conn)
+                    except (OSError, KeyboardInterrupt):
+                        traceback.print_exc()
+                    finally:
+                        with self._busy_lock:
+                            self._busy = False
+        finally:
+            # Wake up the acceptor thread before closing the socket.
+            try:
+                server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            acceptor.join(timeout=DAEMON_POLL_PERIOD)
+            server.close()
+            while not self._conns.empty():
+                self._conns.get().close()
+            if self.socket_path.exists():
+                self.socket_path.unlink()
+            if pid_path.exists() and pid_path.read_text() == str(os.getpid()):
+                pid_path.unlink()
+
+        if self.should_restart:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.execv(sys.executable, [sys.executable, "-m", "saklib.sakdaemon"])
+
+
+def main() -> None:
+    from saklib import sak
+
+    socket_path = get_daemon_socket_path(str(sak.ctx.sak_global))
+    if socket_path is None:
+        raise Exception("Could not define Sak location.")
+
+    watch_paths = [Path(sak.__file__).resolve().parent]
+    for plugin in sak.plm.has_plugins:
+        if plugin._has_plugin_path is not None:
+            watch_paths.append(plugin._has_plugin_path.resolve())
+            watch_paths.append(plugin._has_plugin_path.resolve().parent)
+
+    def run() -> None:
+        # Time each request from its start.
+        saktiming.timings.reset()
+        sak.ctx.current_dir = Path(".").resolve()
+        sak.main()
+
+    daemon = SakDaemon(
+        Path(socket_path),
+        run,
+        watch_paths=list(dict.fromkeys(watch_paths)),
+        sak_global=sak.ctx.sak_global,
+        sak_local=sak.ctx.sak_local,
+    )
+    daemon.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
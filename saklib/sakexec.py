@@ -7,6 +7,7 @@ __license__ = "MIT"
 __maintainer__ = "Fernando Witt"
 __email__ = "ferawitt@gmail.com"
 
+import asyncio
 import subprocess
 import sys
 from typing import Any, Callable, List, Optional, Union
@@ -45,15 +46,65 @@ def run_cmd(
         p.communicate()
         if check:
             if p.returncode != 0:
-                cmd_str = ""
-                if isinstance(cmd, str):
-                    cmd_str = cmd
-                if isinstance(cmd, list):
-                    cmd_str = " ".join(cmd)
-
-                raise Exception('"%s" ret core: %d' % (cmd_str, p.returncode))
+                _raise_cmd_failed(cmd, p.returncode)
         return p.returncode
 
     if block:
         return process_result()
     return process_result
+
+
+def _raise_cmd_failed(cmd: Union[List[str], str], returncode: int) -> None:
+    cmd_str = ""
+    if isinstance(cmd, str):
+        cmd_str = cmd
+    if isinstance(cmd, list):
+        cmd_str = " ".join(cmd)
+
+    raise Exception('"%s" ret core: %d' % (cmd_str, returncode))
+
+
+async def run_cmd_async(
+    cmd: Union[List[str], str],
+    check: bool = False,
+    stdout: Optional[Any] = None,
+    stderr: Optional[Any] = None,
+    **kwargs: Any,
+) -> int:
+    """Async counterpart of run_cmd, to run many commands concurrently.
+
+    Usage:
+        await asyncio.gather(*[run_cmd_async(["make", x]) for x in targets])
+
+    :param cmd: The command, a string is executed by the shell.
+    :param check: Raise an exception if the command fails.
+    :param stdout: Where to write the command stdout, the sys.stdout by default.
+    :param stderr: Where to write the command stderr, the sys.stderr by default.
+    :param kwargs: Extra arguments of asyncio.create_subprocess_exec.
+    :returns: The command return code.
+    """
+    if isinstance(cmd, str):
+        p = await asyncio.create_subprocess_shell(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs
+        )
+    else:
+        p = await asyncio.create_subprocess_exec(
+            *cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs
+        )
+
+    async def _forward(reader: Optional[asyncio.StreamReader], output: Any) -> None:
+        if reader is None:
+            return
+        async for text in reader:
+            output.write(text.decode("utf-8"))
+            output.flush()
+
+    await asyncio.gather(
+        _forward(p.stdout, stdout if stdout is not None else sys.stdout),
+        _forward(p.stderr, stderr if stderr is not None else sys.stderr),
+    )
+    returncode = await p.wait()
+
+    if check and (returncode != 0):
+        _raise_cmd_failed(cmd, returncode)
+    return returncode
@@ -10,10 +10,33 @@ __email__ = "ferawitt@gmail.com"
 
 import sys
 import threading
+from contextvars import ContextVar
 from datetime import datetime
 from io import StringIO, TextIOWrapper  # for Python 3
 from typing import Dict, Optional
 
+# The key of the buffer of the output of the current thread, the coroutines of
+# the same thread can set their own, see set_buffer_key.
+_buffer_key: ContextVar[Optional[int]] = ContextVar("sak_buffer_key", default=None)
+
+
+def get_buffer_key() -> int:
+    key = _buffer_key.get()
+    return threading.get_ident() if key is None else key
+
+
+def set_buffer_key(key: Optional[int]) -> None:
+    """Give the current coroutine its own output buffer.
+
+    :param key: The buffer key, negative not to clash with the thread ids, or
+        None to use the buffer of the thread.
+    """
+    _buffer_key.set(key)
+
+
+class _SakTeeThreadState(threading.local):
+    at_line_start = True
+
 
 class SakThreadedTee(TextIOWrapper):
     def __init__(self, stream: TextIOWrapper, redirect_only: bool = False) -> None:
@@ -22,6 +45,7 @@ class SakThreadedTee(TextIOWrapper):
         self.redirect_only = redirect_only
 
         self._threaded_tee_lock = threading.Lock()
+        self._thread_state = _SakTeeThreadState()
 
     def write(self, message: str) -> int:
         is_main_thread = threading.current_thread() is threading.main_thread()
@@ -39,7 +63,7 @@ class SakThreadedTee(TextIOWrapper):
                 ret = len(tm)
 
             with self._threaded_tee_lock:
-                current_thread = threading.get_ident()
+                current_thread = get_buffer_key()
                 if current_thread not in self.thread_buffer:
                     self.thread_buffer[current_thread] = StringIO()
 
@@ -50,8 +74,13 @@ class SakThreadedTee(TextIOWrapper):
         if is_main_thread:
             ret += _write_new_msg(message)
         else:
-            for line in message.splitlines():
-                tm = timestamp + line + "\n"
+            # The timestamp is only added to the beginning of the lines, the
+            # print function writes the line content and end separately.
+            for line in message.splitlines(keepends=True):
+                tm = line
+                if self._thread_state.at_line_start:
+                    tm = timestamp + line
+                self._thread_state.at_line_start = line.endswith("\n")
                 ret += _write_new_msg(tm)
 
         return ret
@@ -68,6 +97,8 @@ class SakThreadedTee(TextIOWrapper):
         return None
 
     def unregister_thread_id(self, thread_id: int) -> None:
+        if thread_id == threading.get_ident():
+            self._thread_state.at_line_start = True
         with self._threaded_tee_lock:
             if thread_id in self.thread_buffer:
                 self.thread_buffer.pop(thread_id)
@@ -77,7 +108,7 @@ def _get_stream_buffer_for_thread(
     stream: TextIOWrapper, thread_id: Optional[int] = None
 ) -> Optional[StringIO]:
     if thread_id is None:
-        thread_id = threading.get_ident()
+        thread_id = get_buffer_key()
     if isinstance(stream, SakThreadedTee):
         return stream.get_thread_buffer(thread_id)
     return None
@@ -87,7 +118,7 @@ def _unregister_threaded_tee(
     stream: TextIOWrapper, thread_id: Optional[int] = None
 ) -> None:
     if thread_id is None:
-        thread_id = threading.get_ident()
+        thread_id = get_buffer_key()
 
     if isinstance(stream, SakThreadedTee):
         stream.unregister_thread_id(thread_id)
@@ -0,0 +1,513 @@
+# -*- coding: UTF-8 -*-
+
+__author__ = "Fernando Witt"
+__credits__ = ["Fernando Witt"]
+
+__license__ = "MIT"
+__maintainer__ = "Fernando Witt"
+__email__ = "ferawitt@gmail.com"
+
+import hashlib
+import json
+import os
+import sys
+import traceback
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from saklib.sakcmd import SakArg, SakCmdWrapper, get_dir_subcmds
+from saklib.sakplugin import SakPlugin
+
+# Bump this version every time the manifest content changes.
+MANIFEST_VERSION = 2
+
+MANIFEST_MAX_DEPTH = 8
+MANIFEST_MAX_NODES = 10000
+
+
+def _jsonable(value: Any) -> Any:
+    try:
+        json.dumps(value)
+        return value
+    except (TypeError, ValueError):
+        return None
+
+
+def _file_sha1(fpath: Path) -> str:
+    hasher = hashlib.sha1()
+    with open(fpath, "rb") as f:
+        hasher.update(f.read())
+    return hasher.hexdigest()
+
+
+def _plugin_files(plugin_path: Path) -> Dict[str, Path]:
+    return {x.name: x for x in sorted(plugin_path.glob("*.py")) if x.is_file()}
+
+
+def _fingerprint_files(files: Dict[str, Path]) -> Dict[str, Dict[str, Any]]:
+    ret = {}
+    for name, fpath in files.items():
+        st = fpath.stat()
+        ret[name] = {
+            "mtime": st.st_mtime_ns,
+            "size": st.st_size,
+            "sha1": _file_sha1(fpath),
+        }
+    return ret
+
+
+def plugin_loaded_files(plugin: SakPlugin) -> Dict[str, Path]:
+    """Get the python files of a plugin that are loaded, in any folder level.
+
+    They are the exposed files and the modules imported from the plugin path.
+
+    :param plugin: The plugin.
+    :returns: The files, by their path relative to the plugin path.
+    """
+    ret: Dict[str, Path] = {}
+    plugin_path = plugin._plugin_path
+    if plugin_path is None:
+        return ret
+    plugin_path = plugin_path.resolve()
+
+    fpaths = [plugin_path / x for x in plugin._get_expose_files().values()]
+    for module in list(sys.modules.values()):
+        module_file = getattr(module, "__file__", None)
+        if module_file and module_file.endswith(".py"):
+            fpaths.append(Path(module_file))
+
+    for fpath in fpaths:
+        try:
+            fpath = fpath.resolve()
+            name = fpath.relative_to(plugin_path).as_posix()
+        except (OSError, ValueError):
+            continue
+        if fpath.is_file():
+            ret[name] = fpath
+    return ret
+
+
+def plugin_fingerprint(plugin_path: Path) -> Dict[str, Dict[str, Any]]:
+    """Fingerprint the python files of a plugin.
+
+    :param plugin_path: The plugin path.
+    :returns: The stat and hash of each plugin python file.
+    """
+    return _fingerprint_files(_plugin_files(plugin_path))
+
+
+def is_fingerprint_valid(
+    plugin_path: Path, fingerprint: Dict[str, Dict[str, Any]]
+) -> bool:
+    """Check if a fingerprint still matches the plugin files.
+
+    The file is only hashed if the stat does not match, and the fingerprint is
+    updated in place when the content did not change.
+
+    :param plugin_path: The plugin path.
+    :param fingerprint: The fingerprint stored in the manifest.
+    :returns: True if no plugin file changed.
+    """
+    # The files in the plugin folder level are always part of the fingerprint.
+    files = _plugin_files(plugin_path)
+    if set(files.keys()) != {x for x in fingerprint.keys() if "/" not in x}:
+        return False
+
+    for name, info in fingerprint.items():
+        try:
+            st = (plugin_path / name).stat()
+        except OSError:
+            return False
+        if (st.st_mtime_ns == info["mtime"]) and (st.st_size == info["size"]):
+            continue
+        if _file_sha1(plugin_path / name) != info["sha1"]:
+            return False
+        info["mtime"] = st.st_mtime_ns
+        info["size"] = st.st_size
+    return True
+
+
+def arg_to_manifest(arg: SakArg) -> Dict[str, Any]:
+    vargs = arg.vargs
+    _type = vargs.get("type", None)
+    choices = vargs.get("choices", None)
+    return {
+        "name": arg.name,
+        "short_name": arg.short_name,
+        "helpmsg": arg.helpmsg,
+        "required": bool(vargs.get("required", False)),
+        "action": vargs.get("action", None),
+        "nargs": vargs.get("nargs", None),
+        "choices": _jsonable(list(choices)) if choices is not None else None,
+        "default": _jsonable(vargs.get("default", None)),
+        "type": getattr(_type, "__name__", None),
+        "completer": arg.completercb is not None,
+    }
+
+
+class _NodeBudget:
+    def __init__(self, max_nodes: int) -> None:
+        self.nodes_left = max_nodes
+
+
+def cmd_to_manifest(
+    cmd: SakCmdWrapper, depth: int = 0, budget: Optional[_NodeBudget] = None
+) -> Dict[str, Any]:
+    """Describe a command tree as a JSON serializable manifest node.
+
+    Nodes deeper than MANIFEST_MAX_DEPTH, or beyond the node budget, are stored
+    without the subcommands, and are resolved from the real object when needed.
+
+    :param cmd: The command to describe.
+    :param depth: The depth of the command in the tree.
+    :param budget: The amount of nodes that can still be described.
+    :returns: The manifest node.
+    """
+    if budget is None:
+        budget = _NodeBudget(MANIFEST_MAX_NODES)
+    budget.nodes_left -= 1
+
+    node: Dict[str, Any] = {
+        "name": cmd.name,
+        "helpmsg": cmd.helpmsg,
+        "description": cmd.description,
+        "callback": cmd.callback is not None,
+        "args": [arg_to_manifest(x) for x in cmd.args],
+    }
+
+    if cmd.has_lazy_subcmds:
+        # Enumerating them is what the __sak_subcmds__ hook avoids.
+        node["lazy_subcmds"] = True
+        return node
+
+    if (depth >= MANIFEST_MAX_DEPTH) or (budget.nodes_left <= 0):
+        return node
+
+    node["subcmds"] = [
+        cmd_to_manifest(x, depth + 1, budget) for x in cmd.subcmds if x.name
+    ]
+    return node
+
+
+def plugin_to_manifest(plugin: SakPlugin) -> Dict[str, Any]:
+    """Describe a plugin command tree, loading all its exposed files.
+
+    :param plugin: The plugin to describe.
+    :returns: The manifest node.
+    """
+    plugin._load_exposes(declared=False)
+
+    budget = _NodeBudget(MANIFEST_MAX_NODES)
+
+    wrapper = SakCmdWrapper(plugin)
+    node: Dict[str, Any] = {
+        "name": wrapper.name,
+        "helpmsg": wrapper.helpmsg,
+        "description": wrapper.description,
+        "callback": False,
+        "args": [],
+        "subcmds": [],
+    }
+    for key, subcmd in get_dir_subcmds(plugin):
+        if not subcmd.name:
+            continue
+        if isinstance(subcmd, SakLazyCmd) and (subcmd._resolved is None):
+            # Declared command, keep it lazy without args and subcommands.
+            node["subcmds"].append(dict(subcmd._node))
+            continue
+        subnode = cmd_to_manifest(subcmd, 1, budget)
+        subnode["key"] = key
+        subnode["expose"] = plugin._exposed_origin.get(key, None)
+        node["subcmds"].append(subnode)
+    return node
+
+
+class SakLazyCmd(SakCmdWrapper):
+    """Command described by a manifest node.
+
+    The real command is only resolved, and so its plugin file loaded, when
+    something that is not in the manifest is needed.
+    """
+
+    def __init__(
+        self,
+        node: Dict[str, Any],
+        resolver: Callable[[], SakCmdWrapper],
+        plugin: Optional[SakPlugin] = None,
+        subcmds_loader: Optional[Callable[[], Optional[List[Dict[str, Any]]]]] = None,
+    ) -> None:
+        self._node = node
+        self._resolver = resolver
+        self._plugin = plugin
+        self._subcmds_loader = subcmds_loader
+
+        self._resolved: Optional[SakCmdWrapper] = None
+        self._lazy_subcmds: Optional[List[SakCmdWrapper]] = None
+
+        super(SakLazyCmd, self).__init__(name=node["name"])
+
+    def resolve(self) -> SakCmdWrapper:
+        if self._resolved is None:
+            self._resolved = self._resolver()
+        return self._resolved
+
+    def _make_subcmd(self, idx: int, node: Dict[str, Any]) -> "SakLazyCmd":
+        plugin = self._plugin
+        if (plugin is not None) and (node.get("key", None) is not None):
+            return make_exposed_cmd(plugin, node)
+
+        def resolver() -> SakCmdWrapper:
+            subcmds = self.resolve().subcmds
+            if (idx < len(subcmds)) and (subcmds[idx].name == node["name"]):
+                return subcmds[idx]
+            for subcmd in subcmds:
+                if subcmd.name == node["name"]:
+                    return subcmd
+            raise Exception(f"Could not find the command {node['name']}")
+
+        return SakLazyCmd(node, resolver, plugin=plugin)
+
+    @property
+    def name(self) -> Optional[str]:
+        return self._node["name"]  # type: ignore
+
+    @property
+    def helpmsg(self) -> str:
+        return self._node.get("helpmsg", None) or ""
+
+    @property
+    def description(self) -> Optional[str]:
+        return self._node.get("description", None)
+
+    @property
+    def callback(self) -> Optional[Callable[[Any], Any]]:
+        if self._resolved is not None:
+            return self._resolved.callback
+        if not self._node.get("callback", True):
+            return None
+        return self._lazy_callback  # type: ignore
+
+    def _lazy_callback(self, **vargs: Any) -> Any:
+        callback: Any = self.resolve().callback
+        if callback is None:
+            raise Exception(f"The command {self.name} has no callback")
+        return callback(**vargs)
+
+    @property
+    def subcmds(self) -> List[SakCmdWrapper]:
+        if self._resolved is not None:
+            return self._resolved.subcmds
+
+        if self._lazy_subcmds is None:
+            nodes = self._node.get("subcmds", None)
+            if (nodes is None) and (self._subcmds_loader is not None):
+                nodes = self._subcmds_loader()
+                if nodes is not None:
+                    self._node["subcmds"] = nodes
+            if nodes is None:
+                return self.resolve().subcmds
+            self._lazy_subcmds = [
+                self._make_subcmd(idx, x) for idx, x in enumerate(nodes)
+            ]
+        return self._lazy_subcmds
+
+    @property
+    def has_lazy_subcmds(self) -> bool:
+        if self._resolved is not None:
+            return self._resolved.has_lazy_subcmds
+        return bool(self._node.get("lazy_subcmds", False))
+
+    def get_subcmds(self, prefix: str = "") -> List[SakCmdWrapper]:
+        if self.has_lazy_subcmds:
+            return self.resolve().get_subcmds(prefix)
+        return super().get_subcmds(prefix)
+
+    @property
+    def args(self) -> List[SakArg]:
+        if (self._resolved is None) and (self._node.get("args", None) == []):
+            return []
+        return self.resolve().args
+
+    def get_manifest_args(self) -> Optional[List[Dict[str, Any]]]:
+        """Get the arguments description without resolving the command.
+
+        :returns: The arguments manifest, or None if it is not known.
+        """
+        if self._resolved is not None:
+            return [arg_to_manifest(x) for x in self._resolved.args]
+        return self._node.get("args", None)
+
+    @property
+    def cmd(self) -> Any:
+        if self._resolved is not None:
+            return self._resolved.cmd
+        return None
+
+
+def make_exposed_cmd(plugin: SakPlugin, node: Dict[str, Any]) -> SakLazyCmd:
+    """Make a lazy command for an object exposed by a plugin.
+
+    :param plugin: The plugin.
+    :param node: The manifest node, with the exposed "key" and its "expose" name.
+    :returns: The lazy command, that only loads the plugin file that exposes
+        the key when resolved.
+    """
+    key = node["key"]
+
+    def resolver() -> SakCmdWrapper:
+        obj = plugin._get_exposed(key, node.get("expose", None))
+        if key.startswith("_sak_unamed_expose_"):
+            return SakCmdWrapper(wrapped_content=obj)
+        return SakCmdWrapper(wrapped_content=obj, name=key)
+
+    return SakLazyCmd(node, resolver, plugin=plugin)
+
+
+class SakManifest:
+    """On disk cache of the plugins command tree.
+
+    Each plugin has its own manifest file, keyed by the stat and hash of the
+    plugin python files, and of the ones it loads from its subfolders.
+    """
+
+    def __init__(self, path: Optional[Path]) -> None:
+        self.path = path
+        self.enabled = (path is not None) and (
+            os.environ.get("SAK_MANIFEST", "YES") == "YES"
+        )
+
+    def _get_plugin_manifest_path(self, plugin: SakPlugin) -> Path:
+        assert self.path is not None, "The manifest path is not defined"
+        plugin_path = str(plugin._plugin_path)
+        path_hash = hashlib.sha1(plugin_path.encode("utf-8")).hexdigest()[:12]
+        return self.path / f"{plugin._name}-{path_hash}.json"
+
+    def _read(self, fpath: Path) -> Optional[Dict[str, Any]]:
+        try:
+            with open(fpath) as f:
+                data: Dict[str, Any] = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("version", None) != MANIFEST_VERSION:
+            return None
+        return data
+
+    def _write(self, fpath: Path, data: Dict[str, Any]) -> None:
+        try:
+            fpath.parent.mkdir(parents=True, exist_ok=True)
+            tmp_fpath = fpath.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_fpath, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_fpath, fpath)
+        except OSError as e:
+            print(f"WARNING! Failed to write the manifest {fpath}.", str(e))
+
+    def is_cacheable(self, plugin: SakPlugin) -> bool:
+        if not self.enabled:
+            return False
+        if plugin._plugin_path is None:
+            return False
+        return bool(plugin._get_config().get("MANIFEST_CACHE", True))
+
+    def get_plugin_files(self, plugin: SakPlugin) -> List[Path]:
+        """Get the python files that describe the commands of a plugin.
+
+        They are the files fingerprinted in the plugin manifest, the ones in the
+        plugin folder level and the ones it loads from its subfolders.
+
+        :param plugin: The plugin.
+        :returns: The resolved file paths.
+        """
+        plugin_path = plugin._plugin_path
+        if plugin_path is None:
+            return []
+        plugin_path = plugin_path.resolve()
+
+        files = dict(_plugin_files(plugin_path))
+        if self.is_cacheable(plugin):
+            data = self._read(self._get_plugin_manifest_path(plugin))
+            if data is not None:
+                files.update({x: plugin_path / x for x in data["files"]})
+        files.update(plugin_loaded_files(plugin))
+        return [files[x] for x in sorted(files)]
+
+    def get_plugin_node(self, plugin: SakPlugin) -> Optional[Dict[str, Any]]:
+        """Get the manifest node of a plugin, rebuilding it if outdated.
+
+        :param plugin: The plugin.
+        :returns: The manifest node, or None if it could not be built.
+        """
+        plugin_path = plugin._plugin_path
+        if (plugin_path is None) or (not self.is_cacheable(plugin)):
+            return None
+
+        fpath = self._get_plugin_manifest_path(plugin)
+
+        data = self._read(fpath)
+        if data is not None:
+            fingerprint = data["files"]
+            orig_fingerprint = json.dumps(fingerprint, sort_keys=True)
+            if is_fingerprint_valid(plugin_path, fingerprint):
+                # The files were touched but not changed, store the new stat.
+                if json.dumps(fingerprint, sort_keys=True) != orig_fingerprint:
+                    self._write(fpath, data)
+                return data["node"]  # type: ignore
+
+        fingerprint = plugin_fingerprint(plugin_path)
+        try:
+            node = plugin_to_manifest(plugin)
+        except Exception as e:
+            if os.environ.get("SAK_VERBOSE", False):
+                print(f"WARNING! Failed to build the manifest for {plugin._name}.")
+                print("-" * 60)
+                traceback.print_exc(file=sys.stdout)
+                print("-" * 60)
+                print(str(e))
+            return None
+
+        # The files loaded while building the manifest also describe it. They
+        # are fingerprinted after loading, unlike the ones in the folder level.
+        loaded_files = {
+            k: v for k, v in plugin_loaded_files(plugin).items() if k not in fingerprint
+        }
+        fingerprint.update(_fingerprint_files(loaded_files))
+
+        data = {
+            "version": MANIFEST_VERSION,
+            "path": str(plugin_path),
+            "files": fingerprint,
+            "node": node,
+        }
+        self._write(fpath, data)
+        return node
+
+    def wrap_plugin(self, plugin: SakPlugin) -> Any:
+        """Wrap a plugin with a command lazily described by its manifest.
+
+        :param plugin: The plugin.
+        :returns: The lazy command, or the plugin itself if it is not cacheable.
+        """
+        if not self.is_cacheable(plugin):
+            return plugin
+
+        wrapper = SakCmdWrapper(plugin)
+        node: Dict[str, Any] = {
+            "name": wrapper.name,
+            "helpmsg": wrapper.helpmsg,
+            "description": wrapper.description,
+            "callback": False,
+            "args": [],
+        }
+
+        def subcmds_loader() -> Optional[List[Dict[str, Any]]]:
+            plugin_node = self.get_plugin_node(plugin)
+            if plugin_node is None:
+                return None
+            return plugin_node["subcmds"]  # type: ignore
+
+        return SakLazyCmd(
+            node,
+            lambda: SakCmdWrapper(plugin),
+            plugin=plugin,
+            subcmds_loader=subcmds_loader,
+        )
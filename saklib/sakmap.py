@@ -0,0 +1,297 @@
+# -*- coding: UTF-8 -*-
+
+__author__ = "Fernando Witt"
+__credits__ = ["Fernando Witt"]
+
+__license__ = "MIT"
+__maintainer__ = "Fernando Witt"
+__email__ = "ferawitt@gmail.com"
+
+import json
+import multiprocessing
+import shlex
+import sys
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import redirect_stderr, redirect_stdout
+from functools import partial
+from io import StringIO
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    TextIO,
+    Tuple,
+)
+
+from saklib.sakasync import resolve_async
+from saklib.sakcmd import SakCmdWrapper, wrap_cmd
+from saklib.sakio import (
+    get_stdout_buffer_for_thread,
+    register_threaded_stdout_tee,
+    unregister_stdout_thread_id,
+)
+from saklib.sakoutput import is_stream
+from saklib.saktable import SakTable
+
+# Number of jobs submitted to each thread ahead of the written results, so the
+# arguments are not all read and queued at once.
+MAP_THREAD_WINDOW = 4
+
+# The command executed by the forked workers, set before creating the pool.
+_MAP_CMD: Optional[Tuple[SakCmdWrapper, ArgumentParser]] = None
+
+
+def resolve_cmd(root: Any, path: List[str]) -> SakCmdWrapper:
+    """Find a command by its path from the root command.
+
+    :param root: The root command.
+    :param path: The subcommand names.
+    :returns: The command.
+    """
+    cmd = wrap_cmd(root)
+    for name in path:
+        subcmd = cmd.get_subcmd(name)
+        if subcmd is None:
+            raise Exception("Unknown command: %s" % " ".join(path))
+        cmd = subcmd
+    if cmd.callback is None:
+        raise Exception("The command %s has no callback" % " ".join(path))
+    return cmd
+
+
+def make_cmd_parser(cmd: SakCmdWrapper) -> ArgumentParser:
+    parser = ArgumentParser(prog=str(cmd.name), add_help=False)
+    for arg in cmd.args:
+        arg.addToArgParser(parser)
+    return parser
+
+
+def kwargs_to_argv(parser: ArgumentParser, kwargs: Dict[str, Any]) -> List[str]:
+    """Convert the command arguments to its command line.
+
+    :param parser: The command parser.
+    :param kwargs: The argument values by name.
+    :returns: The command line arguments.
+    """
+    actions = {x.dest: x for x in parser._actions}
+
+    argv = []
+    for name, value in kwargs.items():
+        action = actions.get(name, None)
+        if action is None:
+            raise ValueError(f"Unknown argument {name}")
+
+        option = action.option_strings[0]
+        if action.nargs == 0:
+            if value != action.default:
+                argv.append(option)
+        elif isinstance(value, list):
+            argv += [option] + [str(x) for x in value]
+        else:
+            argv.append(f"{option}={value}")
+    return argv
+
+
+def parse_map_line(parser: ArgumentParser, line: str) -> Optional[List[str]]:
+    """Get the command line of a job.
+
+    :param parser: The command parser.
+    :param line: A JSON object with the arguments, a JSON list with the command
+        line or a shell like command line.
+    :returns: The command line, or None for empty and comment lines.
+    """
+    line = line.strip()
+    if (not line) or line.startswith("#"):
+        return None
+    if line.startswith("{"):
+        return kwargs_to_argv(parser, json.loads(line))
+    if line.startswith("["):
+        return [str(x) for x in json.loads(line)]
+    return shlex.split(line)
+
+
+def run_job(cmd: SakCmdWrapper, parser: ArgumentParser, argv: List[str]) -> Any:
+    stderr = StringIO()
+    try:
+        with redirect_stderr(stderr):
+            nm = parser.parse_args(argv)
+    except SystemExit:
+        raise Exception(stderr.getvalue().strip())
+
+    callback: Any = cmd.callback
+    return resolve_async(callback(**vars(nm)))
+
+
+def _run_line(
+    cmd: SakCmdWrapper, parser: ArgumentParser, index: int, line: str
+) -> Dict[str, Any]:
+    result: Dict[str, Any] = {"index": index, "argv": None, "status": 0}
+    try:
+        result["argv"] = parse_map_line(parser, line)
+        value = run_job(cmd, parser, result["argv"])
+        if is_stream(value):
+            value = list(value)
+        elif isinstance(value, SakTable):
+            value = value.to_rows()
+        if value is not None:
+            # Make sure the value can be sent back from the worker process.
+            result["value"] = json.loads(json.dumps(value, default=str))
+    except Exception as e:
+        result["status"] = 1
+        result["error"] = str(e)
+    return result
+
+
+def _run_job_in_process(job: Tuple[int, str]) -> Dict[str, Any]:
+    assert _MAP_CMD is not None, "The map command is not set"
+    cmd, parser = _MAP_CMD
+
+    stdout = StringIO()
+    with redirect_stdout(stdout):
+        result = _run_line(cmd, parser, *job)
+    if stdout.getvalue():
+        result["stdout"] = stdout.getvalue()
+    return result
+
+
+def _run_job_in_thread(
+    cmd: SakCmdWrapper, parser: ArgumentParser, job: Tuple[int, str]
+) -> Dict[str, Any]:
+    result = _run_line(cmd, parser, *job)
+
+    stdout = get_stdout_buffer_for_thread()
+    unregister_stdout_thread_id()
+    if stdout is not None and stdout.getvalue():
+        result["stdout"] = stdout.getvalue()
+    return result
+
+
+def _get_jobs(lines: Iterable[str]) -> Iterator[Tuple[int, str]]:
+    for index, line in enumerate(lines):
+        if line.strip() and not line.strip().startswith("#"):
+            yield index, line
+
+
+def _map_in_window(
+    executor: ThreadPoolExecutor,
+    func: Callable[[Tuple[int, str]], Dict[str, Any]],
+    jobs: Iterator[Tuple[int, str]],
+    window: int,
+    unordered: bool,
+) -> Iterator[Dict[str, Any]]:
+    """Run the jobs in an executor, with at most window jobs submitted at once.
+
+    :param executor: The executor.
+    :param func: The function executed for each job.
+    :param jobs: The jobs.
+    :param window: The maximum number of jobs submitted and not yet returned.
+    :param unordered: Return the results as they finish, instead of in order.
+    :returns: The results.
+    """
+    ordered: Deque["Future[Dict[str, Any]]"] = deque()
+    pending: Set["Future[Dict[str, Any]]"] = set()
+
+    def _submit() -> None:
+        while len(pending) < window:
+            job = next(jobs, None)
+            if job is None:
+                return
+            future = executor.submit(func, job)
+            ordered.append(future)
+            pending.add(future)
+
+    try:
+        _submit()
+        while pending:
+            if unordered:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    yield future.result()
+            else:
+                future = ordered.popleft()
+                pending.remove(future)
+                yield future.result()
+            _submit()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def run_map(
+    root: Any,
+    path: List[str],
+    lines: Iterable[str],
+    output: TextIO,
+    jobs: int = 0,
+    threads: bool = False,
+    unordered: bool = False,
+) -> int:
+    """Execute a command once per set of arguments, in parallel.
+
+    The command is resolved once, and executed by a pool of forked processes,
+    which inherit the loaded plugins, or of threads. The result of each job is
+    written to the output as a JSON line, with the job "index" in the input.
+
+    :param root: The root command.
+    :param path: The path of the command to execute.
+    :param lines: The arguments of each job, see parse_map_line.
+    :param output: Where to write the results.
+    :param jobs: The number of parallel jobs, 0 for the number of CPUs.
+    :param threads: Use threads instead of processes.
+    :param unordered: Write the results as they finish, instead of in order.
+    :returns: The exit status, 0 if all the jobs succeeded.
+    """
+    global _MAP_CMD
+
+    cmd = resolve_cmd(root, path)
+    parser = make_cmd_parser(cmd)
+    jobs = jobs or multiprocessing.cpu_count()
+
+    exit_status = 0
+
+    def _write(results: Iterable[Dict[str, Any]]) -> None:
+        nonlocal exit_status
+        for result in results:
+            if result["status"] != 0:
+                exit_status = 1
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+
+    if threads:
+        old_stdout = sys.stdout
+        register_threaded_stdout_tee(redirect_only=True)
+        try:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                _write(
+                    _map_in_window(
+                        executor,
+                        partial(_run_job_in_thread, cmd, parser),
+                        _get_jobs(lines),
+                        jobs * MAP_THREAD_WINDOW,
+                        unordered,
+                    )
+                )
+        finally:
+            sys.stdout = old_stdout
+    else:
+        _MAP_CMD = (cmd, parser)
+        try:
+            context = multiprocessing.get_context("fork")
+            with context.Pool(processes=jobs) as pool:
+                if unordered:
+                    _write(pool.imap_unordered(_run_job_in_process, _get_jobs(lines)))
+                else:
+                    _write(pool.imap(_run_job_in_process, _get_jobs(lines)))
+        finally:
+            _MAP_CMD = None
+
+    return exit_status
@@ -0,0 +1,488 @@
+# -*- coding: UTF-8 -*-
+
+__author__ = "Fernando Witt"
+__credits__ = ["Fernando Witt"]
+
+__license__ = "MIT"
+__maintainer__ = "Fernando Witt"
+__email__ = "ferawitt@gmail.com"
+
+import asyncio
+import csv
+import io
+import itertools
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from collections.abc import AsyncIterator, Iterator
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, TextIO, Tuple
+
+from saklib.sakio import get_buffer_key, set_buffer_key
+from saklib.saktable import SakTable
+
+# Maximum time, in seconds, that streamed items wait to be flushed.
+STREAM_FLUSH_DELAY = 0.1
+
+# The formats of the --output global option.
+OUTPUT_FORMATS = ["table", "csv", "jsonl", "parquet"]
+
+# Number of rows converted and written at once.
+OUTPUT_CHUNK_SIZE = 10000
+
+
+def is_stream(value: Any) -> bool:
+    """Check if a command result should be rendered item by item.
+
+    :param value: The command result.
+    :returns: True for generators and other iterators.
+    """
+    return isinstance(value, Iterator) and not isinstance(
+        value, (str, bytes, io.IOBase)
+    )
+
+
+def close_stream(items: Any) -> None:
+    close = getattr(items, "close", None)
+    if close is not None:
+        close()
+
+
+# Maximum number of streamed items read ahead of the output.
+STREAM_READ_AHEAD = 10000
+
+# The item that marks the end of the stream, or a failure, in the queue.
+_STREAM_END = object()
+
+
+class _SakStreamReader:
+    """Read the items of a stream in a thread, so they can be waited with timeout.
+
+    The stream is closed by the reader thread if it is still reading when the
+    reader is stopped, a generator can not be closed while it runs.
+    """
+
+    def __init__(self, items: Iterable[Any]) -> None:
+        self.items = items
+        self.queue: "queue.Queue[Tuple[Any, Optional[BaseException]]]" = queue.Queue(
+            maxsize=STREAM_READ_AHEAD
+        )
+
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._done = False
+
+        # The prints of the stream go to the output buffer of the caller.
+        self._thread = threading.Thread(
+            target=self._read, args=(get_buffer_key(),), daemon=True
+        )
+        self._thread.start()
+
+    def _put(self, value: Tuple[Any, Optional[BaseException]]) -> bool:
+        while not self._stopped:
+            try:
+                self.queue.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read(self, buffer_key: int) -> None:
+        set_buffer_key(buffer_key)
+        try:
+            for item in self.items:
+                if not self._put((item, None)):
+                    break
+            else:
+                self._put((_STREAM_END, None))
+        except BaseException as e:
+            self._put((_STREAM_END, e))
+        finally:
+            with self._lock:
+                self._done = True
+                if self._stopped:
+                    close_stream(self.items)
+
+    def stop(self) -> None:
+        with self._lock:
+            self._stopped = True
+            if self._done:
+                close_stream(self.items)
+
+
+def iter_chunks(
+    items: Iterable[Any], max_delay: float = STREAM_FLUSH_DELAY
+) -> Iterator[List[Any]]:
+    """Group the items produced within max_delay seconds, the first one alone.
+
+    The items are read in a thread, so a chunk is flushed after max_delay even
+    if the stream blocks before producing the next item.
+
+    :param items: The items.
+    :param max_delay: The time, in seconds, to gather items in a chunk.
+    :returns: The chunks of items.
+    """
+    reader = _SakStreamReader(items)
+    chunk: List[Any] = []
+    last_chunk = 0.0
+    try:
+        while True:
+            timeout = None
+            if chunk:
+                timeout = max(last_chunk + max_delay - time.monotonic(), 0)
+            try:
+                item, error = reader.queue.get(timeout=timeout)
+            except queue.Empty:
+                yield chunk
+                chunk = []
+                last_chunk = time.monotonic()
+                continue
+
+            if item is _STREAM_END:
+                # Output what was produced before the end, or the failure.
+                if chunk:
+                    yield chunk
+                if error is not None:
+                    raise error
+                break
+
+            chunk.append(item)
+            now = time.monotonic()
+            if now - last_chunk >= max_delay:
+                yield chunk
+                chunk = []
+                last_chunk = now
+    finally:
+        reader.stop()
+
+
+async def aiter_chunks(
+    items: AsyncIterator[Any], max_delay: float = STREAM_FLUSH_DELAY
+) -> AsyncIterator[List[Any]]:
+    """Group the items of an async stream like iter_chunks.
+
+    :param items: The items.
+    :param max_delay: The time, in seconds, to gather items in a chunk.
+    :returns: The chunks of items.
+    """
+    chunk: List[Any] = []
+    last_chunk = 0.0
+    pending: "Optional[asyncio.Future[Any]]" = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(items.__anext__())
+
+            timeout = None
+            if chunk:
+                timeout = max(last_chunk + max_delay - time.monotonic(), 0)
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                yield chunk
+                chunk = []
+                last_chunk = time.monotonic()
+                continue
+
+            future, pending = pending, None
+            try:
+                item = future.result()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                if chunk:
+                    yield chunk
+                raise
+
+            chunk.append(item)
+            now = time.monotonic()
+            if now - last_chunk >= max_delay:
+                yield chunk
+                chunk = []
+                last_chunk = now
+        if chunk:
+            yield chunk
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+def write_stream(items: Iterable[Any], stream: Optional[TextIO] = None) -> int:
+    """Write the items, one per line, as they are produced.
+
+    :param items: The items.
+    :param stream: Where to write, the stdout by default.
+    :returns: The number of written items.
+    """
+    if stream is None:
+        stream = sys.stdout
+
+    count = 0
+    for chunk in iter_chunks(items):
+        stream.write("".join(f"{x}\n" for x in chunk))
+        stream.flush()
+        count += len(chunk)
+    return count
+
+
+def handle_broken_pipe() -> None:
+    """Stop writing to a stdout whose reader is gone, like in "sak ... | head"."""
+    # Python flushes the stdout at exit, which would fail again.
+    try:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        os.close(devnull)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        pass
+    sys.exit(1)
+
+
+def render_value(value: Any) -> None:
+    """Render a command result in the stdout.
+
+    :param value: The command result.
+    """
+    try:
+        if is_stream(value):
+            write_stream(value)
+        elif isinstance(value, SakTable):
+            write_value(value, "table")
+        elif hasattr(value, "show"):
+            value.show()
+        elif "bokeh" in str(type(value)):
+            from bokeh.plotting import show
+
+            show(value)
+        else:
+            print(value)
+            sys.stdout.flush()
+    except BrokenPipeError:
+        handle_broken_pipe()
+
+
+def parse_output_args(
+    args: List[str],
+) -> Tuple[Optional[str], Optional[str], List[str]]:
+    """Remove the --output and --output-file global options, before the command.
+
+    :param args: The SAK arguments, like "--output csv task show".
+    :returns: The output format, the output file and the remaining arguments.
+    """
+    output_format = None
+    output_file = None
+
+    args = list(args)
+    while args and args[0].startswith("--output"):
+        option, _, value = args[0].partition("=")
+        if option not in ["--output", "--output-file"]:
+            break
+        if not value:
+            if len(args) < 2:
+                raise ValueError(f"Missing the value of {option}")
+            value = args[1]
+            args = args[2:]
+        else:
+            args = args[1:]
+
+        if option == "--output":
+            if value not in OUTPUT_FORMATS:
+                raise ValueError(
+                    "Invalid output %s, choose from %s"
+                    % (value, ", ".join(OUTPUT_FORMATS))
+                )
+            output_format = value
+        else:
+            output_file = value
+
+    if (output_format is None) and (output_file is not None):
+        suffix = Path(output_file).suffix.lstrip(".")
+        output_format = suffix if suffix in OUTPUT_FORMATS else "table"
+    return output_format, output_file, args
+
+
+def is_dataframe(value: Any) -> bool:
+    # Checked without importing pandas, which is slow to import.
+    return type(value).__module__.startswith("pandas") and hasattr(value, "iloc")
+
+
+def _iter_frames(value: Any, chunk_size: int) -> Iterator[Any]:
+    import pandas as pd  # type: ignore
+
+    # Keep the meaningful indexes, like the ones from set_index, as columns.
+    if not isinstance(value.index, pd.RangeIndex):
+        value = value.reset_index()
+    for start in range(0, max(len(value), 1), chunk_size):
+        yield value.iloc[start : start + chunk_size]
+
+
+def iter_row_chunks(
+    value: Any, chunk_size: int = OUTPUT_CHUNK_SIZE
+) -> Iterator[List[Dict[str, Any]]]:
+    """Split a command result in chunks of rows.
+
+    :param value: A DataFrame, an iterable of dicts, or any other value.
+    :param chunk_size: The maximum number of rows per chunk.
+    :returns: The chunks of rows, as dicts.
+    """
+    if is_dataframe(value):
+        for frame in _iter_frames(value, chunk_size):
+            yield frame.to_dict(orient="records")
+        return
+    if isinstance(value, SakTable):
+        yield from value.iter_chunks(chunk_size)
+        return
+
+    if isinstance(value, dict) or isinstance(value, (str, bytes)):
+        items: Iterable[Any] = [value]
+    elif isinstance(value, Iterable):
+        items = value
+    else:
+        items = [value]
+
+    iterator = iter(items)
+    try:
+        while True:
+            chunk = [
+                x if isinstance(x, dict) else {"value": x}
+                for x in itertools.islice(iterator, chunk_size)
+            ]
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        close_stream(items)
+
+
+def _get_columns(rows: List[Dict[str, Any]]) -> List[str]:
+    return list(dict.fromkeys(k for row in rows for k in row.keys()))
+
+
+def _check_columns(columns: List[str], rows: List[Dict[str, Any]]) -> None:
+    new_columns = set(_get_columns(rows)) - set(columns)
+    if new_columns:
+        raise ValueError(
+            "New columns after the header was written: %s, use the jsonl output"
+            % ", ".join(sorted(new_columns))
+        )
+
+
+def _get_widths(rows: List[Dict[str, Any]], columns: List[str]) -> List[int]:
+    return [max([len(x)] + [len(str(row.get(x, ""))) for row in rows]) for x in columns]
+
+
+def _format_rows(
+    rows: Iterable[Dict[str, Any]], columns: List[str], widths: List[int]
+) -> str:
+    return "".join(
+        "  ".join(
+            str(row.get(x, "")).ljust(w) for x, w in zip(columns, widths)
+        ).rstrip()
+        + "\n"
+        for row in rows
+    )
+
+
+def format_table(rows: List[Dict[str, Any]], columns: List[str]) -> str:
+    """Format rows as an aligned text table.
+
+    :param rows: The rows, as dicts.
+    :param columns: The columns to show.
+    :returns: The table, with a header.
+    """
+    widths = _get_widths(rows, columns)
+    return _format_rows([{x: x for x in columns}] + rows, columns, widths)
+
+
+def _write_table(chunks: Iterable[List[Dict[str, Any]]], stream: TextIO) -> None:
+    columns: Optional[List[str]] = None
+    widths: List[int] = []
+    for rows in chunks:
+        if columns is None:
+            # The columns widths are taken from the first chunk.
+            columns = _get_columns(rows)
+            widths = _get_widths(rows, columns)
+            stream.write(_format_rows([{x: x for x in columns}], columns, widths))
+        _check_columns(columns, rows)
+        stream.write(_format_rows(rows, columns, widths))
+        stream.flush()
+
+
+def _write_csv(chunks: Iterable[List[Dict[str, Any]]], stream: TextIO) -> None:
+    writer: Optional["csv.DictWriter[str]"] = None
+    columns: List[str] = []
+    for rows in chunks:
+        if writer is None:
+            columns = _get_columns(rows)
+            writer = csv.DictWriter(stream, fieldnames=columns)
+            writer.writeheader()
+        _check_columns(columns, rows)
+        writer.writerows(rows)
+        stream.flush()
+
+
+def _write_jsonl(chunks: Iterable[List[Dict[str, Any]]], stream: TextIO) -> None:
+    for rows in chunks:
+        stream.write("".join(json.dumps(x, default=str) + "\n" for x in rows))
+        stream.flush()
+
+
+def _write_parquet(value: Any, path: str, chunk_size: int) -> None:
+    try:
+        import pyarrow as pa  # type: ignore
+        import pyarrow.parquet as pq  # type: ignore
+    except ImportError:
+        raise Exception("The parquet output needs pyarrow, please install it.")
+
+    if is_dataframe(value):
+        tables = (
+            pa.Table.from_pandas(x, preserve_index=False)
+            for x in _iter_frames(value, chunk_size)
+        )
+    else:
+        tables = (pa.Table.from_pylist(x) for x in iter_row_chunks(value, chunk_size))
+
+    writer = None
+    try:
+        for table in tables:
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def write_value(
+    value: Any,
+    output_format: str,
+    output_file: Optional[str] = None,
+    chunk_size: int = OUTPUT_CHUNK_SIZE,
+) -> None:
+    """Write a command result as a table, a chunk of rows at a time.
+
+    :param value: A DataFrame, an iterable of dicts, or any other value.
+    :param output_format: One of OUTPUT_FORMATS.
+    :param output_file: Where to write, the stdout by default.
+    :param chunk_size: The number of rows converted and written at once.
+    """
+    if output_format == "parquet":
+        if output_file is None:
+            raise Exception("The parquet output needs the --output-file option.")
+        _write_parquet(value, output_file, chunk_size)
+        return
+
+    writers = {"table": _write_table, "csv": _write_csv, "jsonl": _write_jsonl}
+    if output_format not in writers:
+        raise ValueError(f"Invalid output {output_format}")
+
+    chunks = iter_row_chunks(value, chunk_size)
+    if output_file is None:
+        try:
+            writers[output_format](chunks, sys.stdout)
+        except BrokenPipeError:
+            handle_broken_pipe()
+    else:
+        with open(output_file, "w", newline="") as f:
+            writers[output_format](chunks, f)
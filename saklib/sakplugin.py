@@ -9,15 +9,25 @@ __email__ = "ferawitt@gmail.com"
 
 import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from importlib.abc import MetaPathFinder
+from importlib.machinery import ModuleSpec, PathFinder
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Set
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple
 
 from saklib.sakconfig import CURRENT_DIR, SAK_GLOBAL, SAK_LOCAL
 from saklib.sakexec import run_cmd
+from saklib.saktiming import timing
 
 PYTHON_VERSION_MAJOR = sys.version_info.major
 PYTHON_VERSION_MINOR = sys.version_info.minor
 
+# Threads used to load the plugin configs, 1 loads them serially.
+PLUGIN_LOAD_THREADS = int(os.environ.get("SAK_PLUGIN_LOAD_THREADS", "8"))
+
 if PYTHON_VERSION_MAJOR == 3:
     if PYTHON_VERSION_MINOR >= 6:
         import importlib.util
@@ -58,11 +68,132 @@ class AddPath:
             pass
 
 
+class _SakPluginPathFinder(MetaPathFinder):
+    """Meta path finder for the modules next to the files being executed.
+
+    The folders are kept per thread instead of in the global sys.path, so
+    several threads can execute files at once.
+    """
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+
+    @property
+    def _paths(self) -> List[str]:
+        if not hasattr(self._local, "paths"):
+            self._local.paths = []
+        return self._local.paths  # type: ignore
+
+    @contextmanager
+    def add_path(self, path: Path) -> Iterator[None]:
+        self._paths.insert(0, str(path))
+        try:
+            yield
+        finally:
+            self._paths.remove(str(path))
+
+    def find_spec(
+        self,
+        fullname: str,
+        path: Optional[Sequence[str]],
+        target: Any = None,
+    ) -> Optional[ModuleSpec]:
+        # The submodules are found by the path of their package.
+        if (path is not None) or not self._paths:
+            return None
+        return PathFinder.find_spec(fullname, list(self._paths), target)
+
+
+_PATH_FINDER = _SakPluginPathFinder()
+# Right before the sys.path finder, as if the folder was first in sys.path.
+sys.meta_path.insert(
+    next(
+        (i for i, x in enumerate(sys.meta_path) if x is PathFinder),
+        len(sys.meta_path),
+    ),
+    _PATH_FINDER,
+)
+
+# Executed files by resolved path, with the (mtime, size) they were loaded with.
+_LOADED_FILES: Dict[Path, Tuple[Tuple[int, int], Dict[str, Any]]] = {}
+_LOADED_FILES_LOCK = threading.RLock()
+# One lock per file, so a file is executed once even if loaded by many threads.
+_FILE_LOCKS: Dict[Path, threading.Lock] = {}
+_RELOAD_CALLBACKS: List[Callable[[Path], None]] = []
+
+
+def register_reload_callback(callback: Callable[[Path], None]) -> None:
+    """Register a function to be called when a loaded file is executed again.
+
+    :param callback: Function that receives the resolved path of the changed file.
+    """
+    _RELOAD_CALLBACKS.append(callback)
+
+
+def clear_file_cache() -> None:
+    with _LOADED_FILES_LOCK:
+        _LOADED_FILES.clear()
+
+
 def load_file(fpath: Path, environ: Optional[Dict[str, Any]] = None) -> Any:
+    """Execute a python file and get its namespace.
+
+    The file is executed only once per process, and executed again only when
+    its modification time or size changes.
+
+    :param fpath: The python file path.
+    :param environ: Unused, kept for compatibility.
+    :returns: A copy of the file namespace, or None if it failed to execute.
+    """
+    return load_file_timed(fpath, environ)[0]
 
-    # TODO(witt): Implement some sort of auto reload. Check this as inspiration
-    # https://github.com/ipython/ipython/blob/cd54f15544eee69449cc5b3e926665bda5afb9fa/IPython/extensions/autoreload.py
 
+def load_file_timed(
+    fpath: Path, environ: Optional[Dict[str, Any]] = None
+) -> Tuple[Any, float]:
+    """Same as load_file, also getting the time spent to execute the file.
+
+    :param fpath: The python file path.
+    :param environ: Unused, kept for compatibility.
+    :returns: The load_file result and the execution time in seconds, zero if
+        the file was already loaded.
+    """
+    fpath = Path(fpath).resolve()
+    try:
+        stat = fpath.stat()
+    except OSError:
+        start = time.perf_counter()
+        return _exec_file(fpath, environ), time.perf_counter() - start
+    stamp = (stat.st_mtime_ns, stat.st_size)
+
+    with _LOADED_FILES_LOCK:
+        cached = _LOADED_FILES.get(fpath, None)
+        file_lock = _FILE_LOCKS.setdefault(fpath, threading.Lock())
+    if (cached is not None) and (cached[0] == stamp):
+        return dict(cached[1]), 0.0
+
+    with file_lock:
+        # It may have been executed by another thread meanwhile.
+        with _LOADED_FILES_LOCK:
+            cached = _LOADED_FILES.get(fpath, None)
+        if (cached is not None) and (cached[0] == stamp):
+            return dict(cached[1]), 0.0
+
+        start = time.perf_counter()
+        namespace = _exec_file(fpath, environ)
+        duration = time.perf_counter() - start
+        if namespace is None:
+            return None, duration
+        with _LOADED_FILES_LOCK:
+            _LOADED_FILES[fpath] = (stamp, namespace)
+
+    if cached is not None:
+        for callback in list(_RELOAD_CALLBACKS):
+            callback(fpath)
+    return dict(namespace), duration
+
+
+def _exec_file(fpath: Path, environ: Optional[Dict[str, Any]] = None) -> Any:
     # cache_pickle = Path(str(fpath) + '.pk')
     # if cache_pickle.exists():
     #    with open(cache_pickle, 'rb') as f:
@@ -94,7 +225,7 @@ def load_file(fpath: Path, environ: Optional[Dict[str, Any]] = None) -> Any:
         else:
             imported_module = None
             name = fpath.name.replace(".py", "")
-            with AddPath(fpath.parent):
+            with _PATH_FINDER.add_path(fpath.parent):
                 if PYTHON_VERSION_MAJOR == 3:
                     if PYTHON_VERSION_MINOR >= 6:
                         spec = importlib.util.spec_from_file_location(name, fpath)
@@ -154,6 +285,9 @@ class SakPlugin:
 
         # TODO(witt): What is the value of exposed?
         self._exposed: Dict[str, Any] = {}
+        self._exposed_origin: Dict[str, str] = {}
+        self._loaded_files: Set[str] = set()
+        self._declared_cmds: Dict[str, Any] = {}
 
         self._config_file = None
         if path is not None:
@@ -163,81 +297,176 @@ class SakPlugin:
         # if not self._config_file.is_file(): continue
 
         # TODO(witt): Maybe I could run this in a sandbox?!
-        self._config = {}
+        self._config: Dict[str, Any] = {}
+        # Time, in seconds, spent to load the config file.
+        self._config_load_time = 0.0
         if self._config_file is not None and self._config_file.exists():
-            self._config = load_file(self._config_file)
+            with timing("plugin", f"{name} sak_config.py"):
+                self._config, self._config_load_time = load_file_timed(
+                    self._config_file
+                )
 
     def _get_config(self) -> Dict[str, Any]:
         return self._config
 
-    def _load_exposes(self) -> None:
-
-        # TODO: This loaded should be invalidated in case the stat is newer...
-        # if self._loaded: return
-        self._loaded = True
+    def _get_expose_files(self) -> Dict[str, str]:
+        """Map each expose name to its file, "_" exposes in the plugin level.
 
+        :returns: The expose name to expose file name mapping.
+        """
         expose_files = self._config.get("EXPOSE_FILES", None)
 
+        ret: Dict[str, str] = {}
         if isinstance(expose_files, dict):
-            for expose_name, expose_file_name in expose_files.items():
-                expose_file = self._has_plugin_path / expose_file_name
-
-                if not expose_file.exists():
-                    raise Exception("Could not add exposed file %s" % expose_file_name)
-
-                imp_res = load_file(expose_file)
-                if imp_res is not None:
-                    exp_res = imp_res.get("EXPOSE", {})
-
-                    if expose_name == "_":
-                        if isinstance(exp_res, dict):
-                            for k, v in exp_res.items():
-                                self._exposed[k] = v
-                        elif isinstance(exp_res, list):
-                            for idx, v in enumerate(exp_res):
-                                self._exposed[f"_sak_unamed_expose_{idx}"] = v
-                        else:
-                            self._exposed["_sak_unamed_expose_"] = exp_res
-                    else:
-                        if isinstance(exp_res, dict) or isinstance(exp_res, list):
-                            self._exposed[expose_name] = {
-                                "__doc__": imp_res.get("__doc__", ""),
-                                "sak_subcmds": exp_res,
-                            }
-                        else:
-                            self._exposed["_sak_unamed_expose_"] = exp_res
-                else:
-                    raise Exception("Failed to load: %s" % expose_file)
-
+            ret = dict(expose_files)
         elif isinstance(expose_files, str):
-            expose_file_name = expose_files
-            expose_file = self._has_plugin_path / expose_file_name
+            ret = {"_": expose_files}
+
+        # Files only referenced by the declared commands expose in the plugin
+        # level, as the ones with the "_" expose name.
+        for command in self._get_declared_commands().values():
+            if command["file"] not in ret.values():
+                ret["_" + command["file"]] = command["file"]
+        return ret
+
+    def _get_declared_commands(self) -> Dict[str, Dict[str, Any]]:
+        """Get the commands declared in the COMMANDS of the plugin config.
+
+        The declared commands are listed without importing their files. For
+        example:
 
-            if not expose_file.exists():
-                raise Exception("Could not add exposed file %s" % expose_file_name)
+            COMMANDS = {"start": {"file": "core.py", "helpmsg": "Start webapp"}}
 
+        :returns: The command name to command declaration mapping.
+        """
+        return self._config.get("COMMANDS", None) or {}
+
+    def _get_declared_expose_name(self, name: str) -> Optional[str]:
+        command = self._get_declared_commands().get(name, None)
+        if command is None:
+            return None
+        for expose_name, expose_file_name in self._get_expose_files().items():
+            if expose_file_name == command["file"]:
+                return expose_name
+        return None
+
+    def _get_declared_cmd(self, name: str) -> Any:
+        """Get a lazy command for a declared command.
+
+        :param name: The declared command name.
+        :returns: The lazy command, or None if the command is not declared or
+            its file is already loaded.
+        """
+        expose_name = self._get_declared_expose_name(name)
+        if (expose_name is None) or (expose_name in self._loaded_files):
+            return None
+
+        if name not in self._declared_cmds:
+            # Imported here to avoid a circular import.
+            from saklib.sakmanifest import make_exposed_cmd
+
+            command = self._get_declared_commands()[name]
+            node = {
+                "name": name,
+                "helpmsg": command.get("helpmsg", ""),
+                "description": command.get("description", None),
+                "key": name,
+                "expose": expose_name,
+            }
+            self._declared_cmds[name] = make_exposed_cmd(self, node)
+        return self._declared_cmds[name]
+
+    def _load_expose_file(self, expose_name: str, expose_file_name: str) -> None:
+        if self._has_plugin_path is None:
+            raise Exception("Could not add exposed file %s" % expose_file_name)
+
+        expose_file = self._has_plugin_path / expose_file_name
+
+        if not expose_file.exists():
+            raise Exception("Could not add exposed file %s" % expose_file_name)
+
+        with timing("plugin", f"{self._name} {expose_file_name}"):
             imp_res = load_file(expose_file)
-            if imp_res is not None:
-                exp_res = imp_res.get("EXPOSE", {})
-                if isinstance(exp_res, dict):
-                    for k, v in exp_res.items():
-                        self._exposed[k] = v
-                elif isinstance(exp_res, list):
-                    for idx, v in enumerate(exp_res):
-                        self._exposed[f"_sak_unamed_expose_{idx}"] = v
-                else:
-                    self._exposed["_sak_unamed_expose_"] = exp_res
+        if imp_res is None:
+            raise Exception("Failed to load: %s" % expose_file)
+
+        exposed: Dict[str, Any] = {}
+        exp_res = imp_res.get("EXPOSE", {})
+
+        if expose_name.startswith("_"):
+            if isinstance(exp_res, dict):
+                for k, v in exp_res.items():
+                    exposed[k] = v
+            elif isinstance(exp_res, list):
+                for idx, v in enumerate(exp_res):
+                    exposed[f"_sak_unamed_expose_{idx}"] = v
             else:
-                raise Exception("Failed to load: %s" % expose_file)
+                exposed["_sak_unamed_expose_"] = exp_res
+        else:
+            if isinstance(exp_res, dict) or isinstance(exp_res, list):
+                exposed[expose_name] = {
+                    "__doc__": imp_res.get("__doc__", ""),
+                    "sak_subcmds": exp_res,
+                }
+            else:
+                exposed["_sak_unamed_expose_"] = exp_res
+
+        for k, v in exposed.items():
+            self._exposed[k] = v
+            self._exposed_origin[k] = expose_name
+        self._loaded_files.add(expose_name)
+
+    def _load_exposes(self, declared: bool = True) -> None:
+
+        # TODO: This loaded should be invalidated in case the stat is newer...
+        # if self._loaded: return
+        self._loaded = True
+
+        declared_expose_names = set()
+        if not declared:
+            for name in self._get_declared_commands().keys():
+                declared_expose_names.add(self._get_declared_expose_name(name))
+
+        for expose_name, expose_file_name in self._get_expose_files().items():
+            if expose_name in declared_expose_names:
+                continue
+            self._load_expose_file(expose_name, expose_file_name)
+
+    def _get_exposed(self, key: str, expose_name: Optional[str] = None) -> Any:
+        """Get an exposed object loading only the file that defines it.
+
+        :param key: The exposed key, as listed by dir.
+        :param expose_name: The expose name of the file that defines the key.
+        :returns: The exposed object.
+        """
+        if expose_name is not None:
+            if expose_name not in self._loaded_files:
+                expose_file_name = self._get_expose_files()[expose_name]
+                self._load_expose_file(expose_name, expose_file_name)
+            if key in self._exposed:
+                return self._exposed[key]
+        return getattr(self, key)
 
     def __dir__(self) -> Set[Any]:
-        self._load_exposes()
+        self._load_exposes(declared=False)
         ret = set(self._exposed.keys()) | set(super(SakPlugin, self).__dir__())
+        ret |= set(self._get_declared_commands().keys())
 
         return ret
 
     def __getattr__(self, name: str) -> Any:
-        self._load_exposes()
+        expose_name = self._get_declared_expose_name(name)
+        if expose_name is not None:
+            if expose_name not in self._loaded_files:
+                expose_file_name = self._get_expose_files()[expose_name]
+                self._load_expose_file(expose_name, expose_file_name)
+            if name not in self._exposed:
+                raise AttributeError(
+                    f"The command {name} is not exposed in {self._get_expose_files()[expose_name]}"
+                )
+            return self._exposed[name]
+
+        self._load_exposes(declared=False)
         if name in self._exposed:
             return self._exposed[name]
         return super(SakPlugin, self).__getattribute__(name)
@@ -328,26 +557,53 @@ class SakPluginManager(object):
     def getPluginList(self) -> List[SakPlugin]:
         return self.has_plugins
 
+    def _load_plugin(self, plugin_path: Path) -> Optional[SakPlugin]:
+        name = str(plugin_path.name)
+        if not plugin_path.is_dir():
+            return None
+
+        config_file = plugin_path / "sak_config.py"
+        if not config_file.is_file():
+            return None
+
+        if name.startswith("sak_"):
+            name = name.replace("sak_", "")
+
+        if self.has_context is None:
+            raise Exception("No context defined")
+
+        return SakPlugin(self.has_context, name, plugin_path)
+
     def loadPlugins(self, pluginsPath: Optional[Path] = None) -> None:
+        """Load the plugins in a folder.
+
+        The plugin folders are checked and their configs loaded concurrently,
+        but the plugins are added in the folder listing order.
+
+        :param pluginsPath: The folder with the plugins.
+        """
         if pluginsPath is None:
             return
         if not pluginsPath.exists():
             return
 
-        for plugin_path in pluginsPath.iterdir():
-            name = str(plugin_path.name)
-            if not plugin_path.is_dir():
-                continue
+        plugin_paths = list(pluginsPath.iterdir())
 
-            config_file = plugin_path / "sak_config.py"
-            if not config_file.is_file():
-                continue
+        if PLUGIN_LOAD_THREADS > 1 and len(plugin_paths) > 1:
+            workers = min(PLUGIN_LOAD_THREADS, len(plugin_paths))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                plugins = list(executor.map(self._load_plugin, plugin_paths))
+        else:
+            plugins = [self._load_plugin(x) for x in plugin_paths]
 
-            if name.startswith("sak_"):
-                name = name.replace("sak_", "")
+        for plugin in plugins:
+            if plugin is not None:
+                self.addPlugin(plugin)
 
-            if self.has_context is None:
-                raise Exception("No context defined")
+    def get_timing_report(self) -> List[Tuple[str, float]]:
+        """Get the time, in milliseconds, to load each plugin config.
 
-            plugin = SakPlugin(self.has_context, name, plugin_path)
-            self.addPlugin(plugin)
+        :returns: The plugin names and times, the slowest first.
+        """
+        ret = [(x._name, x._config_load_time * 1000.0) for x in self.has_plugins]
+        return sorted(ret, key=lambda x: -x[1])
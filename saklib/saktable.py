@@ -0,0 +1,172 @@
+# -*- coding: UTF-8 -*-
+
+__author__ = "Fernando Witt"
+__credits__ = ["Fernando Witt"]
+
+__license__ = "MIT"
+__maintainer__ = "Fernando Witt"
+__email__ = "ferawitt@gmail.com"
+
+from array import array
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    MutableSequence,
+    Optional,
+)
+
+if TYPE_CHECKING:
+    import pandas as pd  # type: ignore
+
+Column = MutableSequence[Any]
+
+# Number of rows shown by the repr.
+REPR_MAX_ROWS = 10
+
+
+def _new_column(value: Any) -> Column:
+    # The numbers are stored in arrays, 8 bytes per value instead of an object.
+    if isinstance(value, int) and not isinstance(value, bool):
+        try:
+            return array("q", [value])
+        except OverflowError:
+            pass
+    elif isinstance(value, float):
+        return array("d", [value])
+    return [value]
+
+
+class SakTable:
+    """Column oriented table of the command results, without pandas.
+
+    The integer and float columns are stored in arrays, the other columns in
+    lists. The CLI renders the table, and writes it with the --output formats,
+    the webapp shows it, and to_pandas converts it when pandas is needed.
+
+    Usage:
+        table = SakTable()
+        for task in tasks:
+            table.append({"name": task.name, "duration": task.duration})
+        return table
+    """
+
+    def __init__(self, columns: Optional[Dict[str, Iterable[Any]]] = None) -> None:
+        """Create a table.
+
+        :param columns: The values of each column, all with the same length.
+        """
+        self._columns: Dict[str, Column] = {}
+        self._length = 0
+
+        if columns:
+            lengths = set()
+            for name, values in columns.items():
+                column: Column = (
+                    values if isinstance(values, (array, list)) else list(values)
+                )
+                self._columns[name] = column
+                lengths.add(len(column))
+            if len(lengths) > 1:
+                raise ValueError("The columns have different lengths")
+            self._length = lengths.pop()
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Dict[str, Any]]) -> "SakTable":
+        table = cls()
+        table.extend(rows)
+        return table
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self._columns.keys())
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, name: str) -> Column:
+        return self._columns[name]
+
+    def append(self, row: Dict[str, Any]) -> None:
+        """Add a row, the missing values are None.
+
+        :param row: The values by column name, new names add columns.
+        """
+        for name, value in row.items():
+            column = self._columns.get(name, None)
+            if column is None:
+                if self._length:
+                    self._columns[name] = [None] * self._length + [value]
+                else:
+                    self._columns[name] = _new_column(value)
+                continue
+            self._append_value(name, column, value)
+
+        for name, column in self._columns.items():
+            if len(column) == self._length:
+                self._append_value(name, column, None)
+        self._length += 1
+
+    def _append_value(self, name: str, column: Column, value: Any) -> None:
+        if isinstance(column, array):
+            try:
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    column.append(value)  # type: ignore
+                    return
+            except (TypeError, OverflowError):
+                # Like a float in an integer column.
+                pass
+            column = list(column)
+            self._columns[name] = column
+        column.append(value)
+
+    def extend(self, rows: Iterable[Dict[str, Any]]) -> None:
+        for row in rows:
+            self.append(row)
+
+    def iter_rows(
+        self, start: int = 0, stop: Optional[int] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """Iterate the rows, as dicts.
+
+        :param start: The first row.
+        :param stop: The row to stop, the end of the table by default.
+        :returns: The rows.
+        """
+        stop = self._length if stop is None else min(stop, self._length)
+        names = self.columns
+        columns = [self._columns[x][start:stop] for x in names]
+        for values in zip(*columns):
+            yield dict(zip(names, values))
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return self.iter_rows()
+
+    def iter_chunks(self, chunk_size: int) -> Iterator[List[Dict[str, Any]]]:
+        for start in range(0, self._length, chunk_size):
+            yield list(self.iter_rows(start, start + chunk_size))
+
+    def to_rows(self) -> List[Dict[str, Any]]:
+        return list(self.iter_rows())
+
+    def to_pandas(self) -> "pd.DataFrame":
+        import pandas as pd  # type: ignore
+
+        # The arrays are converted through the buffer protocol, without copies
+        # of each value.
+        return pd.DataFrame(
+            {name: column for name, column in self._columns.items()},
+            columns=self.columns,
+        )
+
+    def __repr__(self) -> str:
+        from saklib.sakoutput import format_table
+
+        rows = list(self.iter_rows(stop=REPR_MAX_ROWS))
+        ret = format_table(rows, self.columns)
+        if self._length > REPR_MAX_ROWS:
+            ret += "...\n"
+        return ret + "[%d rows x %d columns]" % (self._length, len(self._columns))
@@ -8,39 +8,49 @@ __maintainer__ = "Fernando Witt"
 __email__ = "ferawitt@gmail.com"
 
 import io
+import itertools
 import json
 import os
 import sys
 import threading
 import traceback
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Callable, Dict, Generator, Iterable, List, Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
 
-# Import heavy modules.
-import lazy_import  # type: ignore
-import sqlalchemy as db
 from filelock import FileLock
-from pygit2 import GitError  # type: ignore
-from sqlalchemy import ForeignKey, Integer, String, event
-from sqlalchemy.engine import Engine
-from sqlalchemy.orm import mapped_column, scoped_session, sessionmaker
-from tqdm import tqdm  # type: ignore
 
 from saklib.sakhash import make_hash_sha256
 from saklib.sakio import get_stdout_buffer_for_thread, unregister_stdout_thread_id
 from saklib.sakstr import camel_to_snake
+from saklib.saktable import SakTable
 from saklib.saktask_ga import SakGitAnnexDriver, SakTaskGitAnnexData
 from saklib.saktask_io import STDERR, STDOUT, VERBOSE
-from saklib.saktask_model import SAK_TASK_DB, TABLES, Base, SakTaskDb, SakTaskStatus
+from saklib.saktask_status import SakTaskStatus
+from saklib.saktiming import span
 
-lazy_import.lazy_module("pandas")
+# The heavy modules (sqlalchemy, pygit2, pandas and tqdm) are only imported by
+# the functions that need them, so plugins can import the task types for free.
+if TYPE_CHECKING:
+    import pandas as pd  # type: ignore
+    import sqlalchemy as db
 
-import pandas as pd  # type: ignore
+    from saklib.saktask_model import Base, SakTaskDb
 
 # Store global state.
 STORAGE: Dict[str, "SakTaskStorage"] = {}
+STORAGE_PATH: Dict[str, Path] = {}
 NAMESPACE: Dict[str, "SakTasksNamespace"] = {}
 
 
@@ -95,6 +105,27 @@ class SakTaskInternalParam:
     perform_commit: bool = True
 
 
+# Number of tasks looked up and inserted, or updated, at once.
+CREATE_TASKS_CHUNK_SIZE = 500
+
+
+def get_param_columns(key_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Get the param table values of a task key, the other types are stored as JSON.
+
+    :param key_data: The task key data.
+    :returns: The values by column name.
+    """
+    ret: Dict[str, Any] = {}
+    for k, v in key_data.items():
+        if isinstance(v, int):
+            ret[k] = v
+        elif isinstance(v, str):
+            ret[k] = v
+        else:
+            ret[k] = json.dumps(v)
+    return ret
+
+
 class SakTask:
     def __init__(
         self,
@@ -112,6 +143,8 @@ class SakTask:
 
         key_hash = self.key.get_hash()
 
+        from saklib.saktask_model import SakTaskDb
+
         session = self.namespace.storage.scoped_session_obj()
 
         db_obj = self.namespace.get_task_db_obj(key_hash)
@@ -125,19 +158,9 @@ class SakTask:
 
         param_obj = self.namespace.get_task_db_param(key_hash)
         if param_obj is None:
-            # TODO(witt): Extract to common function.
-            supported_params: Dict[str, Any] = {}
-            for k, v in key.data.items():
-                if isinstance(v, int):
-                    supported_params[k] = v
-                elif isinstance(v, str):
-                    supported_params[k] = v
-                else:
-                    supported_params[k] = json.dumps(v)
-
             param_obj = self.namespace.param_table_class(
                 key_hash=key_hash,
-                **supported_params,
+                **get_param_columns(key.data),
             )
             session.add(param_obj)
 
@@ -197,7 +220,10 @@ class SakTask:
             db_obj.metadata_hash != metadata_file_hash
         ):
             db_obj.namespace = ga_data.namespace
-            db_obj.status = ga_data.status
+            # The tasks that never ran have no status in git-annex.
+            db_obj.status = (
+                ga_data.status if ga_data.status is not None else SakTaskStatus.PENDING
+            )
             db_obj.start_time = ga_data.start_time
             db_obj.end_time = ga_data.end_time
 
@@ -258,6 +284,13 @@ class SakTask:
     def has_to_rerun(self, **kwargs: Any) -> bool:
         return False
 
+    def get_upstream_keys(self) -> List[Tuple[str, str]]:
+        """Get the tasks that must succeed before this one, see saktask_dag.
+
+        :returns: The namespace name and key hash of each upstream task.
+        """
+        return []
+
     def run(self, **kwargs: Any) -> None:
         # TODO(witt): Verify wrong pending status.
         if (self.get_status() != SakTaskStatus.PENDING) and (
@@ -265,11 +298,21 @@ class SakTask:
         ):
             return
 
+        self.rerun(**kwargs)
+
+    def rerun(self, **kwargs: Any) -> None:
+        """Run the task, even if it already ran."""
+        with span(f"task {type(self).__name__}", key=self.key.get_hash()):
+            self._run_task(**kwargs)
+
+    def _run_task(self, **kwargs: Any) -> None:
         self.ga_obj.set_data(
             SakTaskGitAnnexData(start_time=datetime.now()),
         )
 
         if VERBOSE:
+            from tqdm import tqdm  # type: ignore
+
             tqdm.write(
                 f"Running {type(self).__name__} {self.key.get_hash()}", file=STDOUT
             )
@@ -283,7 +326,8 @@ class SakTask:
         error_message = io.StringIO("")
 
         try:
-            self(**kwargs)
+            with span(f"task {type(self).__name__} call"):
+                self(**kwargs)
         except Exception as e:
             has_error = True
             exception = e
@@ -320,11 +364,29 @@ class SakTask:
                 raise exception
 
 
-def tasks_to_df(
+@dataclass
+class SakTaskHandle:
+    """A task created by SakTasksNamespace.create_tasks, without loading it."""
+
+    namespace: "SakTasksNamespace"
+    key_hash: str
+    key_data: Dict[str, Any]
+
+    def get_task(
+        self, internal_param: Optional[SakTaskInternalParam] = None
+    ) -> Optional[SakTask]:
+        return self.namespace.load_from_git_annex(
+            self.key_hash, self.key_data, internal_param=internal_param
+        )
+
+
+def tasks_to_table(
     objs: Iterable[SakTask], namespace: Optional[str] = None
-) -> "pd.DataFrame":
-    ret = []
-    for obj in tqdm(objs, desc="Create DF", file=STDOUT):
+) -> SakTable:
+    from tqdm import tqdm  # type: ignore
+
+    ret = SakTable()
+    for obj in tqdm(objs, desc="Create table", file=STDOUT):
         row: Dict[str, Any] = {}
 
         row["_key"] = obj.key.get_hash()
@@ -345,7 +407,13 @@ def tasks_to_df(
             continue
 
         ret.append(row)
-    return pd.DataFrame(ret)
+    return ret
+
+
+def tasks_to_df(
+    objs: Iterable[SakTask], namespace: Optional[str] = None
+) -> "pd.DataFrame":
+    return tasks_to_table(objs, namespace=namespace).to_pandas()
 
 
 class SakTasksNamespace:
@@ -361,6 +429,18 @@ class SakTasksNamespace:
         self.param_name = self.obj_class.__name__
         self.param_table = camel_to_snake(self.param_name)
 
+        self._param_table_class: Any = None
+
+    @property
+    def param_table_class(self) -> Any:
+        if self._param_table_class is not None:
+            return self._param_table_class
+
+        from sqlalchemy import ForeignKey, Integer, String
+        from sqlalchemy.orm import mapped_column
+
+        from saklib.saktask_model import SAK_TASK_DB, TABLES, Base
+
         if self.param_table not in TABLES:
             fields = []
             for field_name, field in self.param_class.__dataclass_fields__.items():
@@ -379,16 +459,24 @@ class SakTasksNamespace:
             }
             _parameters.update(dict(fields))
 
-            self.param_table_class = type(self.param_name + "DB", (Base,), _parameters)
+            self._param_table_class = type(self.param_name + "DB", (Base,), _parameters)
 
-            TABLES[self.param_table] = self.param_table_class
+            TABLES[self.param_table] = self._param_table_class
         else:
-            self.param_table_class = TABLES[self.param_table]
+            self._param_table_class = TABLES[self.param_table]
+
+        # The param tables declared after the DB connection are not created yet.
+        self._param_table_class.__table__.create(self.storage.engine, checkfirst=True)
+        return self._param_table_class
 
     def set_volatile(self) -> None:
         pass
 
     def sync_key_table(self) -> None:
+        from tqdm import tqdm  # type: ignore
+
+        from saklib.saktask_model import SakTaskDb
+
         session = self.storage.scoped_session_obj()
 
         key_hash: str = self.param_table_class.key_hash  # type: ignore
@@ -410,6 +498,8 @@ class SakTasksNamespace:
         return ret
 
     def count_tasks(self) -> int:
+        from saklib.saktask_model import SakTaskDb
+
         session = self.storage.scoped_session_obj()
 
         query = session.query(SakTaskDb.key_hash).filter_by(namespace=self.name)
@@ -419,6 +509,8 @@ class SakTasksNamespace:
         return query.count()  # type: ignore
 
     def get_keys(self) -> List[str]:
+        from saklib.saktask_model import SakTaskDb
+
         session = self.storage.scoped_session_obj()
 
         query = session.query(SakTaskDb.key_hash).filter_by(namespace=self.name)
@@ -427,12 +519,14 @@ class SakTasksNamespace:
 
         return [x for x in query.all()]
 
-    def get_task_db_param(self, hash_str: str) -> Optional[Base]:
+    def get_task_db_param(self, hash_str: str) -> Optional["Base"]:
         session = self.storage.scoped_session_obj()
         ret = session.get(self.param_table_class, hash_str)
         return ret
 
-    def get_task_db_obj(self, hash_str: str) -> Optional[SakTaskDb]:
+    def get_task_db_obj(self, hash_str: str) -> Optional["SakTaskDb"]:
+        from saklib.saktask_model import SakTaskDb
+
         session = self.storage.scoped_session_obj()
 
         ret = session.get(SakTaskDb, hash_str)
@@ -441,6 +535,213 @@ class SakTasksNamespace:
                 return ret  # type: ignore
         return None
 
+    def create_tasks(
+        self, params: Iterable[Any], chunk_size: int = CREATE_TASKS_CHUNK_SIZE
+    ) -> List[SakTaskHandle]:
+        """Create many tasks in one DB transaction and one git-annex metadata batch.
+
+        Creating the task objects one by one looks up, writes and commits each
+        task. Here the existing keys are looked up and the new rows bulk inserted
+        a chunk at a time, the metadata of the new tasks is pipelined to
+        git-annex, and the DB is committed once.
+
+        :param params: The task parameters, instances of the param class or dicts.
+        :param chunk_size: Number of tasks looked up and inserted at once.
+        :returns: The handles of the tasks, in the params order, without duplicates.
+        """
+        import sqlalchemy as db
+
+        from saklib.saktask_model import SakTaskDb
+
+        param_table_class = self.param_table_class
+        session = self.storage.scoped_session_obj()
+        ga_drv = self.storage.ga_drv
+
+        ret: List[SakTaskHandle] = []
+        seen = set()
+        params_iter = iter(params)
+        try:
+            while True:
+                chunk = list(itertools.islice(params_iter, chunk_size))
+                if not chunk:
+                    break
+
+                handles: Dict[str, SakTaskHandle] = {}
+                for param in chunk:
+                    key_data = param if isinstance(param, dict) else asdict(param)
+                    key_hash = SakTaskKey(**key_data).get_hash()
+                    if key_hash in seen:
+                        continue
+                    seen.add(key_hash)
+                    handles[key_hash] = SakTaskHandle(self, key_hash, key_data)
+                ret += handles.values()
+
+                keys = list(handles.keys())
+                existing_tasks = set(
+                    session.scalars(
+                        db.select(SakTaskDb.key_hash).where(
+                            SakTaskDb.key_hash.in_(keys)
+                        )
+                    )
+                )
+                existing_params = set(
+                    session.scalars(
+                        db.select(param_table_class.key_hash).where(
+                            param_table_class.key_hash.in_(keys)
+                        )
+                    )
+                )
+
+                new_tasks = [x for x in keys if x not in existing_tasks]
+                if new_tasks:
+                    ga_datas = ga_drv.git_annex_set_metadata_batch(
+                        [
+                            (
+                                x,
+                                SakTaskGitAnnexData(
+                                    key_hash=x,
+                                    namespace=self.name,
+                                    key_data=handles[x].key_data,
+                                ),
+                            )
+                            for x in new_tasks
+                        ]
+                    )
+                    session.execute(
+                        db.insert(SakTaskDb),
+                        [
+                            {
+                                "key_hash": key_hash,
+                                "namespace": self.name,
+                                "status": ga_data.status or SakTaskStatus.PENDING,
+                                "start_time": ga_data.start_time,
+                                "end_time": ga_data.end_time,
+                                "last_changed": ga_data._last_changed,
+                                "metadata_hash": ga_data.get_hash(ga_drv=ga_drv),
+                            }
+                            for key_hash, ga_data in zip(new_tasks, ga_datas)
+                        ],
+                    )
+
+                new_params = [x for x in keys if x not in existing_params]
+                if new_params:
+                    session.execute(
+                        db.insert(param_table_class),
+                        [
+                            dict(key_hash=x, **get_param_columns(handles[x].key_data))
+                            for x in new_params
+                        ],
+                    )
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return ret
+
+    def claim_tasks(self, limit: int) -> List[str]:
+        """Claim PENDING tasks to run them, by changing their DB status to RUNNING.
+
+        Each claim is a conditional UPDATE, so concurrent runners never claim
+        the same task. The RUNNING status is only stored in the DB.
+
+        :param limit: The maximum number of tasks to claim.
+        :returns: The claimed keys.
+        """
+        import sqlalchemy as db
+
+        from saklib.saktask_model import SakTaskDb
+
+        # The rows synced before the tasks had a status in git-annex are NULL.
+        pending = db.or_(
+            SakTaskDb.status.is_(None), SakTaskDb.status == SakTaskStatus.PENDING
+        )
+
+        session = self.storage.scoped_session_obj()
+        try:
+            keys = session.scalars(
+                db.select(SakTaskDb.key_hash)
+                .where(SakTaskDb.namespace == self.name)
+                .where(pending)
+                .limit(limit)
+            ).all()
+
+            ret = []
+            for key in keys:
+                result = session.execute(
+                    db.update(SakTaskDb)
+                    .where(SakTaskDb.key_hash == key)
+                    .where(pending)
+                    .values(status=SakTaskStatus.RUNNING)
+                )
+                if result.rowcount == 1:  # type: ignore
+                    ret.append(key)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return ret
+
+    def claim_task(self, key_hash: str) -> bool:
+        """Claim a task to run it, unless another runner already claimed it.
+
+        Like claim_tasks, but for a task in any status other than RUNNING.
+
+        :param key_hash: The task key hash.
+        :returns: True if the task was claimed.
+        """
+        import sqlalchemy as db
+
+        from saklib.saktask_model import SakTaskDb
+
+        session = self.storage.scoped_session_obj()
+        try:
+            result = session.execute(
+                db.update(SakTaskDb)
+                .where(SakTaskDb.key_hash == key_hash)
+                .where(
+                    db.or_(
+                        SakTaskDb.status.is_(None),
+                        SakTaskDb.status != SakTaskStatus.RUNNING,
+                    )
+                )
+                .values(status=SakTaskStatus.RUNNING)
+            )
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return result.rowcount == 1  # type: ignore
+
+    def release_claims(
+        self, keys: List[str], status: SakTaskStatus = SakTaskStatus.PENDING
+    ) -> None:
+        """Change the status of claimed tasks that are still RUNNING.
+
+        :param keys: The claimed keys.
+        :param status: The new status, PENDING to let them be claimed again.
+        """
+        import sqlalchemy as db
+
+        from saklib.saktask_model import SakTaskDb
+
+        session = self.storage.scoped_session_obj()
+        try:
+            for idx in range(0, len(keys), CREATE_TASKS_CHUNK_SIZE):
+                session.execute(
+                    db.update(SakTaskDb)
+                    .where(
+                        SakTaskDb.key_hash.in_(
+                            keys[idx : idx + CREATE_TASKS_CHUNK_SIZE]
+                        )
+                    )
+                    .where(SakTaskDb.status == SakTaskStatus.RUNNING)
+                    .values(status=status)
+                )
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
     def load_from_git_annex(
         self,
         hash_str: str,
@@ -475,6 +776,8 @@ class SakTasksNamespace:
     ) -> "pd.DataFrame":
         obj = self.get_task(hash_str=hash_str, internal_param=internal_param)
         if obj is None:
+            import pandas as pd  # type: ignore
+
             return pd.DataFrame()
 
         return tasks_to_df([obj], namespace=self.name)
@@ -482,8 +785,10 @@ class SakTasksNamespace:
     def get_task_db_objs(
         self,
         limit: Optional[int] = None,
-        query: Optional[db.sql.elements.BooleanClauseList] = None,
-    ) -> List[SakTaskDb]:
+        query: Optional["db.sql.elements.BooleanClauseList"] = None,
+    ) -> List["SakTaskDb"]:
+        from saklib.saktask_model import SakTaskDb
+
         session = self.storage.scoped_session_obj()
 
         namespace_objs = session.query(SakTaskDb.key_hash).filter(
@@ -492,10 +797,6 @@ class SakTasksNamespace:
         _query = SakTaskDb.key_hash.in_(namespace_objs)
         if query is not None:
             _query = query  # type: ignore
-        else:
-            _query = session.query(SakTaskDb.key_hash).filter(
-                SakTaskDb.namespace == self.name
-            )
 
         do_query = session.query(SakTaskDb).filter(_query)
 
@@ -508,7 +809,7 @@ class SakTasksNamespace:
     def get_tasks(
         self,
         limit: Optional[int] = None,
-        query: Optional[db.sql.elements.BooleanClauseList] = None,
+        query: Optional["db.sql.elements.BooleanClauseList"] = None,
     ) -> Generator[Any, None, None]:
         for db_obj in self.get_task_db_objs(limit=limit, query=query):
             metadata = self.storage.ga_drv.git_annex_get_metada(key=db_obj.key_hash)
@@ -532,15 +833,23 @@ class SakTasksNamespace:
 
     def get_tasks_df(
         self,
-        query: Optional[db.sql.elements.BooleanClauseList] = None,
+        query: Optional["db.sql.elements.BooleanClauseList"] = None,
         limit: Optional[int] = None,
     ) -> "pd.DataFrame":
         objs = list(self.get_tasks(query=query, limit=limit))
         print(len(objs))
         return tasks_to_df(objs, namespace=self.name)
 
+    def get_tasks_table(
+        self,
+        query: Optional["db.sql.elements.BooleanClauseList"] = None,
+        limit: Optional[int] = None,
+    ) -> SakTable:
+        return tasks_to_table(
+            self.get_tasks(query=query, limit=limit), namespace=self.name
+        )
+
 
-@event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_con, con_record):  # type: ignore
     cursor = dbapi_con.cursor()
     cursor.execute("PRAGMA journal_mode=WAL")
@@ -553,11 +862,17 @@ class SakTaskStorage:
 
         self.path.mkdir(parents=True, exist_ok=True)
 
-        self.ga_drv = SakGitAnnexDriver(self.path)
+        self._ga_drv: Optional[SakGitAnnexDriver] = None
 
-        self._engine: Optional[db.engine.base.Engine] = None
-        self._session_factory: Optional[db.orm.session.sessionmaker] = None  # type: ignore
-        self._scoped_session_obj: Optional[db.orm.scoping.scoped_session] = None  # type: ignore
+        self._engine: Optional["db.engine.base.Engine"] = None
+        self._session_factory: Optional["db.orm.session.sessionmaker"] = None  # type: ignore
+        self._scoped_session_obj: Optional["db.orm.scoping.scoped_session"] = None  # type: ignore
+
+    @property
+    def ga_drv(self) -> SakGitAnnexDriver:
+        if self._ga_drv is None:
+            self._ga_drv = SakGitAnnexDriver(self.path)
+        return self._ga_drv
 
     def sync_ga(self) -> None:
         self.ga_drv.sync()
@@ -598,16 +913,16 @@ class SakTaskStorage:
             if last_commit != current_commit:
                 pass
 
-            all_keys = self.ga_drv.get_all_keys(
+            all_keys = self.ga_drv.iter_changed_keys(
                 current_commit=current_commit, last_commit=last_commit
             )
-            if all_keys is None:
-                return
 
             session = self.scoped_session_obj()
 
             internal_param = SakTaskInternalParam(perform_commit=False)
 
+            from tqdm import tqdm  # type: ignore
+
             for key in tqdm(all_keys, desc="Sync db", file=STDOUT):
                 metadata = self.ga_drv.git_annex_get_metada(key=key)
                 if metadata.namespace is None:
@@ -639,21 +954,21 @@ class SakTaskStorage:
             namespace.sync_key_table()
 
     @property
-    def engine(self) -> db.engine.base.Engine:
+    def engine(self) -> "db.engine.base.Engine":
         if self._engine is None:
             self.db_connect()
         assert self._engine is not None, "Failed to create DB engine"
         return self._engine
 
     @property
-    def session_factory(self) -> db.orm.session.sessionmaker:  # type: ignore
+    def session_factory(self) -> "db.orm.session.sessionmaker":  # type: ignore
         if self._session_factory is None:
             self.db_connect()
         assert self._session_factory is not None, "Failed to create DB session factory"
         return self._session_factory
 
     @property
-    def scoped_session_obj(self) -> db.orm.scoping.scoped_session:  # type: ignore
+    def scoped_session_obj(self) -> "db.orm.scoping.scoped_session":  # type: ignore
         if self._scoped_session_obj is None:
             self.db_connect()
         assert (
@@ -662,9 +977,15 @@ class SakTaskStorage:
         return self._scoped_session_obj
 
     def db_connect(self) -> None:
+        import sqlalchemy as db
+        from sqlalchemy.orm import scoped_session, sessionmaker
+
+        from saklib.saktask_model import Base
+
         db_url = f"sqlite:///{self.path.resolve()}/db.sqlite"
 
         self._engine = db.create_engine(db_url, echo=False)
+        db.event.listen(self._engine, "connect", set_sqlite_pragma)
 
         self._session_factory = sessionmaker(bind=self._engine)
         self._scoped_session_obj = scoped_session(self._session_factory)
@@ -678,18 +999,46 @@ class SakTaskStorage:
 
 
 def get_storage(name: str = "global") -> SakTaskStorage:
+    """Get a storage, creating it on the first access.
+
+    :param name: The storage name.
+    :returns: The storage.
+    """
+    if name not in STORAGE:
+        STORAGE[name] = SakTaskStorage(STORAGE_PATH[name])
     return STORAGE[name]
 
 
+def get_storages() -> Dict[str, SakTaskStorage]:
+    """Get all the registered storages that are valid git repositories.
+
+    :returns: The storages by name.
+    """
+    from pygit2 import GitError  # type: ignore
+
+    ret = {}
+    for name in STORAGE_PATH.keys():
+        try:
+            storage = get_storage(name)
+            storage.ga_drv.repo
+        except GitError as e:
+            print(e)
+            continue
+        ret[name] = storage
+    return ret
+
+
 def set_storage(
     path: Path,
     name: str = "global",
 ) -> None:
-    try:
-        STORAGE[name] = SakTaskStorage(path)
-        path.mkdir(parents=True, exist_ok=True)
-    except GitError as e:
-        print(e)
+    """Register a storage, it is only opened when first used.
+
+    :param path: The storage git-annex repository path.
+    :param name: The storage name.
+    """
+    STORAGE_PATH[name] = path
+    STORAGE.pop(name, None)
 
 
 def register_namespace(nm_obj: "SakTasksNamespace") -> None:
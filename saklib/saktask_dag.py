@@ -0,0 +1,311 @@
+# -*- coding: UTF-8 -*-
+
+__author__ = "Fernando Witt"
+__credits__ = ["Fernando Witt"]
+
+__license__ = "MIT"
+__maintainer__ = "Fernando Witt"
+__email__ = "ferawitt@gmail.com"
+
+import multiprocessing
+import sys
+import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+from saklib.sakio import register_threaded_stdout_and_stderr_tee
+from saklib.saktask import NAMESPACE, SakTask, SakTasksNamespace
+from saklib.saktask_io import STDOUT, VERBOSE
+from saklib.saktask_status import SakTaskStatus
+
+# The namespace name and key hash of a task.
+SakTaskRef = Tuple[str, str]
+
+
+@dataclass
+class SakTaskNode:
+    task: SakTask
+    status: Optional[SakTaskStatus] = None
+    start_time: Optional[datetime] = None
+    end_time: Optional[datetime] = None
+    upstream: List[SakTaskRef] = field(default_factory=list)
+    downstream: List[SakTaskRef] = field(default_factory=list)
+
+
+@dataclass
+class SakTaskDagResult:
+    """The outcome of run_dag, the task refs by what happened to them."""
+
+    success: List[SakTaskRef] = field(default_factory=list)
+    fail: List[SakTaskRef] = field(default_factory=list)
+    skipped: List[SakTaskRef] = field(default_factory=list)
+    cancelled: List[SakTaskRef] = field(default_factory=list)
+    # The tasks RUNNING in another runner, like run_tasks, that were not run.
+    running: List[SakTaskRef] = field(default_factory=list)
+    interrupted: bool = False
+
+    def get_counts(self) -> Dict[str, int]:
+        return {
+            "success": len(self.success),
+            "fail": len(self.fail),
+            "skipped": len(self.skipped),
+            "cancelled": len(self.cancelled),
+            "running": len(self.running),
+        }
+
+
+class SakTaskDag:
+    """The tasks and their dependencies, declared by SakTask.get_upstream_keys."""
+
+    def __init__(self) -> None:
+        self.nodes: Dict[SakTaskRef, SakTaskNode] = {}
+
+    def add_task(self, nm: SakTasksNamespace, key_hash: str) -> Optional[SakTaskNode]:
+        """Add a task, with the status and times of its DB row.
+
+        :param nm: The task namespace.
+        :param key_hash: The task key hash.
+        :returns: The node, or None if the task is not in the DB.
+        """
+        db_obj = nm.get_task_db_obj(key_hash)
+        if db_obj is None:
+            return None
+        task = nm.get_task(hash_str=key_hash)
+        if task is None:
+            return None
+
+        node = SakTaskNode(
+            task=task,
+            status=db_obj.status,
+            start_time=db_obj.start_time,
+            end_time=db_obj.end_time,
+            upstream=[tuple(x) for x in task.get_upstream_keys()],  # type: ignore
+        )
+        self.nodes[(nm.name, key_hash)] = node
+        return node
+
+    def get_topological_order(self) -> List[SakTaskRef]:
+        """Sort the tasks so each one comes after its upstream tasks.
+
+        :returns: The task refs.
+        """
+        upstream_count = {ref: len(x.upstream) for ref, x in self.nodes.items()}
+        ready: Deque[SakTaskRef] = deque(
+            ref for ref, count in upstream_count.items() if count == 0
+        )
+
+        ret = []
+        while ready:
+            ref = ready.popleft()
+            ret.append(ref)
+            for downstream in self.nodes[ref].downstream:
+                upstream_count[downstream] -= 1
+                if upstream_count[downstream] == 0:
+                    ready.append(downstream)
+
+        if len(ret) != len(self.nodes):
+            cycle = sorted(ref for ref, count in upstream_count.items() if count > 0)
+            raise Exception(f"The task dependencies have a cycle between {cycle}")
+        return ret
+
+    def get_descendants(self, refs: Set[SakTaskRef]) -> Set[SakTaskRef]:
+        ret: Set[SakTaskRef] = set()
+        stack = list(refs)
+        while stack:
+            for downstream in self.nodes[stack.pop()].downstream:
+                if downstream not in ret:
+                    ret.add(downstream)
+                    stack.append(downstream)
+        return ret
+
+    def plan(self) -> Set[SakTaskRef]:
+        """Find the tasks to run.
+
+        The tasks that succeeded after all their upstream tasks finished are up
+        to date, unless an upstream task has to run again. The failed tasks run
+        again.
+
+        :returns: The refs of the tasks to run.
+        """
+        to_run: Set[SakTaskRef] = set()
+        for ref in self.get_topological_order():
+            node = self.nodes[ref]
+
+            changed = any(x in to_run for x in node.upstream) or any(
+                (x.end_time is not None)
+                and ((node.start_time is None) or (x.end_time > node.start_time))
+                for x in [self.nodes[x] for x in node.upstream]
+            )
+            if changed or (node.status != SakTaskStatus.SUCCESS):
+                to_run.add(ref)
+        return to_run
+
+
+def build_dag(namespaces: List[SakTasksNamespace]) -> SakTaskDag:
+    """Build the DAG of the tasks of the namespaces, from the DB.
+
+    The upstream tasks in other namespaces are added too, their namespaces have
+    to be registered.
+
+    :param namespaces: The namespaces whose tasks to add.
+    :returns: The DAG.
+    """
+    ret = SakTaskDag()
+
+    nms: Dict[str, SakTasksNamespace] = dict(NAMESPACE)
+    nms.update({x.name: x for x in namespaces})
+
+    refs: List[SakTaskRef] = []
+    for nm in namespaces:
+        refs += [(nm.name, x.key_hash) for x in nm.get_task_db_objs()]
+
+    while refs:
+        ref = refs.pop()
+        if ref in ret.nodes:
+            continue
+
+        name, key_hash = ref
+        if name not in nms:
+            raise Exception(f"The namespace {name} is not registered")
+        node = ret.add_task(nms[name], key_hash)
+        if node is None:
+            raise Exception(f"The task {key_hash} of {name} is not in the DB")
+        refs += [x for x in node.upstream if x not in ret.nodes]
+
+    for ref, node in ret.nodes.items():
+        for upstream in node.upstream:
+            ret.nodes[upstream].downstream.append(ref)
+    return ret
+
+
+def _run_node(
+    ref: SakTaskRef, node: SakTaskNode, run_kwargs: Optional[Dict[str, Any]]
+) -> Optional[bool]:
+    task = node.task
+    nm = task.namespace
+
+    # The claim keeps other runners from running the task at the same time.
+    if not nm.claim_task(ref[1]):
+        nm.storage.scoped_session_obj.remove()
+        return None
+
+    status = SakTaskStatus.FAIL
+    try:
+        try:
+            with task.lock:
+                task.rerun(**(run_kwargs or {}))
+        except Exception:
+            # Already in the task log, and its status is FAIL.
+            pass
+
+        try:
+            task.sync_db(task.ga_obj.data)
+        except Exception:
+            print(80 * "-")
+            traceback.print_exc(file=sys.stdout)
+            print(80 * "-")
+        status = task.get_status()
+    finally:
+        # sync_db already stored the status, unless it failed.
+        nm.release_claims([ref[1]], status=status)
+        nm.storage.scoped_session_obj.remove()
+    return status == SakTaskStatus.SUCCESS
+
+
+def run_dag(
+    dag: SakTaskDag, jobs: int = 0, run_kwargs: Optional[Dict[str, Any]] = None
+) -> SakTaskDagResult:
+    """Run the tasks of a DAG in a pool of threads, as soon as they are ready.
+
+    A task starts when all its upstream tasks succeed, without waiting for the
+    other tasks of the same depth. The up to date tasks are skipped, and the
+    tasks after a failure are cancelled. The tasks RUNNING in another runner
+    are not run, and the tasks after them are cancelled. On SIGINT, the running
+    tasks finish, and the ones that did not start are cancelled.
+
+    :param dag: The DAG, see build_dag.
+    :param jobs: The number of parallel tasks, 0 for the number of CPUs.
+    :param run_kwargs: The arguments of the task runs.
+    :returns: The tasks by outcome.
+    """
+    from tqdm import tqdm  # type: ignore
+
+    jobs = jobs or multiprocessing.cpu_count()
+
+    to_run = dag.plan()
+
+    ret = SakTaskDagResult()
+    ret.skipped = [x for x in dag.nodes if x not in to_run]
+
+    upstream_count = {
+        ref: len([x for x in dag.nodes[ref].upstream if x in to_run]) for ref in to_run
+    }
+    ready = [ref for ref, count in upstream_count.items() if count == 0]
+    futures: Dict["Future[Optional[bool]]", SakTaskRef] = {}
+
+    def _cancel_descendants(ref: SakTaskRef) -> None:
+        cancelled = dag.get_descendants({ref}) & set(upstream_count)
+        ret.cancelled += cancelled
+        progress.update(len(cancelled))
+        for x in cancelled:
+            upstream_count.pop(x)
+
+    # The task logs are the output buffers of the worker threads.
+    old_stdout, old_stderr = sys.stdout, sys.stderr
+    register_threaded_stdout_and_stderr_tee(redirect_only=(not VERBOSE))
+
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    progress = tqdm(desc="Run DAG", total=len(to_run), file=STDOUT)
+    try:
+        while ready or futures:
+            for ref in ready:
+                futures[
+                    executor.submit(_run_node, ref, dag.nodes[ref], run_kwargs)
+                ] = ref
+            ready = []
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                ref = futures.pop(future)
+                upstream_count.pop(ref)
+                progress.update(1)
+                success = future.result()
+                if not success:
+                    (ret.running if success is None else ret.fail).append(ref)
+                    _cancel_descendants(ref)
+                    continue
+
+                ret.success.append(ref)
+                for downstream in dag.nodes[ref].downstream:
+                    if downstream not in upstream_count:
+                        continue
+                    upstream_count[downstream] -= 1
+                    if upstream_count[downstream] == 0:
+                        ready.append(downstream)
+    except KeyboardInterrupt:
+        ret.interrupted = True
+        for future in futures:
+            future.cancel()
+        print("Interrupted, waiting for the running tasks.")
+    finally:
+        executor.shutdown(wait=True)
+        progress.close()
+        sys.stdout, sys.stderr = old_stdout, old_stderr
+
+    if ret.interrupted:
+        for future, ref in futures.items():
+            if future.cancelled():
+                continue
+            upstream_count.pop(ref)
+            success = future.result()
+            if success is None:
+                ret.running.append(ref)
+            else:
+                (ret.success if success else ret.fail).append(ref)
+
+        # The tasks that did not start, submitted or not.
+        ret.cancelled += [x for x in dag.get_topological_order() if x in upstream_count]
+    return ret
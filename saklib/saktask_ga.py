@@ -7,21 +7,26 @@ __license__ = "MIT"
 __maintainer__ = "Fernando Witt"
 __email__ = "ferawitt@gmail.com"
 
+import base64
+import functools
 import hashlib
 import json
+import os
 import re
 import subprocess
 import sys
+import threading
+import time
 import traceback
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Optional
-
-import pygit2  # type: ignore
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 from saklib.sakhash import make_hash_sha1
-from saklib.saktask_model import SakTaskStatus
+from saklib.saktask_status import SakTaskStatus
+
+GIT_MODE_TREE = b"40000"
 
 
 def get_ga_key(key: str) -> str:
@@ -38,8 +43,15 @@ def ga_key_to_key_file(key: str) -> str:
     return ret
 
 
+def ga_key_file_to_journal_file(key_file: str) -> str:
+    # The journal flattens the paths, and escapes the underscores to keep it unique.
+    return key_file.replace("_", "__").replace("/", "_")
+
+
 def ga_key_file_to_key(key_file: str) -> str:
-    return Path(key_file).name.replace("SHA256E-s0--", "").replace(".log.met", "")
+    # Without pathlib, it is called for each changed key of the sync.
+    name = key_file.rpartition("/")[2]
+    return name.replace("SHA256E-s0--", "").replace(".log.met", "")
 
 
 @dataclass
@@ -93,6 +105,28 @@ class SakTaskGitAnnexData:
         return ret
 
 
+def git_annex_metadata_fields(data: SakTaskGitAnnexData) -> Dict[str, List[str]]:
+    fields: Dict[str, List[str]] = {}
+    if data.key_hash is not None:
+        fields["key_hash"] = [json.dumps(data.key_hash)]
+    if data.namespace is not None:
+        fields["namespace"] = [json.dumps(data.namespace)]
+
+    if data.key_data is not None:
+        fields["key_data"] = [json.dumps(data.key_data)]
+    if data.user_data is not None:
+        fields["user_data"] = [json.dumps(data.user_data)]
+    if data.start_time is not None:
+        fields["start_time"] = [data.start_time.isoformat()]
+    if data.end_time is not None:
+        fields["end_time"] = [data.end_time.isoformat()]
+    if data.status is not None:
+        fields["status"] = [json.dumps(data.status.name)]
+    if data.log is not None:
+        fields["log"] = [json.dumps(data.log)]
+    return fields
+
+
 def git_annex_parse_metadata(ga_metadata: Dict[str, Any]) -> SakTaskGitAnnexData:
     out = SakTaskGitAnnexData()
 
@@ -125,15 +159,143 @@ def git_annex_parse_metadata(ga_metadata: Dict[str, Any]) -> SakTaskGitAnnexData
     return out
 
 
+def _decode_metadata_value(value: bytes) -> bytes:
+    # The values with whitespaces, or starting with "!", are in base64.
+    if value.startswith(b"!"):
+        return base64.b64decode(value[1:])
+    return value
+
+
+def _format_last_changed(timestamp: float) -> str:
+    return time.strftime("%Y-%m-%d@%H-%M-%S", time.gmtime(timestamp))
+
+
+def git_annex_parse_metadata_log(content: bytes) -> Dict[str, List[str]]:
+    """Parse a .log.met file, into the fields of "git annex metadata --json".
+
+    Each line has a timestamp and the values set (+) or unset (-) for some
+    fields, like "1507541153.566038914s status +PENDING -FAIL". The latest line
+    of each value wins, and the fields get their lastchanged dates.
+
+    :param content: The log file content.
+    :returns: The currently set values, by field.
+    """
+    lines = []
+    for line in content.splitlines():
+        clock, _, rest = line.partition(b" ")
+        try:
+            lines.append((float(clock.rstrip(b"s")), rest.split()))
+        except ValueError:
+            continue
+    lines.sort(key=lambda x: x[0])
+
+    # If each value is set or not, by field.
+    values: Dict[str, Dict[bytes, bool]] = {}
+    last_changed: Dict[str, float] = {}
+    for timestamp, words in lines:
+        field = ""
+        field_values: Optional[Dict[bytes, bool]] = None
+        for word in words:
+            sign = word[:1]
+            if (sign != b"+") and (sign != b"-"):
+                # The field names are case insensitive.
+                field = word.decode("utf-8").lower()
+                field_values = values.setdefault(field, {})
+            elif field_values is not None:
+                field_values[_decode_metadata_value(word[1:])] = sign == b"+"
+                last_changed[field] = timestamp
+
+    # The fields usually change together, format each date once.
+    dates = {x: _format_last_changed(x) for x in set(last_changed.values())}
+
+    ret: Dict[str, List[str]] = {}
+    for field, field_values in values.items():
+        current = [x.decode("utf-8") for x, is_set in field_values.items() if is_set]
+        if current:
+            ret[field] = sorted(current)
+            ret[field + "-lastchanged"] = [dates[last_changed[field]]]
+    if lines:
+        timestamp = lines[-1][0]
+        ret["lastchanged"] = [dates.get(timestamp) or _format_last_changed(timestamp)]
+    return ret
+
+
+@functools.lru_cache(maxsize=None)
+def _tree_entry_re(oid_size: int) -> "re.Pattern[bytes]":
+    # The entries of the raw git tree objects: mode, name and binary object id,
+    # 20 bytes for SHA-1 repositories and 32 for SHA-256 ones.
+    return re.compile(rb"\d+ [^\0]*\0.{%d}" % oid_size, re.DOTALL)
+
+
+def _read_tree_entries(odb: Any, tree_id: Optional[str]) -> Set[bytes]:
+    if tree_id is None:
+        return set()
+    return set(_tree_entry_re(len(tree_id) // 2).findall(odb.read(tree_id)[1]))
+
+
+def iter_tree_diff(
+    odb: Any, old_tree_id: Optional[str], new_tree_id: Optional[str], prefix: str = ""
+) -> Iterator[str]:
+    """Iterate the paths of the files that differ between two git trees.
+
+    The raw tree objects are compared entry by entry, and only the subtrees that
+    changed are read, so the cost depends on the changes, not on the tree size.
+
+    :param odb: The pygit2 object database.
+    :param old_tree_id: The old tree, None for an empty tree.
+    :param new_tree_id: The new tree, None for an empty tree.
+    :param prefix: The path of the trees.
+    :returns: The added, changed and removed file paths.
+    """
+    old_entries = _read_tree_entries(odb, old_tree_id)
+    new_entries = _read_tree_entries(odb, new_tree_id)
+    # The object id size of the repository, from the hex ids of the trees.
+    oid_size = len(old_tree_id or new_tree_id or "") // 2
+
+    # The old and new subtree id, or file id, of each changed name.
+    changes: Dict[bytes, List[Optional[Tuple[bool, str]]]] = {}
+    for idx, entries in enumerate(
+        [old_entries - new_entries, new_entries - old_entries]
+    ):
+        for entry in entries:
+            mode, _, rest = entry.partition(b" ")
+            change = changes.setdefault(rest[: -(oid_size + 1)], [None, None])
+            change[idx] = (mode == GIT_MODE_TREE, rest[-oid_size:].hex())
+
+    for name, (old, new) in changes.items():
+        path = prefix + name.decode("utf-8", "surrogateescape")
+        old_tree = old[1] if (old is not None) and old[0] else None
+        new_tree = new[1] if (new is not None) and new[0] else None
+        if (old_tree is not None) or (new_tree is not None):
+            yield from iter_tree_diff(odb, old_tree, new_tree, path + "/")
+        if ((old is not None) and not old[0]) or ((new is not None) and not new[0]):
+            yield path
+
+
 class SakGitAnnexDriver:
     def __init__(self, repo_path: Path) -> None:
         self.repo_path = repo_path
-        self.repo = pygit2.Repository(self.repo_path)
         self.metada_p: Optional[subprocess.Popen[bytes]] = None
 
+        self._repo: Any = None
         self._cache: Dict[str, SakTaskGitAnnexData] = {}
 
+        # The git-annex branch commit, its tree, and if it can be read directly.
+        self._annex_tree: Optional[Tuple[str, Any, bool]] = None
+
+        # The batch process is shared by the threads of the task runners.
+        self._metadata_lock = threading.RLock()
+
+    @property
+    def repo(self) -> Any:
+        if self._repo is None:
+            import pygit2  # type: ignore
+
+            self._repo = pygit2.Repository(self.repo_path)
+        return self._repo
+
     def sync(self) -> None:
+        self._annex_tree = None
         cmd = ["git", "annex", "sync"]
         subprocess.run(
             cmd,
@@ -141,41 +303,103 @@ class SakGitAnnexDriver:
             check=True,
         )
 
-    def ga_key_metadata_hash(self, key: str) -> Optional[str]:
-        fname = ga_key_to_key_file(key)
-
-        content: Optional[bytes] = None
-
-        journal = (
-            self.repo_path / ".git" / "annex" / "journal" / fname.replace("/", "_")
+    def _get_journal_content(self, key_file: str) -> Optional[bytes]:
+        # Without pathlib, it is called for each key read.
+        journal = os.path.join(
+            self.repo_path,
+            ".git",
+            "annex",
+            "journal",
+            ga_key_file_to_journal_file(key_file),
         )
-        if journal.exists():
+        try:
             with open(journal, "rb") as f:
-                content = f.read()
+                return f.read()
+        except FileNotFoundError:
+            return None
 
-            hasher = hashlib.sha1()
-            hasher.update(b"Blob " + f"{len(content)}".encode() + b"\0" + content)
-            return hasher.hexdigest()
-        else:
-            return self._git_annex_get_path_blob(fname)
+    def _get_journal_hash(self, content: bytes) -> str:
+        hasher = hashlib.sha1()
+        hasher.update(b"Blob " + f"{len(content)}".encode() + b"\0" + content)
+        return hasher.hexdigest()
+
+    def _get_annex_tree(self) -> Tuple[Any, bool]:
+        # Cached by commit, it is looked up for each key of a sync. The remote
+        # branches are checked again by sync and get_current_git_hash.
+        commit_id = str(self.repo.lookup_reference("refs/heads/git-annex").target)
+        if (self._annex_tree is None) or (self._annex_tree[0] != commit_id):
+            tree = self.repo[commit_id].tree
+
+            # The remote branches not merged yet, and the private journal, are
+            # only taken into account by git-annex.
+            remote_ids = [
+                str(self.repo.lookup_reference(x).target)
+                for x in self.repo.references
+                if x.startswith("refs/remotes/") and x.endswith("/git-annex")
+            ]
+            private_journal = self.repo_path / ".git" / "annex" / "journal-private"
+            can_read = (not private_journal.exists()) and all(
+                (x == commit_id) or self.repo.descendant_of(commit_id, x)
+                for x in remote_ids
+            )
+            self._annex_tree = (commit_id, tree, can_read)
+        return self._annex_tree[1], self._annex_tree[2]
+
+    def ga_key_metadata_hash(self, key: str) -> Optional[str]:
+        fname = ga_key_to_key_file(key)
 
-        raise Exception(f"Failed to get content for metadata {key}")
+        content = self._get_journal_content(fname)
+        if content is not None:
+            return self._get_journal_hash(content)
+        return self._git_annex_get_path_blob(fname)
 
     def git_annex_get_metada(self, key: str) -> SakTaskGitAnnexData:
         ret = self.git_annex_set_metadata(key=key)
         return ret
 
     def _git_annex_get_path_blob(self, path: str) -> Optional[str]:
-        commit = self.repo.revparse_single("git-annex")
-        tree = commit.tree
+        tree, _ = self._get_annex_tree()
 
         try:
-            blob = tree / path
-        except Exception:
+            blob = tree[path]
+        except KeyError:
             return None
 
-        blob_hash = blob.hex
-        return blob_hash  # type: ignore
+        return str(blob.id)
+
+    def _git_annex_read_metadata(
+        self, key: str
+    ) -> Optional[Tuple[str, Callable[[], SakTaskGitAnnexData]]]:
+        """Read the metadata log of a key, from the journal or the git-annex branch.
+
+        The journal has the changes not committed to the branch yet, like the
+        ones of the batch process.
+
+        :param key: The task key hash.
+        :returns: The metadata hash and a function that parses the log, or None
+            if only git-annex can read it.
+        """
+        fname = ga_key_to_key_file(key)
+
+        content = self._get_journal_content(fname)
+        if content is not None:
+            journal_content = content
+            return self._get_journal_hash(content), lambda: git_annex_parse_metadata(
+                {"fields": git_annex_parse_metadata_log(journal_content)}
+            )
+
+        tree, can_read = self._get_annex_tree()
+        if not can_read:
+            return None
+        try:
+            blob = tree[fname]
+        except KeyError:
+            # Not in the branch, or not committed yet.
+            return None
+
+        return str(blob.id), lambda: git_annex_parse_metadata(
+            {"fields": git_annex_parse_metadata_log(blob.data)}
+        )
 
     def git_annex_drop_key(self, key: str) -> None:
         git_annex_repo = self.repo_path
@@ -194,26 +418,95 @@ class SakGitAnnexDriver:
             p.stdout is not None
         ), f"Failed to remove metadata for {key} in {str(git_annex_repo)}"
 
-    def git_annex_set_metadata(
-        self,
-        key: str,
-        data: Optional[SakTaskGitAnnexData] = None,
-        change_callback: Optional[Callable[[SakTaskGitAnnexData], None]] = None,
-    ) -> SakTaskGitAnnexData:
-        git_annex_repo = self.repo_path
-
-        # TODO(witt): Maybe this should be locked!!!!
-
+    def _get_metadata_process(self) -> "subprocess.Popen[bytes]":
         if self.metada_p is None:
             cmd = ["git", "annex", "metadata", "--json", "--batch", "--fast"]
             self.metada_p = subprocess.Popen(
                 cmd,
                 stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE,
-                cwd=git_annex_repo,
+                stderr=subprocess.DEVNULL,
+                cwd=self.repo_path,
+            )
+        return self.metada_p
+
+    def git_annex_set_metadata_batch(
+        self, items: List[Tuple[str, SakTaskGitAnnexData]]
+    ) -> List[SakTaskGitAnnexData]:
+        """Write the metadata of many keys in one pipelined batch.
+
+        Unlike git_annex_set_metadata, the current metadata is not read first, and
+        the requests are written by a thread while the responses are read, so
+        there is no round trip per key.
+
+        :param items: The keys and the metadata to set.
+        :returns: The resulting metadata of each key, in the same order.
+        """
+        with self._metadata_lock:
+            return self._git_annex_set_metadata_batch(items)
+
+    def _git_annex_set_metadata_batch(
+        self, items: List[Tuple[str, SakTaskGitAnnexData]]
+    ) -> List[SakTaskGitAnnexData]:
+        p = self._get_metadata_process()
+        stdin = p.stdin
+        stdout = p.stdout
+        assert (stdin is not None) and (
+            stdout is not None
+        ), f"Failed to write metadata in {str(self.repo_path)}"
+
+        lines = [
+            json.dumps({"key": get_ga_key(k), "fields": git_annex_metadata_fields(x)})
+            + "\n"
+            for k, x in items
+        ]
+        errors: List[Exception] = []
+
+        def write() -> None:
+            try:
+                for line in lines:
+                    stdin.write(line.encode("utf-8"))
+                stdin.flush()
+            except Exception as e:
+                errors.append(e)
+
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+
+        ret = []
+        for _ in lines:
+            out_data_bytes = stdout.readline()
+            if not out_data_bytes:
+                break
+            ret.append(git_annex_parse_metadata(json.loads(out_data_bytes)))
+        writer.join()
+
+        if errors:
+            raise errors[0]
+        if len(ret) != len(lines):
+            raise Exception(
+                f"git annex metadata stopped after {len(ret)} of {len(lines)} keys"
             )
+        return ret
 
-        p = self.metada_p
+    def git_annex_set_metadata(
+        self,
+        key: str,
+        data: Optional[SakTaskGitAnnexData] = None,
+        change_callback: Optional[Callable[[SakTaskGitAnnexData], None]] = None,
+    ) -> SakTaskGitAnnexData:
+        with self._metadata_lock:
+            return self._git_annex_set_metadata(key, data, change_callback)
+
+    def _git_annex_set_metadata(
+        self,
+        key: str,
+        data: Optional[SakTaskGitAnnexData] = None,
+        change_callback: Optional[Callable[[SakTaskGitAnnexData], None]] = None,
+    ) -> SakTaskGitAnnexData:
+        git_annex_repo = self.repo_path
+
+        p = self._get_metadata_process()
 
         assert (
             (p is not None) and (p.stdin is not None) and (p.stdout is not None)
@@ -227,23 +520,7 @@ class SakGitAnnexDriver:
         if data is not None:
             orig_data = self.git_annex_get_metada(key)
 
-            if data.key_hash is not None:
-                in_data["fields"]["key_hash"] = [json.dumps(data.key_hash)]
-            if data.namespace is not None:
-                in_data["fields"]["namespace"] = [json.dumps(data.namespace)]
-
-            if data.key_data is not None:
-                in_data["fields"]["key_data"] = [json.dumps(data.key_data)]
-            if data.user_data is not None:
-                in_data["fields"]["user_data"] = [json.dumps(data.user_data)]
-            if data.start_time is not None:
-                in_data["fields"]["start_time"] = [data.start_time.isoformat()]
-            if data.end_time is not None:
-                in_data["fields"]["end_time"] = [data.end_time.isoformat()]
-            if data.status is not None:
-                in_data["fields"]["status"] = [json.dumps(data.status.name)]
-            if data.log is not None:
-                in_data["fields"]["log"] = [json.dumps(data.log)]
+            in_data["fields"] = git_annex_metadata_fields(data)
 
             data = git_annex_parse_metadata(in_data)
 
@@ -274,12 +551,26 @@ class SakGitAnnexDriver:
                     if orig_data._hashes._log == data._hashes._log:
                         in_data["fields"].pop("log")
 
-        # Get from cache.
+        # Get from cache, or parse the metadata log without git-annex.
         if not in_data["fields"]:
-            blob_hash = self.ga_key_metadata_hash(key)
+            read = self._git_annex_read_metadata(key)
+            blob_hash = read[0] if read is not None else self.ga_key_metadata_hash(key)
             if (blob_hash is not None) and (blob_hash in self._cache):
                 return self._cache[blob_hash]
 
+            if read is not None:
+                try:
+                    out = read[1]()
+                except Exception:
+                    # Let git-annex read it, below.
+                    out = None
+
+                if out is not None:
+                    if change_callback is not None:
+                        change_callback(out)
+                    self._cache[read[0]] = out
+                    return out
+
         # If has to set data, dispach to git annex.
         in_data_str = json.dumps(in_data) + "\n"
 
@@ -317,21 +608,10 @@ class SakGitAnnexDriver:
 
     def get_current_git_hash(self) -> Optional[str]:
         bname = "git-annex"
+        self._annex_tree = None
         try:
-            cmd = ["git", "log", "-1", bname]
-            p = subprocess.run(
-                cmd,
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.DEVNULL,
-                cwd=self.repo_path,
-            )
-            text = p.stdout.strip().decode("utf-8")
-            r: List[str] = re.findall("commit ([a-f0-9]+)", text)
-            if r:
-                return r[0]
-            else:
-                return None
+            commit = self.repo.revparse_single(bname)
+            return str(commit.id)
         except Exception as e:
             print(80 * "-")
             traceback.print_exc(file=sys.stdout)
@@ -342,30 +622,44 @@ class SakGitAnnexDriver:
             )
             return None
 
+    def iter_changed_keys(
+        self, current_commit: str, last_commit: Optional[str] = None
+    ) -> Iterator[str]:
+        """Iterate the keys whose metadata changed between two git-annex commits.
+
+        :param current_commit: The current git-annex branch commit.
+        :param last_commit: The commit of the last sync, None for all the keys.
+        :returns: The changed keys, as the trees are compared.
+        """
+        new_tree = str(self.repo[current_commit].tree_id)
+        old_tree = None
+        if last_commit is not None:
+            try:
+                old_tree = str(self.repo[last_commit].tree_id)
+            except (KeyError, ValueError):
+                # The last synced commit is gone, like after a rebase, sync all.
+                old_tree = None
+
+        if old_tree is None:
+            # A full listing, the diff of libgit2 is faster than the Python walk.
+            import pygit2  # type: ignore
+
+            diff = self.repo[new_tree].diff_to_tree(
+                swap=True, flags=pygit2.GIT_DIFF_SKIP_BINARY_CHECK
+            )
+            paths: Iterator[str] = (x.new_file.path for x in diff.deltas)
+        else:
+            paths = iter_tree_diff(self.repo.odb, old_tree, new_tree)
+
+        for path in paths:
+            if path.endswith(".log.met"):
+                yield ga_key_file_to_key(path)
+
     def get_all_keys(
         self, current_commit: str, last_commit: Optional[str] = None
     ) -> Optional[List[str]]:
         try:
-            diff_hashes = ""
-            if last_commit is not None:
-                diff_hashes = last_commit + ".."
-            diff_hashes += current_commit
-
-            cmd = ["git", "diff", "--name-only", diff_hashes]
-
-            p = subprocess.run(
-                cmd,
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.DEVNULL,
-                cwd=self.repo_path,
-            )
-            text = p.stdout.strip().decode("utf-8")
-            return [
-                ga_key_file_to_key(x)
-                for x in text.splitlines()
-                if x.endswith(".log.met")
-            ]
+            return list(self.iter_changed_keys(current_commit, last_commit))
         except Exception as e:
             print(80 * "-")
             traceback.print_exc(file=sys.stdout)
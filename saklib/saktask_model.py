@@ -7,30 +7,19 @@ __license__ = "MIT"
 __maintainer__ = "Fernando Witt"
 __email__ = "ferawitt@gmail.com"
 
-import enum
 from typing import Any, Dict
 
-# Import heavy modules.
-import lazy_import  # type: ignore
-
-lazy_import.lazy_module("sqlalchemy")
-
+# NOTE: This module imports sqlalchemy, so import it only when the DB is used.
 # from sqlalchemy import DateTime, Enum, String
 import sqlalchemy
 from sqlalchemy.orm import declarative_base, mapped_column
 
+from saklib.saktask_status import SakTaskStatus  # noqa: F401
+
 Base = declarative_base()
 
 TABLES: Dict[str, Any] = {}
 
-
-class SakTaskStatus(enum.Enum):
-    PENDING = 1
-    ABORTED = 2
-    FAIL = 3
-    SUCCESS = 4
-
-
 SAK_TASK_DB = "sak_tasks"
 
 
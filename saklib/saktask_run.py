@@ -0,0 +1,136 @@
+# -*- coding: UTF-8 -*-
+
+__author__ = "Fernando Witt"
+__credits__ = ["Fernando Witt"]
+
+__license__ = "MIT"
+__maintainer__ = "Fernando Witt"
+__email__ = "ferawitt@gmail.com"
+
+import multiprocessing
+import sys
+import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from saklib.sakio import register_threaded_stdout_and_stderr_tee
+from saklib.saktask import SakTasksNamespace
+from saklib.saktask_io import STDOUT, VERBOSE
+from saklib.saktask_status import SakTaskStatus
+
+
+@dataclass
+class SakTaskRunResult:
+    """The number of tasks run by run_tasks, by final status."""
+
+    counts: Dict[str, int] = field(default_factory=dict)
+    interrupted: bool = False
+
+    def add(self, status: SakTaskStatus) -> None:
+        self.counts[status.name] = self.counts.get(status.name, 0) + 1
+
+
+def run_claimed_task(
+    nm: SakTasksNamespace, key: str, run_kwargs: Optional[Dict[str, Any]] = None
+) -> SakTaskStatus:
+    """Run a task claimed by claim_tasks, and release its claim with its status.
+
+    The task output is captured in its log by the per thread buffers of sakio.
+
+    :param nm: The task namespace.
+    :param key: The claimed task key.
+    :param run_kwargs: The arguments of the task run.
+    :returns: The final task status.
+    """
+    # The tasks that fail to load are released as FAIL, not to claim them again.
+    status = SakTaskStatus.FAIL
+    try:
+        task = nm.get_task(hash_str=key)
+        if task is None:
+            print(f"Failed to load the task {key} of {nm.name}.")
+            return status
+
+        try:
+            with task.lock:
+                task.run(**(run_kwargs or {}))
+        except Exception:
+            # Already in the task log, and its status is FAIL.
+            pass
+        task.sync_db(task.ga_obj.data)
+        status = task.get_status()
+    except Exception:
+        print(80 * "-")
+        traceback.print_exc(file=sys.stdout)
+        print(80 * "-")
+    finally:
+        nm.release_claims([key], status=status)
+        nm.storage.scoped_session_obj.remove()
+    return status
+
+
+def run_tasks(
+    nm: SakTasksNamespace,
+    jobs: int = 0,
+    limit: Optional[int] = None,
+    run_kwargs: Optional[Dict[str, Any]] = None,
+) -> SakTaskRunResult:
+    """Run the PENDING tasks of a namespace in a pool of threads.
+
+    The tasks are claimed as the workers become free, so several runners can
+    share a namespace. On SIGINT, the claims of the tasks that did not start are
+    released, and the running ones finish.
+
+    :param nm: The task namespace.
+    :param jobs: The number of parallel tasks, 0 for the number of CPUs.
+    :param limit: The maximum number of tasks to run.
+    :param run_kwargs: The arguments of the task runs.
+    :returns: The number of tasks run, by status.
+    """
+    from tqdm import tqdm  # type: ignore
+
+    jobs = jobs or multiprocessing.cpu_count()
+
+    ret = SakTaskRunResult()
+    futures: Dict["Future[SakTaskStatus]", str] = {}
+    started = 0
+
+    # The task logs are the output buffers of the worker threads.
+    old_stdout, old_stderr = sys.stdout, sys.stderr
+    register_threaded_stdout_and_stderr_tee(redirect_only=(not VERBOSE))
+
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    progress = tqdm(desc=f"Run {nm.name}", file=STDOUT)
+    try:
+        while True:
+            free = jobs - len(futures)
+            if limit is not None:
+                free = min(free, limit - started)
+            keys: List[str] = nm.claim_tasks(free) if free > 0 else []
+            for key in keys:
+                futures[executor.submit(run_claimed_task, nm, key, run_kwargs)] = key
+            started += len(keys)
+
+            if not futures:
+                break
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                futures.pop(future)
+                ret.add(future.result())
+                progress.update(1)
+    except KeyboardInterrupt:
+        ret.interrupted = True
+        unstarted = [key for future, key in futures.items() if future.cancel()]
+        nm.release_claims(unstarted)
+        print(f"Interrupted, released {len(unstarted)} claims.")
+    finally:
+        executor.shutdown(wait=True)
+        progress.close()
+        sys.stdout, sys.stderr = old_stdout, old_stderr
+
+    if ret.interrupted:
+        for future in futures:
+            if not future.cancelled():
+                ret.add(future.result())
+    return ret
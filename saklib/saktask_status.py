@@ -0,0 +1,19 @@
+# -*- coding: UTF-8 -*-
+
+__author__ = "Fernando Witt"
+__credits__ = ["Fernando Witt"]
+
+__license__ = "MIT"
+__maintainer__ = "Fernando Witt"
+__email__ = "ferawitt@gmail.com"
+
+import enum
+
+
+class SakTaskStatus(enum.Enum):
+    PENDING = 1
+    ABORTED = 2
+    FAIL = 3
+    SUCCESS = 4
+    # Claimed by a task runner, only stored in the DB, see claim_tasks.
+    RUNNING = 5
@@ -0,0 +1,459 @@
+# -*- coding: UTF-8 -*-
+
+__author__ = "Fernando Witt"
+__credits__ = ["Fernando Witt"]
+
+__license__ = "MIT"
+__maintainer__ = "Fernando Witt"
+__email__ = "ferawitt@gmail.com"
+
+import json
+import math
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from importlib.abc import MetaPathFinder
+from importlib.machinery import ModuleSpec
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+# Set by the launcher with the time.time_ns() before starting the interpreter.
+SAK_LAUNCH_TIME_ENV = "SAK_LAUNCH_TIME_NS"
+
+# Set to record the spans of every command run in the trace file.
+SAK_TRACE_ENV = "SAK_TRACE"
+
+# The trace file is rotated when bigger than this number of bytes.
+TRACE_MAX_SIZE = int(os.environ.get("SAK_TRACE_MAX_SIZE", str(10 * 1024 * 1024)))
+
+# Number of rotated trace files to keep.
+TRACE_BACKUPS = 3
+
+
+def is_startup_profile() -> bool:
+    return os.environ.get("SAK_PROFILE", None) == "startup"
+
+
+def is_trace() -> bool:
+    return os.environ.get(SAK_TRACE_ENV, "") not in ["", "0", "NO"]
+
+
+class SakTimings:
+    """Collect the duration of the named steps of a SAK execution."""
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.start = time.perf_counter()
+        self.records: List[Dict[str, Any]] = []
+        # The path of the executed command, like "sak show version".
+        self.command: Optional[str] = None
+        # The steps can be timed from several threads, like the plugin loading.
+        self._local = threading.local()
+
+    def reset(self) -> None:
+        """Start timing a new run, like the requests of the daemon."""
+        self.start = time.perf_counter()
+        self.records = []
+        self.command = None
+
+    @property
+    def _depth(self) -> int:
+        return int(getattr(self._local, "depth", 0))
+
+    @_depth.setter
+    def _depth(self, value: int) -> None:
+        self._local.depth = value
+
+    @property
+    def _children(self) -> List[float]:
+        # The duration of the children of each running step, for the self time.
+        if not hasattr(self._local, "children"):
+            self._local.children = []
+        return self._local.children  # type: ignore
+
+    def add(
+        self, category: str, name: str, start: float, duration: float
+    ) -> Dict[str, Any]:
+        record = {
+            "category": category,
+            "name": name,
+            "start": (start - self.start) * 1000.0,
+            "duration": duration * 1000.0,
+            "depth": self._depth,
+        }
+        self.records.append(record)
+        return record
+
+    @contextmanager
+    def timing(self, category: str, name: str, **attrs: Any) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        self._depth += 1
+        self._children.append(0.0)
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            children = self._children.pop()
+            duration = time.perf_counter() - start
+            if self._children:
+                self._children[-1] += duration
+            record = self.add(category, name, start, duration)
+            record["self"] = (duration - children) * 1000.0
+            if attrs:
+                record["attrs"] = attrs
+
+
+timings = SakTimings()
+
+
+def timing(category: str, name: str) -> Any:
+    """Time a step, if the startup profile or the trace is enabled.
+
+    :param category: The step category, like "plugin" or "argparse".
+    :param name: The step name.
+    :returns: The timing context manager.
+    """
+    return timings.timing(category, name)
+
+
+def span(name: str, **attrs: Any) -> Any:
+    """Time a block of code, recorded in the trace when SAK_TRACE is set.
+
+    Usage:
+        with span("fetch", url=url):
+            ...
+
+    :param name: The span name, the runs of a command are aggregated by name.
+    :param attrs: JSON serializable details about this span.
+    :returns: The span context manager.
+    """
+    return timings.timing("span", name, **attrs)
+
+
+class _SakImportTimer(MetaPathFinder):
+    """Meta path finder that times the execution of each imported module."""
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+
+    @property
+    def _finding(self) -> List[str]:
+        if not hasattr(self._local, "finding"):
+            self._local.finding = []
+        return self._local.finding  # type: ignore
+
+    @property
+    def _stack(self) -> List[List[float]]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack  # type: ignore
+
+    def find_spec(
+        self,
+        fullname: str,
+        path: Optional[Sequence[str]],
+        target: Any = None,
+    ) -> Optional[ModuleSpec]:
+        if fullname in self._finding:
+            return None
+
+        self._finding.append(fullname)
+        try:
+            spec = None
+            for finder in sys.meta_path:
+                if (finder is self) or not hasattr(finder, "find_spec"):
+                    continue
+                spec = finder.find_spec(fullname, path, target)
+                if spec is not None:
+                    break
+        finally:
+            self._finding.remove(fullname)
+
+        loader = spec.loader if spec is not None else None
+        # Loaders shared between modules, like the builtin ones, are classes.
+        if (loader is not None) and not isinstance(loader, type):
+            if hasattr(loader, "exec_module"):
+                loader.exec_module = self._timed_exec_module(  # type: ignore
+                    fullname, loader.exec_module
+                )
+        return spec
+
+    def _timed_exec_module(self, fullname: str, exec_module: Any) -> Any:
+        def _exec_module(module: Any) -> None:
+            start = time.perf_counter()
+            # Children durations, to compute the self time.
+            self._stack.append([0.0])
+            try:
+                exec_module(module)
+            finally:
+                children = self._stack.pop()[0]
+                duration = time.perf_counter() - start
+                if self._stack:
+                    self._stack[-1][0] += duration
+                record = timings.add("import", fullname, start, duration)
+                record["self"] = (duration - children) * 1000.0
+
+        return _exec_module
+
+
+def enable(imports: bool = True) -> None:
+    """Enable the timings collection.
+
+    :param imports: Also time the imported modules.
+    """
+    timings.enabled = True
+    if imports and not any(isinstance(x, _SakImportTimer) for x in sys.meta_path):
+        sys.meta_path.insert(0, _SakImportTimer())
+
+
+def _get_launcher_duration(total: float) -> Optional[float]:
+    launch_time = os.environ.get(SAK_LAUNCH_TIME_ENV, None)
+    if launch_time is None:
+        return None
+    start_ns = time.time_ns() - int(total * 1e6)
+    return max(0.0, (start_ns - int(launch_time)) / 1e6)
+
+
+def get_report(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Summarize the collected timings.
+
+    :param argv: The profiled command arguments.
+    :returns: The JSON serializable report.
+    """
+    total = (time.perf_counter() - timings.start) * 1000.0
+    launcher = _get_launcher_duration(total)
+
+    steps = [x for x in timings.records if x["category"] != "import"]
+    imports = [x for x in timings.records if x["category"] == "import"]
+
+    plugins: Dict[str, float] = {}
+    for step in steps:
+        if step["category"] == "plugin":
+            plugin_name = step["name"].split(" ")[0]
+            plugins[plugin_name] = plugins.get(plugin_name, 0.0) + step["duration"]
+
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "argv": argv if argv is not None else sys.argv[1:],
+        "total": total,
+        "launcher": launcher,
+        "imports_total": sum(x["self"] for x in imports),
+        "plugins": plugins,
+        "steps": sorted(steps, key=lambda x: x["start"]),
+        "imports": sorted(imports, key=lambda x: -x["duration"]),
+    }
+
+
+def report_to_table(report: Dict[str, Any], max_imports: int = 20) -> str:
+    """Render a report as a text table.
+
+    :param report: The report from get_report.
+    :param max_imports: The number of slowest imports to show.
+    :returns: The table.
+    """
+    lines = []
+    lines.append("Command: sak %s" % " ".join(report["argv"]))
+    lines.append("%-60s %10s" % ("Step", "Time (ms)"))
+    lines.append("-" * 71)
+    if report["launcher"] is not None:
+        lines.append("%-60s %10.1f" % ("launcher", report["launcher"]))
+    for step in report["steps"]:
+        name = "  " * step["depth"] + "%s: %s" % (step["category"], step["name"])
+        lines.append("%-60s %10.1f" % (name[:60], step["duration"]))
+    lines.append("%-60s %10.1f" % ("imports (self time)", report["imports_total"]))
+    lines.append("%-60s %10.1f" % ("total", report["total"]))
+
+    if report["plugins"]:
+        lines.append("")
+        lines.append("%-60s %10s" % ("Plugin", "Time (ms)"))
+        lines.append("-" * 71)
+        for name, duration in sorted(report["plugins"].items(), key=lambda x: -x[1]):
+            lines.append("%-60s %10.1f" % (name, duration))
+
+    if report["imports"]:
+        lines.append("")
+        lines.append("%-49s %10s %10s" % ("Import", "Self (ms)", "Cumul (ms)"))
+        lines.append("-" * 71)
+        for imp in report["imports"][:max_imports]:
+            lines.append(
+                "%-49s %10.1f %10.1f" % (imp["name"][:49], imp["self"], imp["duration"])
+            )
+    return "\n".join(lines) + "\n"
+
+
+def save_report(history_path: Path, report: Dict[str, Any]) -> None:
+    """Append a report to the history, keeping only the slowest imports.
+
+    :param history_path: The JSON lines history file.
+    :param report: The report from get_report.
+    """
+    entry = dict(report)
+    entry["imports"] = entry["imports"][:20]
+    history_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(history_path, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+def load_history(history_path: Path) -> List[Dict[str, Any]]:
+    if not history_path.exists():
+        return []
+    ret = []
+    with open(history_path) as f:
+        for line in f:
+            try:
+                ret.append(json.loads(line))
+            except ValueError:
+                continue
+    return ret
+
+
+def get_trace_entry(
+    argv: Optional[List[str]] = None, status: int = 0
+) -> Dict[str, Any]:
+    """Describe the spans of the current run.
+
+    :param argv: The command arguments.
+    :param status: The command exit status.
+    :returns: The JSON serializable trace entry.
+    """
+    total = (time.perf_counter() - timings.start) * 1000.0
+    spans = [x for x in timings.records if x["category"] != "import"]
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "pid": os.getpid(),
+        "cmd": timings.command or "sak",
+        "argv": argv if argv is not None else sys.argv[1:],
+        "status": status,
+        "total": total,
+        "launcher": _get_launcher_duration(total),
+        "spans": sorted(spans, key=lambda x: x["start"]),
+    }
+
+
+def _get_backup_path(trace_path: Path, index: int) -> Path:
+    return trace_path.with_name(f"{trace_path.name}.{index}")
+
+
+def save_trace(
+    trace_path: Path,
+    entry: Dict[str, Any],
+    max_size: int = TRACE_MAX_SIZE,
+    backups: int = TRACE_BACKUPS,
+) -> None:
+    """Append an entry to the trace, rotating the trace file when too big.
+
+    :param trace_path: The JSON lines trace file.
+    :param entry: The entry from get_trace_entry.
+    :param max_size: The size, in bytes, to rotate the trace file.
+    :param backups: The number of rotated trace files to keep.
+    """
+    trace_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        if trace_path.stat().st_size >= max_size:
+            for index in range(backups - 1, 0, -1):
+                backup_path = _get_backup_path(trace_path, index)
+                if backup_path.exists():
+                    os.replace(backup_path, _get_backup_path(trace_path, index + 1))
+            if backups > 0:
+                os.replace(trace_path, _get_backup_path(trace_path, 1))
+            else:
+                trace_path.unlink()
+    except FileNotFoundError:
+        # Not created yet, or rotated by another run.
+        pass
+
+    with open(trace_path, "a") as f:
+        f.write(json.dumps(entry, default=str) + "\n")
+
+
+def load_trace(trace_path: Path) -> List[Dict[str, Any]]:
+    """Load the trace entries, from the oldest rotated file to the newest.
+
+    :param trace_path: The JSON lines trace file.
+    :returns: The trace entries.
+    """
+    ret = []
+    for index in range(TRACE_BACKUPS, 0, -1):
+        ret += load_history(_get_backup_path(trace_path, index))
+    ret += load_history(trace_path)
+    return ret
+
+
+def clear_trace(trace_path: Path) -> None:
+    for index in range(TRACE_BACKUPS, 0, -1):
+        _get_backup_path(trace_path, index).unlink(missing_ok=True)
+    trace_path.unlink(missing_ok=True)
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """Get the nearest rank percentile.
+
+    :param values: The values, not empty.
+    :param percent: The percentile, from 0 to 100.
+    :returns: The smallest value that is greater or equal to percent of them.
+    """
+    values = sorted(values)
+    rank = math.ceil(percent / 100.0 * len(values))
+    return values[min(len(values) - 1, max(0, rank - 1))]
+
+
+def aggregate_trace(
+    entries: List[Dict[str, Any]]
+) -> Dict[str, Dict[str, Dict[str, List[float]]]]:
+    """Group the span durations by command and span.
+
+    :param entries: The trace entries.
+    :returns: The "duration" and "self" times of each span of each command.
+    """
+    ret: Dict[str, Dict[str, Dict[str, List[float]]]] = {}
+    for entry in entries:
+        cmd_spans = ret.setdefault(entry["cmd"], {})
+
+        def _add(name: str, duration: float, self_time: float) -> None:
+            values = cmd_spans.setdefault(name, {"duration": [], "self": []})
+            values["duration"].append(duration)
+            values["self"].append(self_time)
+
+        _add("total", entry["total"], entry["total"])
+        if entry.get("launcher", None) is not None:
+            _add("launcher", entry["launcher"], entry["launcher"])
+        for item in entry["spans"]:
+            name = "  " * item["depth"] + "%s: %s" % (item["category"], item["name"])
+            _add(name, item["duration"], item.get("self", item["duration"]))
+    return ret
+
+
+def trace_to_table(entries: List[Dict[str, Any]]) -> str:
+    """Render the p50 and p95 of the spans of each command as a text table.
+
+    :param entries: The trace entries.
+    :returns: The table.
+    """
+    lines = []
+    for cmd, cmd_spans in sorted(aggregate_trace(entries).items()):
+        runs = len(cmd_spans["total"]["duration"])
+        lines.append("Command: %s (%d runs)" % (cmd, runs))
+        lines.append(
+            "%-44s %6s %10s %10s %10s"
+            % ("Span (ms)", "Count", "p50", "p95", "Self p50")
+        )
+        lines.append("-" * 84)
+        for name, values in cmd_spans.items():
+            lines.append(
+                "%-44s %6d %10.1f %10.1f %10.1f"
+                % (
+                    name[:44],
+                    len(values["duration"]),
+                    percentile(values["duration"], 50),
+                    percentile(values["duration"], 95),
+                    percentile(values["self"], 50),
+                )
+            )
+        lines.append("")
+    return "\n".join(lines)
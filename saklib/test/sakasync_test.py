@@ -0,0 +1,81 @@
+import asyncio
+import io
+import time
+import unittest
+from typing import AsyncIterator, List
+
+from saklib.sakasync import is_async_callable, run_coroutine
+from saklib.sakcmd import SakCmd, sak_arg_parser, wrap_cmd
+from saklib.sakexec import run_cmd_async
+
+
+@SakCmd("wait", helpmsg="Wait concurrently.")
+async def wait(count: int = 1) -> float:
+    start = time.perf_counter()
+    await asyncio.gather(*[asyncio.sleep(0.1) for _ in range(count)])
+    return time.perf_counter() - start
+
+
+@SakCmd("count")
+async def count(n: int = 3) -> AsyncIterator[int]:
+    for i in range(n):
+        await asyncio.sleep(0)
+        yield i
+
+
+class SakAsyncTest(unittest.TestCase):
+    def test_async_callbacks(self) -> None:
+        # GIVEN.
+        root = wrap_cmd({"wait": wait, "count": count}, name="sak")
+
+        # WHEN.
+        duration = sak_arg_parser(root, ["wait", "--count", "10"])["value"]
+        items = sak_arg_parser(root, ["count", "--n", "3"])["value"]
+
+        # THEN.
+        self.assertLess(duration, 0.5)
+        self.assertEqual(list(items), [0, 1, 2])
+        self.assertTrue(is_async_callable(wrap_cmd(wait).callback))
+
+    def test_not_run_async(self) -> None:
+        # GIVEN.
+        root = wrap_cmd({"wait": wait}, name="sak")
+
+        # WHEN.
+        value = sak_arg_parser(root, ["wait"], run_async=False)["value"]
+
+        # THEN.
+        self.assertTrue(asyncio.iscoroutine(value))
+        self.assertLess(run_coroutine(value), 0.5)
+
+    def test_run_coroutine_in_loop(self) -> None:
+        # GIVEN.
+        async def outer() -> float:
+            elapsed: float = run_coroutine(wait(count=2))
+            return elapsed
+
+        # THEN.
+        self.assertLess(asyncio.run(outer()), 0.5)
+
+    def test_run_cmd_async(self) -> None:
+        # GIVEN.
+        stdout = io.StringIO()
+
+        async def run_all() -> List[int]:
+            ret = await asyncio.gather(
+                run_cmd_async(["sleep", "0.2"]),
+                run_cmd_async(["sleep", "0.2"]),
+                run_cmd_async("echo hello", stdout=stdout),
+            )
+            return list(ret)
+
+        # WHEN.
+        start = time.perf_counter()
+        ret = asyncio.run(run_all())
+
+        # THEN.
+        self.assertLess(time.perf_counter() - start, 0.35)
+        self.assertEqual(ret, [0, 0, 0])
+        self.assertEqual(stdout.getvalue(), "hello\n")
+        with self.assertRaises(Exception):
+            asyncio.run(run_cmd_async(["false"], check=True))
@@ -0,0 +1,60 @@
+import io
+import json
+import unittest
+
+from saklib.sakbatch import parse_batch_line, run_batch
+from saklib.sakcmd import SakCmd, wrap_cmd
+
+
+def echo(value: str = "") -> str:
+    return value
+
+
+def fail() -> None:
+    raise Exception("failed")
+
+
+class SakBatchTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.root = SakCmd("sak")
+        self.root.subcmds.append(wrap_cmd({"echo": echo, "fail": fail}, name="test"))
+
+    def test_parse_batch_line(self) -> None:
+        self.assertEqual(parse_batch_line("  "), None)
+        self.assertEqual(parse_batch_line("# comment"), None)
+        self.assertEqual(
+            parse_batch_line("sak test echo --value 'a b'"),
+            ["test", "echo", "--value", "a b"],
+        )
+        self.assertEqual(parse_batch_line('["test", "echo"]'), ["test", "echo"])
+        self.assertEqual(parse_batch_line('{"argv": ["test"]}'), ["test"])
+
+    def test_run_batch(self) -> None:
+        # GIVEN.
+        lines = [
+            "test echo --value foo",
+            "test fail",
+            "",
+            "test echo --value bar",
+        ]
+
+        # WHEN.
+        output = io.StringIO()
+        status = run_batch(self.root, lines, output)
+
+        # THEN.
+        results = [json.loads(x) for x in output.getvalue().splitlines()]
+        self.assertEqual(status, 1)
+        self.assertEqual([x["status"] for x in results], [0, 1])
+        self.assertEqual(results[0]["value"], "foo")
+        self.assertEqual(results[1]["error"], "failed")
+
+        # WHEN.
+        output = io.StringIO()
+        status = run_batch(self.root, lines, output, continue_on_error=True)
+
+        # THEN.
+        results = [json.loads(x) for x in output.getvalue().splitlines()]
+        self.assertEqual(status, 1)
+        self.assertEqual([x["line"] for x in results], [1, 2, 4])
+        self.assertEqual(results[2]["value"], "bar")
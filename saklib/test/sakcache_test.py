@@ -0,0 +1,184 @@
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from typing import Any, List, Optional
+from unittest import mock
+
+from saklib import sakcache
+from saklib.sakcache import SakCmdCache, SakCompleterCache, get_func_key
+from saklib.sakcmd import SakArg, SakCmd, SakCompleterArg, sak_arg_parser, wrap_cmd
+from saklib.sakplugin import load_file
+
+CALLS: List[int] = []
+
+
+@SakCmd("expensive", cache=True)
+def expensive(value: int = 0) -> int:
+    CALLS.append(value)
+    return value * 2
+
+
+class SakCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = SakCmdCache(Path(self.tmp_dir.name))
+
+        self.old_cache = sakcache._CMD_CACHE
+        sakcache._CMD_CACHE = self.cache
+        CALLS.clear()
+
+    def tearDown(self) -> None:
+        sakcache._CMD_CACHE = self.old_cache
+        self.tmp_dir.cleanup()
+
+    def test_cmd_cache(self) -> None:
+        # GIVEN.
+        root = wrap_cmd({"expensive": expensive}, name="sak")
+
+        # WHEN.
+        values = [
+            sak_arg_parser(root, ["expensive", "--value", "1"])["value"],
+            sak_arg_parser(root, ["expensive", "--value", "1"])["value"],
+            sak_arg_parser(root, ["expensive", "--value", "2"])["value"],
+            sak_arg_parser(root, ["expensive", "--value", "1", "--no_cache"])["value"],
+        ]
+
+        # THEN.
+        self.assertEqual(values, [2, 2, 4, 2])
+        self.assertEqual(CALLS, [1, 2, 1])
+
+        # WHEN.
+        self.cache.invalidate(expensive)
+        sak_arg_parser(root, ["expensive", "--value", "1"])
+
+        # THEN.
+        self.assertEqual(CALLS, [1, 2, 1, 1])
+
+    def test_ttl(self) -> None:
+        # GIVEN.
+        self.cache.set("func", "args", "value")
+
+        # THEN.
+        self.assertEqual(self.cache.get("func", "args", ttl=60), "value")
+        time.sleep(0.01)
+        self.assertIs(self.cache.get("func", "args", ttl=0.001), sakcache._MISSING)
+        self.assertIs(self.cache.get("func", "args"), sakcache._MISSING)
+
+    def test_lru_eviction(self) -> None:
+        # GIVEN.
+        self.cache.max_size = 2500
+        self.cache.set("func", "a", "a" * 1000)
+        self.cache.set("func", "b", "b" * 1000)
+        old_time = time.time() - 60
+        os.utime(self.cache.path / "func" / "b.pk", (old_time, old_time))
+
+        # WHEN.
+        self.cache.set("func", "c", "c" * 1000)
+
+        # THEN.
+        self.assertIs(self.cache.get("func", "b"), sakcache._MISSING)
+        self.assertEqual(self.cache.get("func", "a"), "a" * 1000)
+        self.assertEqual(self.cache.get("func", "c"), "c" * 1000)
+
+    def test_source_change(self) -> None:
+        # GIVEN.
+        module_path = Path(self.tmp_dir.name) / "cmds.py"
+        module_path.write_text("def cmd(value):\n    return value\n")
+        module = load_file(module_path)
+        self.cache.call(module["cmd"], [1], {})
+        args_keys = list((self.cache.path / get_func_key(module["cmd"])).iterdir())
+
+        # WHEN.
+        module_path.write_text("def cmd(value):\n    return value * 2\n")
+        module = load_file(module_path)
+        value = self.cache.call(module["cmd"], [1], {})
+
+        # THEN.
+        self.assertEqual(value, 2)
+        self.assertEqual(len(args_keys), 1)
+
+    def test_evict_amortized(self) -> None:
+        # GIVEN.
+        self.cache.set("func", "a", "a")
+
+        # WHEN.
+        with mock.patch.object(SakCmdCache, "_entries") as entries:
+            for idx in range(10):
+                self.cache.set("func", str(idx), "value")
+
+        # THEN.
+        entries.assert_not_called()
+
+
+class SakCompleterCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = SakCompleterCache(Path(self.tmp_dir.name))
+
+        self.old_cache = sakcache._COMPLETER_CACHE
+        sakcache._COMPLETER_CACHE = self.cache
+
+        self.prefixes: List[str] = []
+
+    def tearDown(self) -> None:
+        sakcache._COMPLETER_CACHE = self.old_cache
+        self.tmp_dir.cleanup()
+
+    def completer(self, arg: Optional[SakCompleterArg]) -> List[Any]:
+        prefix = ((arg is not None) and arg.prefix) or ""
+        self.prefixes.append(prefix)
+        return [x for x in ["abc", "abd", "bcd"] if x.startswith(prefix)]
+
+    def test_prefix_reuse(self) -> None:
+        # GIVEN.
+        sakarg = SakArg("name", completercb=self.completer)
+
+        # WHEN.
+        values = [
+            sakarg.complete(SakCompleterArg("a", None, None, None)),
+            sakarg.complete(SakCompleterArg("ab", None, None, None)),
+            sakarg.complete(SakCompleterArg("abc", None, None, None)),
+            sakarg.complete(SakCompleterArg("b", None, None, None)),
+        ]
+
+        # THEN.
+        self.assertEqual(values, [["abc", "abd"], ["abc", "abd"], ["abc"], ["bcd"]])
+        self.assertEqual(self.prefixes, ["a", "b"])
+
+        # WHEN. A new process, sharing the same cache folder.
+        sakcache._COMPLETER_CACHE = SakCompleterCache(Path(self.tmp_dir.name))
+        value = sakarg.complete(SakCompleterArg("abd", None, None, None))
+
+        # THEN.
+        self.assertEqual(value, ["abd"])
+        self.assertEqual(self.prefixes, ["a", "b"])
+
+    def test_background_refresh(self) -> None:
+        # GIVEN.
+        sakarg = SakArg("name", completercb=self.completer, completer_ttl=0.05)
+        sakarg.complete(SakCompleterArg(None, None, None, None))
+        time.sleep(0.1)
+
+        # WHEN.
+        value = sakarg.complete(SakCompleterArg(None, None, None, None))
+        for _ in range(100):
+            if not self.cache._refreshing:
+                break
+            time.sleep(0.01)
+
+        # THEN.
+        self.assertEqual(value, ["abc", "abd", "bcd"])
+        self.assertEqual(self.prefixes, ["", ""])
+
+    def test_disabled(self) -> None:
+        # GIVEN.
+        sakarg = SakArg("name", completercb=self.completer, completer_ttl=0)
+
+        # WHEN.
+        sakarg.complete(SakCompleterArg("a", None, None, None))
+        sakarg.complete(SakCompleterArg("a", None, None, None))
+
+        # THEN.
+        self.assertEqual(self.prefixes, ["a", "a"])
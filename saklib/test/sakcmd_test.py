@@ -1,7 +1,25 @@
+import gc
+import os
+import time
 import unittest
+import weakref
 from typing import Any, List, Optional, Tuple
+from unittest import mock
 
-from saklib.sakcmd import SakArg, SakCmd, SakCmdWrapper, sak_arg_parser
+from saklib import sakcmd
+from saklib.sakcmd import (
+    _WRAPPERS,
+    SUBCMDS_PREFIX_MEMO_SIZE,
+    SakArg,
+    SakCmd,
+    SakCmdWrapper,
+    clear_cmd_cache,
+    sak_arg_parser,
+    wrap_cmd,
+)
+
+# Set to "YES" to run the timing checks, they depend on the machine load.
+BENCHMARK = os.environ.get("SAK_BENCHMARK", "NO") == "YES"
 
 
 class SakCmdTest(unittest.TestCase):
@@ -411,3 +429,200 @@ class SakCmdWrapperFunctionDocAndDecoratorTest(unittest.TestCase):
         self.assertEqual(wrap.args[0].vargs["required"], True)
         self.assertEqual(wrap.args[0].vargs["type"], int)
         self.assertEqual(wrap.args[0].completercb, None)
+
+    def test_wrapper_cache(self) -> None:
+        # GIVEN.
+        def func(arg_int: int) -> None:
+            return None
+
+        def other() -> None:
+            return None
+
+        cmds = {"func": func, "other": other}
+
+        # WHEN.
+        wrap = wrap_cmd(cmds, name="root")
+
+        # THEN.
+        self.assertIs(wrap_cmd(cmds, name="root"), wrap)
+        self.assertIs(wrap.subcmds, wrap.subcmds)
+        self.assertIs(wrap.subcmds[0], wrap_cmd(func, name="func"))
+        self.assertIs(wrap.subcmds[0].args, wrap.subcmds[0].args)
+
+        # WHEN.
+        args = wrap.subcmds[0].args
+        clear_cmd_cache()
+
+        # THEN.
+        self.assertIsNot(wrap_cmd(cmds, name="root"), wrap)
+        self.assertIsNot(wrap.subcmds[0].args, args)
+        self.assertEqual(wrap.subcmds[0].args[0].name, "arg_int")
+
+    def test_wrappers_are_released(self) -> None:
+        # GIVEN.
+        def func() -> None:
+            return None
+
+        cmds = {"func": func}
+        func_wrap = wrap_cmd(func, name="func")
+        cmds_wrap = wrap_cmd(cmds, name="root")
+        func_ref = weakref.ref(func)
+        count = len(_WRAPPERS)
+
+        # THEN.
+        self.assertIs(wrap_cmd(func, name="func"), func_wrap)
+        self.assertIs(wrap_cmd(cmds, name="root"), cmds_wrap)
+
+        # WHEN.
+        del func, cmds, func_wrap, cmds_wrap
+        gc.collect()
+
+        # THEN.
+        self.assertIsNone(func_ref())
+        self.assertEqual(len(_WRAPPERS), count - 1)
+
+    def test_cmd_subcmds_not_cached(self) -> None:
+        # GIVEN.
+        cmd = SakCmd("foo")
+        wrap = wrap_cmd(cmd)
+        self.assertEqual(wrap.subcmds, [])
+
+        # WHEN.
+        cmd.subcmds.append(SakCmd("bar"))
+
+        # THEN.
+        self.assertEqual([x.name for x in wrap.subcmds], ["bar"])
+
+
+class SakArgParserBenchmarkTest(unittest.TestCase):
+    def make_root(self, siblings: int) -> Any:
+        def leaf(value: int = 0) -> int:
+            return value
+
+        group = {"cmd%d" % idx: leaf for idx in range(siblings)}
+        return wrap_cmd({"group": group, "other": leaf}, name="root")
+
+    def parse_time(self, root: Any) -> float:
+        # Warm up the cached wrappers.
+        sak_arg_parser(root, ["group", "cmd1", "--value", "1"])
+
+        durations = []
+        for _ in range(10):
+            start = time.perf_counter()
+            ret = sak_arg_parser(root, ["group", "cmd1", "--value", "1"])
+            durations.append(time.perf_counter() - start)
+            self.assertEqual(ret["value"], 1)
+        return sorted(durations)[len(durations) // 2]
+
+    def count_wraps(self, root: Any) -> int:
+        # Warm up the cached wrappers.
+        sak_arg_parser(root, ["group", "cmd1", "--value", "1"])
+
+        with mock.patch.object(sakcmd, "wrap_cmd", wraps=wrap_cmd) as patched:
+            ret = sak_arg_parser(root, ["group", "cmd1", "--value", "1"])
+        self.assertEqual(ret["value"], 1)
+        return patched.call_count
+
+    def test_parse_flat_in_siblings(self) -> None:
+        # GIVEN.
+        small = self.make_root(10)
+        large = self.make_root(5000)
+
+        # THEN.
+        self.assertEqual(self.count_wraps(large), self.count_wraps(small))
+
+    @unittest.skipUnless(BENCHMARK, "Set SAK_BENCHMARK=YES to run it")
+    def test_parse_time_flat_in_siblings(self) -> None:
+        # GIVEN.
+        small = self.make_root(10)
+        large = self.make_root(5000)
+
+        # WHEN.
+        small_time = self.parse_time(small)
+        large_time = self.parse_time(large)
+
+        # THEN.
+        self.assertLess(large_time, 3 * small_time + 0.001)
+
+
+class SakLazySubcmdsTest(unittest.TestCase):
+    def test_subcmds_hook(self) -> None:
+        # GIVEN.
+        prefixes: List[str] = []
+
+        def leaf(value: int = 0) -> int:
+            return value
+
+        class Branches:
+            def __sak_subcmds__(self, prefix: str) -> Any:
+                prefixes.append(prefix)
+                names = ["feature%d" % idx for idx in range(100000)] + ["main"]
+                return {x: leaf for x in names if x.startswith(prefix)}
+
+        root = wrap_cmd({"branch": Branches()}, name="root")
+
+        # WHEN.
+        ret = sak_arg_parser(root, ["branch", "main", "--value", "2"])
+        branch = root.get_subcmd("branch")
+
+        # THEN.
+        self.assertEqual(ret["value"], 2)
+        self.assertEqual(prefixes, ["main"])
+        assert branch is not None
+        self.assertTrue(branch.has_lazy_subcmds)
+        self.assertEqual(len(branch.get_subcmds("feature9999")), 11)
+        self.assertIsNone(branch.get_subcmd("feature"))
+
+        # WHEN.
+        for idx in range(2 * SUBCMDS_PREFIX_MEMO_SIZE):
+            branch.get_subcmds("feature%d" % idx)
+
+        # THEN.
+        memo = branch._memo_values["subcmds_by_prefix"]
+        self.assertEqual(len(memo), SUBCMDS_PREFIX_MEMO_SIZE)
+
+    def test_dir_subcmds_by_prefix(self) -> None:
+        # GIVEN.
+        calls: List[str] = []
+
+        class Group:
+            @property
+            def first(self) -> Any:
+                calls.append("first")
+                return lambda: 1
+
+            @property
+            def second(self) -> Any:
+                calls.append("second")
+                return lambda: 2
+
+        root = wrap_cmd({"group": Group()}, name="root")
+
+        # WHEN.
+        ret = sak_arg_parser(root, ["group", "second"])
+
+        # THEN.
+        self.assertEqual(ret["value"], 2)
+        self.assertNotIn("first", calls)
+
+    def test_dir_subcmds_by_prefix_decorated(self) -> None:
+        # GIVEN.
+        class Show:
+            @SakCmd("version", helpmsg="Show the version.")
+            def show_version(self) -> str:
+                return "1.0"
+
+            @SakCmd("other", helpmsg="Other command.")
+            def version_other(self) -> str:
+                return "other"
+
+        root = wrap_cmd({"show": Show()}, name="root")
+
+        # WHEN.
+        ret = sak_arg_parser(root, ["show", "version"])
+        show = root.get_subcmd("show")
+
+        # THEN.
+        self.assertEqual(ret["value"], "1.0")
+        assert show is not None
+        self.assertEqual([x.name for x in show.get_subcmds("v")], ["version"])
@@ -0,0 +1,119 @@
+import os
+import subprocess
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Any, List, Optional
+
+from saklib.sakcmd import SakArg, SakCmd, SakCompleterArg, wrap_cmd
+from saklib.sakcomplete import (
+    INDEX_SEP,
+    build_complete_index,
+    get_bash_complete_script,
+    write_complete_index,
+)
+
+
+def completer(arg: Optional[SakCompleterArg]) -> List[Any]:
+    return ["a", "b"]
+
+
+@SakCmd("hello", helpmsg="Say hello.")
+@SakArg("name", short_name="n", helpmsg="The name.")
+@SakArg("color", choices=["red", "light blue"], helpmsg="The color.")
+@SakArg("file", completercb=completer, helpmsg="The file.")
+@SakArg("loud", helpmsg="Shout.")
+def hello(name: str, color: str, file: str, loud: bool = False) -> str:
+    return "hello " + name
+
+
+class SakCompleteTest(unittest.TestCase):
+    def _root(self) -> SakCmd:
+        root = SakCmd("sak")
+        dummy = SakCmd("dummy")
+        dummy.subcmds.append(wrap_cmd(hello))
+        root.subcmds.append(dummy)
+        return root
+
+    def test_build_complete_index(self) -> None:
+        # GIVEN.
+        root = self._root()
+
+        # WHEN.
+        index = build_complete_index(root).splitlines()
+
+        # THEN.
+        self.assertTrue(index[0].startswith("# sak-complete-index"))
+        self.assertIn("C\tsak\tdummy", index)
+        self.assertIn(f"C\tsak{INDEX_SEP}dummy\thello", index)
+        opts = ["-h", "--help", "--name", "-n", "--color", "--file", "--loud"]
+        self.assertIn(
+            f"O\tsak{INDEX_SEP}dummy{INDEX_SEP}hello\t" + INDEX_SEP.join(opts), index
+        )
+        hello_path = INDEX_SEP.join(["sak", "dummy", "hello"])
+        self.assertIn(
+            f"V\t{hello_path}{INDEX_SEP}--color\tred{INDEX_SEP}light blue", index
+        )
+        self.assertIn(f"D\t{hello_path}{INDEX_SEP}--file\t", index)
+        self.assertIn(f"A\t{hello_path}{INDEX_SEP}--name\t", index)
+        self.assertNotIn(f"A\t{hello_path}{INDEX_SEP}--loud\t", index)
+
+    def test_build_complete_index_reserved(self) -> None:
+        # GIVEN.
+        @SakCmd("cmd")
+        @SakArg("sep", choices=["a\tb", "c"])
+        def cmd(sep: str) -> str:
+            return sep
+
+        root = SakCmd("sak")
+        root.subcmds.append(wrap_cmd(cmd))
+
+        # WHEN.
+        index = build_complete_index(root).splitlines()
+
+        # THEN.
+        self.assertIn(f"D\tsak{INDEX_SEP}cmd{INDEX_SEP}--sep\t", index)
+
+    def test_write_complete_index(self) -> None:
+        # GIVEN.
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index_path = Path(tmp_dir) / "complete" / "index"
+
+            # WHEN.
+            write_complete_index(self._root(), index_path, watch_paths=[Path(tmp_dir)])
+
+            # THEN.
+            self.assertIn(f"W\t{tmp_dir}\t", index_path.read_text().splitlines())
+
+    def test_complete_load_watch_files(self) -> None:
+        # GIVEN.
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            plugin_path = Path(tmp_dir) / "plugin"
+            lib_file = plugin_path / "lib" / "texts.py"
+            lib_file.parent.mkdir(parents=True)
+            lib_file.write_text('HELLO = "Say hello."\n')
+            index_path = Path(tmp_dir) / "complete" / "index"
+            write_complete_index(
+                self._root(),
+                index_path,
+                watch_paths=[plugin_path],
+                watch_files=[lib_file],
+            )
+            # Only the subfolder file is newer than the index.
+            index_mtime = index_path.stat().st_mtime_ns
+            os.utime(plugin_path, ns=(index_mtime, index_mtime))
+            script = get_bash_complete_script(index_path, Path(tmp_dir))
+            check = f'{script}\n_sak_complete_load "{index_path}"; echo $?\n'
+
+            # WHEN.
+            before = subprocess.run(
+                ["bash", "-c", check], stdout=subprocess.PIPE, check=True
+            )
+            os.utime(lib_file, ns=(index_mtime + 10**9, index_mtime + 10**9))
+            after = subprocess.run(
+                ["bash", "-c", check], stdout=subprocess.PIPE, check=True
+            )
+
+            # THEN.
+            self.assertEqual(before.stdout.decode().split()[-1], "0")
+            self.assertEqual(after.stdout.decode().split()[-1], "2")
@@ -0,0 +1,150 @@
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from typing import List
+from unittest import mock
+
+from saklib.sakclient import connect, recv_msg, run_in_daemon, send_msg
+from saklib.sakdaemon import SakDaemon
+
+
+class SakDaemonTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name)
+
+        self.watch_path = self.path / "plugins"
+        self.watch_path.mkdir()
+        (self.watch_path / "dummy.py").write_text("")
+
+        self.calls = 0
+
+        def run() -> None:
+            self.calls += 1
+            print(" ".join(sys.argv), os.environ["SAK_DUMMY"], os.getcwd())
+            sys.exit(3)
+
+        self.daemon = SakDaemon(
+            self.path / "daemon.sock", run, watch_paths=[self.watch_path]
+        )
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def _request(self, msg: dict) -> dict:  # type: ignore
+        out_path = self.path / "out.txt"
+        client, server = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        with client, server, open(out_path, "w") as out:
+            send_msg(client, msg, fds=[0, out.fileno(), out.fileno()])
+            self.daemon.handle(server)
+            reply, _ = recv_msg(client)
+        self.out = out_path.read_text()
+        return reply  # type: ignore
+
+    def test_run(self) -> None:
+        # GIVEN.
+        cwd = os.getcwd()
+        env = dict(os.environ)
+        env["SAK_DUMMY"] = "dummy"
+        msg = {"type": "run", "argv": ["foo"], "cwd": str(self.path), "env": env}
+
+        # WHEN.
+        reply = self._request(msg)
+
+        # THEN.
+        self.assertEqual(reply, {"exit_code": 3})
+        self.assertEqual(self.out, f"sak foo dummy {self.path}\n")
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertNotIn("SAK_DUMMY", os.environ)
+
+    def test_restart_on_change(self) -> None:
+        # GIVEN.
+        (self.watch_path / "other.py").write_text("")
+        msg = {"type": "run", "argv": [], "cwd": str(self.path), "env": {}}
+
+        # WHEN.
+        reply = self._request(msg)
+
+        # THEN.
+        self.assertEqual(reply, {"fallback": True})
+        self.assertTrue(self.daemon.should_restart)
+        self.assertEqual(self.calls, 0)
+
+    def _serve(self) -> threading.Thread:
+        server = threading.Thread(target=self.daemon.serve_forever)
+        server.start()
+        for _ in range(100):
+            if self.daemon.socket_path.exists():
+                break
+            time.sleep(0.01)
+        return server
+
+    def _stop(self, server: threading.Thread) -> None:
+        sock = connect(str(self.daemon.socket_path))
+        assert sock is not None
+        with sock:
+            send_msg(sock, {"type": "stop"})
+            recv_msg(sock)
+        server.join(5)
+
+    def test_run_in_daemon_env(self) -> None:
+        # GIVEN.
+        paths: List[str] = []
+        self.daemon.run_callback = lambda: paths.append(os.environ["PATH"])
+        self.daemon.socket_path = self.path / "cache" / "daemon.sock"
+        server = self._serve()
+        env = dict(os.environ)
+        env["PATH"] = "/sak/python/bin:" + env["PATH"]
+
+        # WHEN.
+        with mock.patch.dict(os.environ, {"SAK_GLOBAL": str(self.path)}):
+            exit_code = run_in_daemon(["foo"], env=env)
+        self._stop(server)
+
+        # THEN.
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(paths, [env["PATH"]])
+
+    def test_busy(self) -> None:
+        # GIVEN.
+        started = threading.Event()
+        release = threading.Event()
+
+        def run() -> None:
+            started.set()
+            release.wait(5)
+
+        self.daemon.run_callback = run
+        server = self._serve()
+        msg = {"type": "run", "argv": [], "cwd": str(self.path), "env": {}}
+
+        with open(self.path / "out.txt", "w") as out:
+            fds = [0, out.fileno(), out.fileno()]
+            first = connect(str(self.daemon.socket_path))
+            assert first is not None
+            with first:
+                send_msg(first, msg, fds=fds)
+                self.assertTrue(started.wait(5))
+
+                # WHEN.
+                second = connect(str(self.daemon.socket_path))
+                assert second is not None
+                with second:
+                    second.settimeout(5)
+                    send_msg(second, msg, fds=fds)
+                    busy_reply, _ = recv_msg(second)
+
+                release.set()
+                first_reply, _ = recv_msg(first)
+
+        self._stop(server)
+
+        # THEN.
+        self.assertEqual(busy_reply, {"fallback": True})
+        self.assertEqual(first_reply, {"exit_code": 0})
+        self.assertFalse(server.is_alive())
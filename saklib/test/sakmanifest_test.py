@@ -0,0 +1,123 @@
+import json
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+from saklib.sakcmd import SakCmd, sak_arg_parser
+from saklib.sakmanifest import SakLazyCmd, SakManifest
+from saklib.sakplugin import _LOADED_FILES, SakContext, SakPlugin
+
+SAK_CONFIG = '''
+"""Dummy plugin."""
+
+EXPOSE_FILES = "dummy.py"
+'''
+
+DUMMY = """
+from saklib.sakcmd import SakCmd
+
+
+@SakCmd("hello", helpmsg="Say hello.")
+def hello(name: str = "world") -> str:
+    return "hello " + name
+
+
+EXPOSE = {"hello": hello}
+"""
+
+
+class SakManifestTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name)
+
+        self.plugin_path = self.path / "plugins" / "sak_dummy"
+        self.plugin_path.mkdir(parents=True)
+        (self.plugin_path / "sak_config.py").write_text(SAK_CONFIG)
+        (self.plugin_path / "dummy.py").write_text(DUMMY)
+
+        self.cache_path = self.path / "cache" / "manifest"
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def _root(self) -> SakCmd:
+        plugin = SakPlugin(SakContext(), "dummy", self.plugin_path)
+        self.plugin = plugin
+        root = SakCmd("sak")
+        root.subcmds.append(SakManifest(self.cache_path).wrap_plugin(plugin))
+        return root
+
+    def test_manifest_is_created(self) -> None:
+        # GIVEN.
+        root = self._root()
+
+        # WHEN.
+        ret = sak_arg_parser(root, ["dummy", "hello", "--name", "foo"])
+
+        # THEN.
+        self.assertEqual(ret["value"], "hello foo")
+        self.assertEqual(len(list(self.cache_path.glob("dummy-*.json"))), 1)
+
+    def test_manifest_lazy_load(self) -> None:
+        # GIVEN.
+        sak_arg_parser(self._root(), ["dummy", "-h"])
+        root = self._root()
+
+        # WHEN.
+        ret = sak_arg_parser(root, ["dummy", "-h"])
+
+        # THEN.
+        self.assertIn("Say hello.", ret["argparse"]["help"])
+        self.assertIsInstance(ret["cmd"], SakLazyCmd)
+        self.assertEqual(self.plugin._loaded_files, set())
+
+        # WHEN.
+        ret = sak_arg_parser(root, ["dummy", "hello"])
+
+        # THEN.
+        self.assertEqual(ret["value"], "hello world")
+        self.assertEqual(self.plugin._loaded_files, {"_"})
+
+    def test_manifest_invalidation(self) -> None:
+        # GIVEN.
+        sak_arg_parser(self._root(), ["dummy", "-h"])
+        (self.plugin_path / "dummy.py").write_text(
+            DUMMY.replace("Say hello.", "Say hi.")
+        )
+
+        # WHEN.
+        ret = sak_arg_parser(self._root(), ["dummy", "-h"])
+
+        # THEN.
+        self.assertIn("Say hi.", ret["argparse"]["help"])
+
+    def test_manifest_invalidation_imported(self) -> None:
+        # GIVEN.
+        lib_path = self.plugin_path / "dummy_lib"
+        lib_path.mkdir()
+        (lib_path / "texts.py").write_text('HELLO = "Say hello."\n')
+        (self.plugin_path / "dummy.py").write_text(
+            "from dummy_lib.texts import HELLO\n"
+            + DUMMY.replace('"Say hello."', "HELLO")
+        )
+        sak_arg_parser(self._root(), ["dummy", "-h"])
+        (lib_path / "texts.py").write_text('HELLO = "Say hi."\n')
+
+        # A new process loads the files again.
+        sys.modules.pop("dummy_lib.texts", None)
+        sys.modules.pop("dummy_lib", None)
+        _LOADED_FILES.clear()
+
+        # WHEN.
+        ret = sak_arg_parser(self._root(), ["dummy", "-h"])
+
+        # THEN.
+        self.assertIn("Say hi.", ret["argparse"]["help"])
+        manifest = json.loads(next(self.cache_path.glob("dummy-*.json")).read_text())
+        self.assertIn("dummy_lib/texts.py", manifest["files"])
+        # Also listed when the manifest is used and the file is not loaded.
+        sys.modules.pop("dummy_lib.texts", None)
+        files = SakManifest(self.cache_path).get_plugin_files(self.plugin)
+        self.assertIn((lib_path / "texts.py").resolve(), files)
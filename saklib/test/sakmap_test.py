@@ -0,0 +1,86 @@
+import io
+import json
+import unittest
+from typing import Iterator, List
+
+from saklib.sakcmd import SakCmd, wrap_cmd
+from saklib.sakmap import MAP_THREAD_WINDOW, run_map
+
+
+def square(x: int = 0) -> int:
+    print("square", x)
+    if x < 0:
+        raise Exception("negative")
+    return x * x
+
+
+class SakMapTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.root = SakCmd("sak")
+        self.root.subcmds.append(wrap_cmd({"square": square}, name="math"))
+        self.lines = ['{"x": %d}' % x for x in range(10)] + ["", "--x -1"]
+
+    def check(self, output: io.StringIO) -> None:
+        results = [json.loads(x) for x in output.getvalue().splitlines()]
+        self.assertEqual(sorted(x["index"] for x in results), list(range(10)) + [11])
+        for result in results[:10]:
+            self.assertEqual(result["value"], result["index"] ** 2)
+            self.assertIn("square %d" % result["index"], result["stdout"])
+        self.assertEqual(results[-1]["status"], 1)
+        self.assertEqual(results[-1]["error"], "negative")
+
+    def test_map_processes(self) -> None:
+        # WHEN.
+        output = io.StringIO()
+        status = run_map(self.root, ["math", "square"], self.lines, output, jobs=2)
+
+        # THEN.
+        self.assertEqual(status, 1)
+        self.check(output)
+
+    def test_map_threads(self) -> None:
+        # WHEN.
+        output = io.StringIO()
+        status = run_map(
+            self.root, ["math", "square"], self.lines, output, jobs=2, threads=True
+        )
+
+        # THEN.
+        self.assertEqual(status, 1)
+        self.check(output)
+
+    def test_map_threads_window(self) -> None:
+        # GIVEN.
+        read: List[int] = []
+        written: List[int] = []
+
+        def lines() -> Iterator[str]:
+            for x in range(100):
+                read.append(x)
+                yield '{"x": %d}' % x
+
+        class Output(io.StringIO):
+            def write(self, s: str) -> int:
+                written.append(len(read))
+                return super().write(s)
+
+        for unordered in [False, True]:
+            read.clear()
+            written.clear()
+            output = Output()
+
+            # WHEN.
+            status = run_map(
+                self.root,
+                ["math", "square"],
+                lines(),
+                output,
+                jobs=2,
+                threads=True,
+                unordered=unordered,
+            )
+
+            # THEN.
+            self.assertEqual(status, 0)
+            self.assertEqual(len(output.getvalue().splitlines()), 100)
+            self.assertLessEqual(written[0], 2 * MAP_THREAD_WINDOW + 1)
@@ -0,0 +1,200 @@
+import asyncio
+import csv
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterator, List
+
+from saklib.sakoutput import (
+    aiter_chunks,
+    is_stream,
+    iter_chunks,
+    iter_row_chunks,
+    parse_output_args,
+    write_stream,
+    write_value,
+)
+
+BROKEN_PIPE_SCRIPT = """
+from saklib.sakoutput import render_value
+
+render_value("row %d" % x for x in range(1000000))
+"""
+
+
+def rows(fail_at: int) -> Iterator[str]:
+    for idx in range(10):
+        if idx == fail_at:
+            raise Exception("failed")
+        yield "row %d" % idx
+
+
+def records(count: int) -> Iterator[Dict[str, Any]]:
+    for idx in range(count):
+        yield {"key": idx, "name": "task %d" % idx}
+
+
+def blocking_rows(released: threading.Event) -> Iterator[str]:
+    yield "row 0"
+    yield "row 1"
+    released.wait(timeout=10)
+    yield "row 2"
+
+
+async def async_blocking_rows(released: asyncio.Event) -> AsyncIterator[str]:
+    yield "row 0"
+    yield "row 1"
+    await asyncio.wait_for(released.wait(), timeout=10)
+    yield "row 2"
+
+
+class SakOutputTest(unittest.TestCase):
+    def test_is_stream(self) -> None:
+        self.assertTrue(is_stream(rows(-1)))
+        self.assertTrue(is_stream(iter([1, 2])))
+        self.assertFalse(is_stream([1, 2]))
+        self.assertFalse(is_stream("abc"))
+        self.assertFalse(is_stream(io.StringIO("abc")))
+
+    def test_iter_chunks(self) -> None:
+        # WHEN.
+        chunks = list(iter_chunks(rows(-1), max_delay=60))
+
+        # THEN.
+        self.assertEqual(chunks[0], ["row 0"])
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(len(chunks[1]), 9)
+
+    def test_iter_chunks_blocked(self) -> None:
+        # GIVEN.
+        released = threading.Event()
+        chunks: List[List[Any]] = []
+
+        # WHEN.
+        for chunk in iter_chunks(blocking_rows(released), max_delay=0.05):
+            chunks.append(chunk)
+            if "row 1" in chunk:
+                # The row before the blocking call is shown while it blocks.
+                self.assertFalse(released.is_set())
+                released.set()
+
+        # THEN.
+        self.assertEqual(chunks, [["row 0"], ["row 1"], ["row 2"]])
+
+    def test_aiter_chunks_blocked(self) -> None:
+        async def collect() -> List[List[Any]]:
+            released = asyncio.Event()
+            chunks: List[List[Any]] = []
+            async for chunk in aiter_chunks(
+                async_blocking_rows(released), max_delay=0.05
+            ):
+                chunks.append(chunk)
+                if "row 1" in chunk:
+                    self.assertFalse(released.is_set())
+                    released.set()
+            return chunks
+
+        # WHEN.
+        chunks = asyncio.run(collect())
+
+        # THEN.
+        self.assertEqual(chunks, [["row 0"], ["row 1"], ["row 2"]])
+
+    def test_write_stream_failure(self) -> None:
+        # GIVEN.
+        output = io.StringIO()
+
+        # WHEN.
+        with self.assertRaises(Exception):
+            write_stream(rows(5), output)
+
+        # THEN.
+        self.assertEqual(output.getvalue().splitlines()[-1], "row 4")
+
+    def test_broken_pipe(self) -> None:
+        # GIVEN.
+        env = dict(os.environ)
+        env["PYTHONPATH"] = str(Path(__file__).resolve().parent.parent.parent)
+
+        # WHEN.
+        proc = subprocess.Popen(
+            [sys.executable, "-c", BROKEN_PIPE_SCRIPT],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+        )
+        assert proc.stdout is not None
+        first_line = proc.stdout.readline()
+        proc.stdout.close()
+        _, stderr = proc.communicate()
+
+        # THEN.
+        self.assertEqual(first_line, b"row 0\n")
+        self.assertEqual(stderr, b"")
+        self.assertEqual(proc.returncode, 1)
+
+    def test_parse_output_args(self) -> None:
+        self.assertEqual(
+            parse_output_args(["--output", "csv", "task", "show", "--output", "x"]),
+            ("csv", None, ["task", "show", "--output", "x"]),
+        )
+        self.assertEqual(
+            parse_output_args(["--output-file=tasks.jsonl", "task"]),
+            ("jsonl", "tasks.jsonl", ["task"]),
+        )
+        with self.assertRaises(ValueError):
+            parse_output_args(["--output", "xml", "task"])
+
+    def test_iter_row_chunks(self) -> None:
+        # WHEN.
+        chunks = list(iter_row_chunks(records(5), chunk_size=2))
+
+        # THEN.
+        self.assertEqual([len(x) for x in chunks], [2, 2, 1])
+        self.assertEqual(list(iter_row_chunks(3)), [[{"value": 3}]])
+        self.assertEqual(list(iter_row_chunks("abc")), [[{"value": "abc"}]])
+
+    def test_write_value(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # GIVEN.
+            csv_path = Path(tmp_dir) / "tasks.csv"
+            jsonl_path = Path(tmp_dir) / "tasks.jsonl"
+            table = io.StringIO()
+
+            # WHEN.
+            write_value(records(25), "csv", str(csv_path), chunk_size=10)
+            write_value(records(25), "jsonl", str(jsonl_path), chunk_size=10)
+            sys.stdout, old_stdout = table, sys.stdout
+            try:
+                write_value(records(3), "table")
+            finally:
+                sys.stdout = old_stdout
+
+            # THEN.
+            with open(csv_path, newline="") as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual(len(rows), 25)
+            self.assertEqual(rows[24], {"key": "24", "name": "task 24"})
+
+            with open(jsonl_path) as f:
+                lines = [json.loads(x) for x in f]
+            self.assertEqual(lines, list(records(25)))
+
+            self.assertEqual(
+                table.getvalue().splitlines(),
+                ["key  name", "0    task 0", "1    task 1", "2    task 2"],
+            )
+
+    def test_write_value_new_column(self) -> None:
+        # GIVEN.
+        rows = [{"a": 1}, {"a": 2, "b": 3}]
+
+        # THEN.
+        with self.assertRaises(ValueError):
+            write_value(iter(rows), "csv", os.devnull, chunk_size=1)
@@ -0,0 +1,189 @@
+import sys
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List
+
+from saklib.sakcmd import SakCmd, sak_arg_parser
+from saklib.sakplugin import (
+    _RELOAD_CALLBACKS,
+    SakContext,
+    SakPlugin,
+    SakPluginManager,
+    load_file,
+    load_file_timed,
+    register_reload_callback,
+)
+
+SAK_CONFIG = '''
+"""Dummy plugin."""
+
+COMMANDS = {
+    "hello": {"file": "dummy.py", "helpmsg": "Say hello."},
+    "group": {"file": "dummy.py", "helpmsg": "A group."},
+}
+'''
+
+DUMMY = """
+from saklib.sakcmd import SakCmd
+
+
+@SakCmd("hello")
+def hello(name: str = "world") -> str:
+    return "hello " + name
+
+
+EXPOSE = {"hello": hello, "group": {"bye": lambda: "bye"}}
+"""
+
+
+class SakPluginTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name)
+
+        self.plugin_path = self.path / "sak_dummy"
+        self.plugin_path.mkdir(parents=True)
+        (self.plugin_path / "sak_config.py").write_text(SAK_CONFIG)
+        (self.plugin_path / "dummy.py").write_text(DUMMY)
+
+        self.plugin = SakPlugin(SakContext(), "dummy", self.plugin_path)
+        self.root = SakCmd("sak")
+        self.root.subcmds.append(self.plugin)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_declared_commands_help(self) -> None:
+        # WHEN.
+        ret = sak_arg_parser(self.root, ["dummy", "-h"])
+
+        # THEN.
+        self.assertIn("Say hello.", ret["argparse"]["help"])
+        self.assertIn("A group.", ret["argparse"]["help"])
+        self.assertEqual(self.plugin._loaded_files, set())
+
+    def test_declared_commands_run(self) -> None:
+        # WHEN.
+        ret = sak_arg_parser(self.root, ["dummy", "hello", "--name", "foo"])
+
+        # THEN.
+        self.assertEqual(ret["value"], "hello foo")
+        self.assertEqual(self.plugin._loaded_files, {"_dummy.py"})
+
+    def test_declared_group_shows_help(self) -> None:
+        # WHEN.
+        ret = sak_arg_parser(self.root, ["dummy", "group"])
+
+        # THEN.
+        self.assertIn("bye", ret["argparse"]["help"])
+
+    def test_load_plugins_order(self) -> None:
+        # GIVEN.
+        for name in ["sak_b", "sak_a", "sak_c", "not_a_plugin"]:
+            (self.path / name).mkdir()
+            if name.startswith("sak_"):
+                (self.path / name / "sak_config.py").write_text("")
+        plm = SakPluginManager()
+        plm.has_context = SakContext()
+
+        # WHEN.
+        plm.loadPlugins(self.path)
+
+        # THEN.
+        expected = [
+            x.name.replace("sak_", "")
+            for x in self.path.iterdir()
+            if (x / "sak_config.py").is_file()
+        ]
+        self.assertEqual([x._name for x in plm.has_plugins], expected)
+        self.assertEqual(
+            sorted(x[0] for x in plm.get_timing_report()), sorted(expected)
+        )
+
+    def test_declared_commands_attribute(self) -> None:
+        # WHEN.
+        value = self.plugin.hello(name="bar")
+
+        # THEN.
+        self.assertEqual(value, "hello bar")
+
+
+class LoadFileTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = Path(self.tmp_dir.name) / "mod.py"
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_load_file_cache(self) -> None:
+        # GIVEN.
+        reloaded: List[Path] = []
+        register_reload_callback(reloaded.append)
+        self.addCleanup(_RELOAD_CALLBACKS.remove, reloaded.append)
+        self.file_path.write_text("VALUE = 1\nOBJ = object()\n")
+
+        # WHEN.
+        first = load_file(self.file_path)
+        second = load_file(self.file_path)
+        second["VALUE"] = 3
+
+        # THEN.
+        self.assertIs(first["OBJ"], second["OBJ"])
+        self.assertEqual(load_file(self.file_path)["VALUE"], 1)
+        self.assertEqual(reloaded, [])
+
+        # WHEN.
+        self.file_path.write_text("VALUE = 22\nOBJ = object()\n")
+        third = load_file(self.file_path)
+
+        # THEN.
+        self.assertEqual(third["VALUE"], 22)
+        self.assertIsNot(first["OBJ"], third["OBJ"])
+        self.assertEqual(reloaded, [self.file_path.resolve()])
+
+    def test_load_file_threads(self) -> None:
+        # GIVEN.
+        # Only passed if all the files are executed at the same time.
+        barrier = threading.Barrier(8, timeout=10)
+        setattr(sys.modules[__name__], "LOAD_BARRIER", barrier)
+        self.addCleanup(delattr, sys.modules[__name__], "LOAD_BARRIER")
+        sys_path = list(sys.path)
+        paths = []
+        for idx in range(8):
+            path = Path(self.tmp_dir.name) / f"plugin{idx}" / "sak_config.py"
+            path.parent.mkdir()
+            (path.parent / f"sibling{idx}.py").write_text(f"VALUE = {idx}\n")
+            path.write_text(
+                "import sys\n"
+                f"sys.modules[{__name__!r}].LOAD_BARRIER.wait()\n"
+                f"from sibling{idx} import VALUE\n"
+            )
+            paths.append(path)
+
+        # WHEN.
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            namespaces = list(executor.map(load_file, paths))
+
+        # THEN.
+        self.assertEqual([x["VALUE"] for x in namespaces], list(range(8)))
+        self.assertEqual(sys.path, sys_path)
+        for idx in range(8):
+            sys.modules.pop(f"sibling{idx}", None)
+
+    def test_load_file_timed(self) -> None:
+        # GIVEN.
+        self.file_path.write_text("import time\ntime.sleep(0.05)\nVALUE = 1\n")
+
+        # WHEN.
+        first, first_time = load_file_timed(self.file_path)
+        second, second_time = load_file_timed(self.file_path)
+
+        # THEN.
+        self.assertEqual(first["VALUE"], 1)
+        self.assertEqual(second["VALUE"], 1)
+        self.assertGreaterEqual(first_time, 0.05)
+        self.assertEqual(second_time, 0.0)
@@ -0,0 +1,58 @@
+import io
+import sys
+import unittest
+from array import array
+
+from saklib.sakoutput import iter_row_chunks, render_value
+from saklib.saktable import SakTable
+
+
+class SakTableTest(unittest.TestCase):
+    def test_append(self) -> None:
+        # GIVEN.
+        table = SakTable()
+
+        # WHEN.
+        table.append({"id": 1, "duration": 0.5, "name": "a"})
+        table.append({"id": 2, "duration": 1, "name": "b", "tag": "x"})
+        table.append({"id": None, "duration": 2.5})
+
+        # THEN.
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.columns, ["id", "duration", "name", "tag"])
+        self.assertEqual(list(table["id"]), [1, 2, None])
+        self.assertIsInstance(table["duration"], array)
+        self.assertEqual(list(table["duration"]), [0.5, 1.0, 2.5])
+        self.assertEqual(table["tag"], [None, "x", None])
+        self.assertEqual(
+            table.to_rows()[2], {"id": None, "duration": 2.5, "name": None, "tag": None}
+        )
+
+    def test_columns(self) -> None:
+        # GIVEN.
+        table = SakTable({"id": array("q", range(5)), "name": map(str, range(5))})
+
+        # THEN.
+        self.assertEqual(len(table), 5)
+        self.assertEqual(
+            [len(x) for x in iter_row_chunks(table, chunk_size=2)], [2, 2, 1]
+        )
+        with self.assertRaises(ValueError):
+            SakTable({"a": [1], "b": [1, 2]})
+
+    def test_render(self) -> None:
+        # GIVEN.
+        table = SakTable.from_rows({"id": x, "name": "n%d" % x} for x in range(12))
+        stdout = io.StringIO()
+
+        # WHEN.
+        sys.stdout, old_stdout = stdout, sys.stdout
+        try:
+            render_value(table)
+        finally:
+            sys.stdout = old_stdout
+
+        # THEN.
+        self.assertEqual(stdout.getvalue().splitlines()[:2], ["id  name", "0   n0"])
+        self.assertEqual(len(stdout.getvalue().splitlines()), 13)
+        self.assertTrue(repr(table).endswith("...\n[12 rows x 2 columns]"))
@@ -0,0 +1,204 @@
+import tempfile
+import threading
+import time
+import unittest
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, List, Optional, Tuple
+from unittest import mock
+
+from saklib.saktask import (
+    SakTask,
+    SakTaskInternalParam,
+    SakTaskKey,
+    SakTasksNamespace,
+    SakTaskStorage,
+)
+from saklib.saktask_dag import build_dag, run_dag
+from saklib.saktask_model import SakTaskDb
+from saklib.test.saktask_test import FakeGitAnnexDriver
+
+RUNS: List[Tuple[str, str]] = []
+RUNS_LOCK = threading.Lock()
+FAILING: List[str] = []
+
+
+@dataclass
+class StepParam:
+    step: str
+    name: str
+
+
+class StepTask(SakTask):
+    nm: Any = None
+    upstream_nm: Any = None
+
+    def __init__(
+        self,
+        param: StepParam,
+        hash_str: Optional[str] = None,
+        internal_param: Optional[SakTaskInternalParam] = None,
+    ) -> None:
+        super().__init__(SakTaskKey(**asdict(param)), self.nm, internal_param)
+
+    def get_upstream_keys(self) -> List[Tuple[str, str]]:
+        if self.upstream_nm is None:
+            return []
+        name = self.upstream_nm.name
+        return [(name, SakTaskKey(step=name, name=self.key.data["name"]).get_hash())]
+
+    def __call__(self, **kwargs: Any) -> None:
+        time.sleep(0.01)
+        with RUNS_LOCK:
+            RUNS.append((self.namespace.name, self.key.data["name"]))
+        if self.key.data["name"] in FAILING:
+            raise Exception("Failed step")
+
+
+class BuildTask(StepTask):
+    pass
+
+
+class CheckTask(StepTask):
+    pass
+
+
+class ReportTask(StepTask):
+    names: List[str] = []
+
+    def get_upstream_keys(self) -> List[Tuple[str, str]]:
+        return [
+            ("check", SakTaskKey(step="check", name=x).get_hash()) for x in self.names
+        ]
+
+
+def create_namespaces(storage: SakTaskStorage) -> List[SakTasksNamespace]:
+    build = SakTasksNamespace("build", storage, StepParam, BuildTask)
+    check = SakTasksNamespace("check", storage, StepParam, CheckTask)
+    report = SakTasksNamespace("report", storage, StepParam, ReportTask)
+    BuildTask.nm = build
+    CheckTask.nm, CheckTask.upstream_nm = check, build
+    ReportTask.nm = report
+
+    names = ["a", "b", "c"]
+    ReportTask.names = names
+    build.create_tasks(StepParam("build", x) for x in names)
+    check.create_tasks(StepParam("check", x) for x in names)
+    report.create_tasks([StepParam("report", "all")])
+    return [build, check, report]
+
+
+class SakTaskDagTest(unittest.TestCase):
+    def setUp(self) -> None:
+        RUNS.clear()
+        FAILING.clear()
+
+    def test_run_dag(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # GIVEN.
+            storage = SakTaskStorage(Path(tmp_dir))
+            storage._ga_drv = FakeGitAnnexDriver()  # type: ignore
+            build, check, report = create_namespaces(storage)
+            FAILING[:] = ["b"]
+
+            # WHEN.
+            first = run_dag(build_dag([build, check, report]), jobs=4)
+            first_runs = list(RUNS)
+            RUNS.clear()
+            FAILING.clear()
+            second = run_dag(build_dag([build, check, report]), jobs=4)
+            second_runs = list(RUNS)
+            RUNS.clear()
+            third = run_dag(build_dag([build, check, report]), jobs=4)
+
+            # THEN.
+            self.assertEqual(
+                first.get_counts(),
+                {"success": 4, "fail": 1, "skipped": 0, "cancelled": 2, "running": 0},
+            )
+            self.assertNotIn(("check", "b"), first_runs)
+            self.assertLess(
+                first_runs.index(("build", "a")), first_runs.index(("check", "a"))
+            )
+
+            self.assertEqual(
+                sorted(second_runs), [("build", "b"), ("check", "b"), ("report", "all")]
+            )
+            self.assertEqual(len(second.skipped), 4)
+
+            self.assertEqual(third.get_counts()["skipped"], 7)
+            storage.engine.dispose()
+
+    def test_run_dag_running(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # GIVEN.
+            storage = SakTaskStorage(Path(tmp_dir))
+            storage._ga_drv = FakeGitAnnexDriver()  # type: ignore
+            build, check, report = create_namespaces(storage)
+            build_b = SakTaskKey(step="build", name="b").get_hash()
+            build.claim_task(build_b)
+
+            # WHEN.
+            ret = run_dag(build_dag([build, check, report]), jobs=4)
+
+            # THEN.
+            self.assertEqual(ret.running, [("build", build_b)])
+            self.assertEqual(
+                ret.get_counts(),
+                {"success": 4, "fail": 0, "skipped": 0, "cancelled": 2, "running": 1},
+            )
+            self.assertNotIn(("build", "b"), RUNS)
+            storage.engine.dispose()
+
+    def test_run_dag_interrupted(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # GIVEN.
+            storage = SakTaskStorage(Path(tmp_dir))
+            storage._ga_drv = FakeGitAnnexDriver()  # type: ignore
+            namespaces = create_namespaces(storage)
+
+            # WHEN.
+            with mock.patch("saklib.saktask_dag.wait", side_effect=KeyboardInterrupt):
+                ret = run_dag(build_dag(namespaces), jobs=1)
+
+            # THEN.
+            self.assertTrue(ret.interrupted)
+            self.assertEqual(sum(ret.get_counts().values()), 7)
+            self.assertEqual(len([x for x in ret.cancelled if x[0] != "build"]), 4)
+            storage.engine.dispose()
+
+    def test_run_dag_constructed(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # GIVEN.
+            storage = SakTaskStorage(Path(tmp_dir))
+            storage._ga_drv = FakeGitAnnexDriver()  # type: ignore
+            build = SakTasksNamespace("build", storage, StepParam, BuildTask)
+            BuildTask.nm = build
+            tasks = [BuildTask(StepParam("build", x)) for x in ["a", "b", "c"]]
+
+            # A row synced before the tasks had a status.
+            session = storage.scoped_session_obj()
+            session.get(SakTaskDb, tasks[0].key.get_hash()).status = None
+            session.commit()
+
+            # WHEN.
+            ret = run_dag(build_dag([build]), jobs=2)
+
+            # THEN.
+            self.assertEqual(ret.get_counts()["success"], 3)
+            self.assertEqual(sorted(RUNS), [("build", x) for x in ["a", "b", "c"]])
+            storage.engine.dispose()
+
+    def test_cycle(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # GIVEN.
+            storage = SakTaskStorage(Path(tmp_dir))
+            storage._ga_drv = FakeGitAnnexDriver()  # type: ignore
+            loop = SakTasksNamespace("loop", storage, StepParam, CheckTask)
+            CheckTask.nm, CheckTask.upstream_nm = loop, loop
+            loop.create_tasks([StepParam("loop", "a")])
+
+            # THEN.
+            with self.assertRaises(Exception):
+                build_dag([loop]).get_topological_order()
+            storage.engine.dispose()
@@ -0,0 +1,311 @@
+import base64
+import gc
+import os
+import subprocess
+import tempfile
+import time
+import unittest
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from saklib.saktask_ga import (
+    SakGitAnnexDriver,
+    SakTaskGitAnnexData,
+    ga_key_file_to_journal_file,
+    ga_key_file_to_key,
+    ga_key_to_key_file,
+    git_annex_metadata_fields,
+    git_annex_parse_metadata,
+    git_annex_parse_metadata_log,
+    iter_tree_diff,
+)
+from saklib.saktask_status import SakTaskStatus
+
+# Number of keys of the benchmark repository, like 500000, it is skipped if unset.
+BENCHMARK_KEYS = int(os.environ.get("SAK_BENCHMARK_KEYS", "0"))
+
+
+def make_log_line(timestamp: str, fields: Dict[str, List[str]]) -> str:
+    # Like git-annex, the values with whitespaces are in base64.
+    words = [timestamp]
+    for field, values in fields.items():
+        words.append(field)
+        for value in values:
+            if (" " in value) or value.startswith("!"):
+                value = "!" + base64.b64encode(value.encode()).decode()
+            words.append("+" + value)
+    return " ".join(words) + "\n"
+
+
+def make_task_log(key: str, namespace: str = "build") -> str:
+    data = SakTaskGitAnnexData(
+        key_hash=key,
+        namespace=namespace,
+        status=SakTaskStatus.SUCCESS,
+        start_time=datetime(2023, 1, 2, 3, 4, 5),
+        end_time=datetime(2023, 1, 2, 3, 5, 6),
+        key_data={"name": key, "step": "build"},
+        log="Building " + key,
+    )
+    return make_log_line("1672628645.123456789s", git_annex_metadata_fields(data))
+
+
+def make_annex_branch(
+    path: Path,
+    keys: List[str],
+    parent: Optional[str] = None,
+    content: str = "a",
+    log: Optional[Callable[[str], str]] = None,
+) -> str:
+    """Commit a .log.met file per key to the git-annex branch, in a single pack.
+
+    :param log: The log of each key, by default the same one for all the keys.
+    :returns: The commit hash.
+    """
+    lines = []
+    for idx, key in enumerate(keys if log is not None else keys[:1]):
+        data = (log(key) if log is not None else f"1s key_hash +{content}\n").encode()
+        lines += [b"blob", b"mark :%d" % (idx + 2), b"data %d" % len(data), data]
+    lines += [
+        b"commit refs/heads/git-annex",
+        b"mark :1",
+        b"committer sak <sak@sak> 0 +0000",
+        b"data 6",
+        b"update",
+    ]
+    if parent is not None:
+        lines.append(b"from " + parent.encode())
+    lines += [
+        b"M 100644 :%d " % ((idx + 2) if log is not None else 2)
+        + ga_key_to_key_file(x).encode()
+        for idx, x in enumerate(keys)
+    ]
+    lines += [b"get-mark :1", b""]
+
+    p = subprocess.run(
+        ["git", "fast-import", "--quiet"],
+        input=b"\n".join(lines),
+        stdout=subprocess.PIPE,
+        cwd=path,
+        check=True,
+    )
+    return p.stdout.decode().strip()
+
+
+def git_diff_keys(path: Path, current: str, last: Optional[str]) -> List[str]:
+    # The "git diff --name-only" of the previous implementation.
+    diff_hashes = current if last is None else f"{last}..{current}"
+    p = subprocess.run(
+        ["git", "diff", "--name-only", diff_hashes],
+        stdout=subprocess.PIPE,
+        cwd=path,
+        check=True,
+    )
+    return [
+        Path(x).name.replace("SHA256E-s0--", "").replace(".log.met", "")
+        for x in p.stdout.decode().splitlines()
+        if x.endswith(".log.met")
+    ]
+
+
+class GitCatFileOdb:
+    """Object database that reads the objects with git, for any object format."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def read(self, oid: str) -> Tuple[str, bytes]:
+        p = subprocess.run(
+            ["git", "cat-file", "tree", oid],
+            stdout=subprocess.PIPE,
+            cwd=self.path,
+            check=True,
+        )
+        return "tree", p.stdout
+
+
+def git_tree_id(path: Path, commit: str) -> str:
+    p = subprocess.run(
+        ["git", "rev-parse", commit + "^{tree}"],
+        stdout=subprocess.PIPE,
+        cwd=path,
+        check=True,
+    )
+    return p.stdout.decode().strip()
+
+
+class SakGitAnnexDriverTest(unittest.TestCase):
+    def make_repo(self, tmp_dir: str) -> Path:
+        path = Path(tmp_dir)
+        subprocess.run(["git", "init", "-q", str(path)], check=True)
+        return path
+
+    def test_iter_changed_keys(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # GIVEN.
+            path = self.make_repo(tmp_dir)
+            keys = ["key%d" % x for x in range(1000)]
+            first = make_annex_branch(path, keys)
+            second = make_annex_branch(path, keys[:10] + ["new"], first, content="b")
+            ga_drv = SakGitAnnexDriver(path)
+
+            # WHEN.
+            current = ga_drv.get_current_git_hash()
+            all_keys = ga_drv.get_all_keys(first)
+            changed = list(ga_drv.iter_changed_keys(second, first))
+            unknown_last = ga_drv.get_all_keys(second, "0" * 40)
+
+            # THEN.
+            self.assertEqual(current, second)
+            self.assertEqual(sorted(all_keys or []), sorted(keys))
+            self.assertEqual(sorted(changed), sorted(keys[:10] + ["new"]))
+            self.assertEqual(
+                sorted(changed), sorted(git_diff_keys(path, second, first))
+            )
+            self.assertEqual(len(unknown_last or []), 1001)
+
+    def test_iter_tree_diff_sha256(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # GIVEN.
+            path = Path(tmp_dir)
+            subprocess.run(
+                ["git", "init", "-q", "--object-format=sha256", str(path)], check=True
+            )
+            keys = ["key%d" % x for x in range(50)]
+            first = make_annex_branch(path, keys)
+            second = make_annex_branch(path, keys[:5] + ["new"], first, content="b")
+            odb: Any = GitCatFileOdb(path)
+
+            # WHEN.
+            changed = list(
+                iter_tree_diff(odb, git_tree_id(path, first), git_tree_id(path, second))
+            )
+
+            # THEN.
+            self.assertEqual(len(git_tree_id(path, first)), 64)
+            self.assertEqual(
+                sorted(ga_key_file_to_key(x) for x in changed),
+                sorted(git_diff_keys(path, second, first)),
+            )
+
+    def test_parse_metadata_log(self) -> None:
+        # GIVEN.
+        data = SakTaskGitAnnexData(
+            key_hash="abc",
+            namespace="build",
+            status=SakTaskStatus.PENDING,
+            start_time=datetime(2023, 1, 2, 3, 4, 5),
+            key_data={"name": "a b"},
+            log="line 1\nline 2",
+        )
+        first = make_log_line("1000.5s", git_annex_metadata_fields(data))
+        second = '2000s status -"PENDING" +"SUCCESS"\n'
+
+        # WHEN.
+        fields = git_annex_parse_metadata_log((second + first).encode())
+        out = git_annex_parse_metadata({"fields": fields})
+
+        # THEN.
+        self.assertEqual(out.key_hash, "abc")
+        self.assertEqual(out.namespace, "build")
+        self.assertEqual(out.status, SakTaskStatus.SUCCESS)
+        self.assertEqual(out.start_time, data.start_time)
+        self.assertIsNone(out.end_time)
+        self.assertEqual(out.key_data, {"name": "a b"})
+        self.assertEqual(out.log, "line 1\nline 2")
+        self.assertEqual(out._last_changed, "1970-01-01@00-33-20")
+        self.assertEqual(fields["namespace-lastchanged"], ["1970-01-01@00-16-40"])
+
+    def test_read_metadata(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # GIVEN.
+            path = self.make_repo(tmp_dir)
+            data = SakTaskGitAnnexData(key_hash="key", namespace="build")
+            log = make_log_line("1s", git_annex_metadata_fields(data))
+            first = make_annex_branch(path, ["key"], log=lambda x: log)
+            ga_drv = SakGitAnnexDriver(path)
+
+            # WHEN.
+            from_branch = ga_drv.git_annex_get_metada("key")
+
+            journal = path / ".git" / "annex" / "journal"
+            journal.mkdir(parents=True)
+            journal_file = journal / ga_key_file_to_journal_file(
+                ga_key_to_key_file("key")
+            )
+            with open(journal_file, "w") as f:
+                f.write(log + '2s namespace -"build" +"check"\n')
+            from_journal = ga_drv.git_annex_get_metada("key")
+
+            # An unmerged remote git-annex branch.
+            remote = make_annex_branch(path, ["other"], first)
+            subprocess.run(
+                ["git", "update-ref", "refs/remotes/origin/git-annex", remote],
+                cwd=path,
+                check=True,
+            )
+            subprocess.run(
+                ["git", "update-ref", "refs/heads/git-annex", first],
+                cwd=path,
+                check=True,
+            )
+            journal_file.unlink()
+            ga_drv.get_current_git_hash()
+            unmerged = ga_drv._git_annex_read_metadata("key")
+
+            # THEN.
+            self.assertEqual(from_branch.namespace, "build")
+            self.assertEqual(from_journal.namespace, "check")
+            self.assertIsNone(unmerged)
+
+    @unittest.skipUnless(BENCHMARK_KEYS, "Set SAK_BENCHMARK_KEYS to run it")
+    def test_benchmark(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # GIVEN.
+            path = self.make_repo(tmp_dir)
+            keys = ["key%d" % x for x in range(BENCHMARK_KEYS)]
+            first = make_annex_branch(path, keys, log=make_task_log)
+            changed = keys[:: max(len(keys) // 1000, 1)]
+            second = make_annex_branch(
+                path, changed, first, log=lambda x: make_task_log(x, "check")
+            )
+
+            for last, current in [(None, first), (first, second)]:
+                # WHEN.
+                gc.collect()
+                start = time.perf_counter()
+                ga_drv = SakGitAnnexDriver(path)
+                commit = ga_drv.get_current_git_hash()
+                in_process = list(ga_drv.iter_changed_keys(current, last))
+                in_process_time = time.perf_counter() - start
+
+                start = time.perf_counter()
+                subprocess.run(
+                    ["git", "log", "-1", "git-annex"],
+                    stdout=subprocess.PIPE,
+                    cwd=path,
+                    check=True,
+                )
+                git_diff = git_diff_keys(path, current, last)
+                git_diff_time = time.perf_counter() - start
+
+                # THEN.
+                print(
+                    f"{len(keys)} keys, {len(in_process)} changed: "
+                    f"pygit2 {in_process_time:.3f}s, git {git_diff_time:.3f}s"
+                )
+                self.assertEqual(commit, second)
+                self.assertEqual(sorted(in_process), sorted(git_diff))
+
+            # WHEN.
+            gc.collect()
+            start = time.perf_counter()
+            ga_drv = SakGitAnnexDriver(path)
+            ga_drv.get_current_git_hash()
+            metadata = [ga_drv.git_annex_get_metada(x) for x in keys]
+            read_time = time.perf_counter() - start
+
+            # THEN.
+            print(f"{len(keys)} keys, metadata read: pygit2 {read_time:.3f}s")
+            self.assertEqual([x.key_hash for x in metadata[:10]], keys[:10])
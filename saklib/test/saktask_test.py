@@ -0,0 +1,289 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from dataclasses import asdict, dataclass, replace
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from unittest import mock
+
+from saklib.sakhash import make_hash_sha1
+from saklib.saktask import (
+    SakTask,
+    SakTaskInternalParam,
+    SakTaskKey,
+    SakTasksNamespace,
+    SakTaskStorage,
+)
+from saklib.saktask_ga import SakTaskGitAnnexData
+from saklib.saktask_model import SakTaskDb
+from saklib.saktask_run import run_tasks
+from saklib.saktask_status import SakTaskStatus
+
+IMPORT_SCRIPT = """
+import json
+import sys
+import time
+from pathlib import Path
+
+start = time.perf_counter()
+from saklib.saktask import STORAGE, set_storage
+
+set_storage(Path(sys.argv[1]) / "storage", name="test")
+duration = time.perf_counter() - start
+
+heavy = ["sqlalchemy", "pygit2", "pandas", "tqdm"]
+print(json.dumps({
+    "duration": duration,
+    "loaded": [x for x in heavy if x in sys.modules],
+    "storages": list(STORAGE.keys()),
+}))
+"""
+
+# The heavy modules took around 460ms to import.
+MAX_IMPORT_DURATION = 0.2
+
+# Set to "YES" to run the timing checks, they depend on the machine load.
+BENCHMARK = os.environ.get("SAK_BENCHMARK", "NO") == "YES"
+
+
+def run_import_script(tmp_dir: str) -> Dict[str, Any]:
+    env = dict(os.environ)
+    env["HOME"] = tmp_dir
+    env["PYTHONPATH"] = str(Path(__file__).resolve().parent.parent.parent)
+
+    output = subprocess.check_output(
+        [sys.executable, "-c", IMPORT_SCRIPT, tmp_dir], env=env
+    )
+    ret: Dict[str, Any] = json.loads(output)
+    return ret
+
+
+class SakTaskTest(unittest.TestCase):
+    def test_import_is_lazy(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # WHEN.
+            result = run_import_script(tmp_dir)
+
+            # THEN.
+            self.assertEqual(result["loaded"], [])
+            self.assertEqual(result["storages"], [])
+            self.assertFalse((Path(tmp_dir) / "sak").exists())
+
+    @unittest.skipUnless(BENCHMARK, "Set SAK_BENCHMARK=YES to run it")
+    def test_import_time(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # WHEN.
+            result = run_import_script(tmp_dir)
+
+            # THEN.
+            self.assertLess(result["duration"], MAX_IMPORT_DURATION)
+
+
+@dataclass
+class BulkParam:
+    name: str
+    size: int
+
+
+class BulkTask(SakTask):
+    nm: Any = None
+
+    def __init__(
+        self,
+        param: BulkParam,
+        hash_str: Optional[str] = None,
+        internal_param: Optional[SakTaskInternalParam] = None,
+    ) -> None:
+        super().__init__(SakTaskKey(**asdict(param)), self.nm, internal_param)
+
+    def __call__(self, **kwargs: Any) -> None:
+        print("size", self.key.data["size"])
+        if self.key.data["size"] == 3:
+            raise Exception("Failed task")
+
+
+class FakeGitAnnexDriver:
+    def __init__(self) -> None:
+        self.batches: List[List[str]] = []
+        self.metadata: Dict[str, SakTaskGitAnnexData] = {}
+        self.lock = threading.RLock()
+
+    def git_annex_set_metadata_batch(
+        self, items: List[Tuple[str, SakTaskGitAnnexData]]
+    ) -> List[SakTaskGitAnnexData]:
+        self.batches.append([x for x, _ in items])
+        return [self.git_annex_set_metadata(k, x) for k, x in items]
+
+    def git_annex_set_metadata(
+        self, key: str, data: Optional[SakTaskGitAnnexData] = None, **kwargs: Any
+    ) -> SakTaskGitAnnexData:
+        with self.lock:
+            current = self.metadata.setdefault(key, SakTaskGitAnnexData())
+            if data is not None:
+                for name, value in vars(data).items():
+                    if (value is not None) and not name.startswith("_"):
+                        setattr(current, name, value)
+            return replace(current)
+
+    def git_annex_get_metada(self, key: str) -> SakTaskGitAnnexData:
+        return self.git_annex_set_metadata(key)
+
+    def ga_key_metadata_hash(self, key: str) -> Optional[str]:
+        with self.lock:
+            if key not in self.metadata:
+                return None
+            return make_hash_sha1(repr(self.metadata[key]))
+
+
+class SakTaskCreateTasksTest(unittest.TestCase):
+    def test_create_tasks(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # GIVEN.
+            storage = SakTaskStorage(Path(tmp_dir))
+            ga_drv = FakeGitAnnexDriver()
+            storage._ga_drv = ga_drv  # type: ignore
+            nm = SakTasksNamespace("bulk", storage, BulkParam, BulkTask)
+            params: List[Any] = [BulkParam(f"task{i}", i) for i in range(1200)]
+
+            # WHEN.
+            handles = nm.create_tasks(params + [{"name": "task0", "size": 0}])
+            again = nm.create_tasks(params[:10])
+
+            # THEN.
+            self.assertEqual(len(handles), 1200)
+            self.assertEqual(
+                handles[1].key_hash, SakTaskKey(name="task1", size=1).get_hash()
+            )
+            self.assertEqual([len(x) for x in ga_drv.batches], [500, 500, 200])
+            self.assertEqual(nm.count_tasks(), 1200)
+            self.assertEqual(
+                [x.key_hash for x in again], [x.key_hash for x in handles[:10]]
+            )
+
+            session = storage.scoped_session_obj()
+            db_obj = session.get(SakTaskDb, handles[1].key_hash)
+            self.assertEqual(
+                db_obj.metadata_hash, ga_drv.ga_key_metadata_hash(handles[1].key_hash)
+            )
+            param_obj = nm.get_task_db_param(handles[1].key_hash)
+            assert param_obj is not None
+            self.assertEqual((param_obj.name, param_obj.size), ("task1", 1))
+            storage.engine.dispose()
+
+
+class SakTaskRunTest(unittest.TestCase):
+    def test_claims(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # GIVEN.
+            storage = SakTaskStorage(Path(tmp_dir))
+            storage._ga_drv = FakeGitAnnexDriver()  # type: ignore
+            nm = SakTasksNamespace("claims", storage, BulkParam, BulkTask)
+            nm.create_tasks(BulkParam(f"task{i}", i) for i in range(10))
+
+            # WHEN.
+            first = nm.claim_tasks(6)
+            second = nm.claim_tasks(6)
+            nm.release_claims(first[:2])
+            third = nm.claim_tasks(6)
+
+            # THEN.
+            self.assertEqual(len(first), 6)
+            self.assertEqual(len(second), 4)
+            self.assertFalse(set(first) & set(second))
+            self.assertEqual(sorted(third), sorted(first[:2]))
+            storage.engine.dispose()
+
+    def test_run_tasks(self) -> None:
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # GIVEN.
+            storage = SakTaskStorage(Path(tmp_dir))
+            ga_drv = FakeGitAnnexDriver()
+            storage._ga_drv = ga_drv  # type: ignore
+            nm = SakTasksNamespace("run", storage, BulkParam, BulkTask)
+            BulkTask.nm = nm
+            handles = nm.create_tasks(BulkParam(f"task{i}", i) for i in range(20))
+
+            # WHEN.
+            result = run_tasks(nm, jobs=4)
+            again = run_tasks(nm, jobs=4)
+
+            # THEN.
+            self.assertEqual(result.counts, {"SUCCESS": 19, "FAIL": 1})
+            self.assertEqual(again.counts, {})
+            self.assertEqual(nm.claim_tasks(1), [])
+            metadata = ga_drv.metadata[handles[5].key_hash]
+            self.assertEqual(metadata.status, SakTaskStatus.SUCCESS)
+            self.assertIn("size 5", metadata.log or "")
+            storage.engine.dispose()
+
+    def test_run_tasks_constructed(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # GIVEN.
+            storage = SakTaskStorage(Path(tmp_dir))
+            storage._ga_drv = FakeGitAnnexDriver()  # type: ignore
+            nm = SakTasksNamespace("constructed", storage, BulkParam, BulkTask)
+            BulkTask.nm = nm
+            tasks = [BulkTask(BulkParam(f"task{i}", i + 10)) for i in range(5)]
+
+            # A row synced before the tasks had a status.
+            session = storage.scoped_session_obj()
+            session.get(SakTaskDb, tasks[0].key.get_hash()).status = None
+            session.commit()
+
+            # WHEN.
+            result = run_tasks(nm, jobs=2)
+
+            # THEN.
+            self.assertEqual(result.counts, {"SUCCESS": 5})
+            storage.engine.dispose()
+
+    def test_run_tasks_without_key_data(self) -> None:
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # GIVEN.
+            storage = SakTaskStorage(Path(tmp_dir))
+            ga_drv = FakeGitAnnexDriver()
+            storage._ga_drv = ga_drv  # type: ignore
+            nm = SakTasksNamespace("broken", storage, BulkParam, BulkTask)
+            BulkTask.nm = nm
+            handles = nm.create_tasks(BulkParam(f"task{i}", i + 10) for i in range(5))
+            ga_drv.metadata[handles[0].key_hash].key_data = None
+
+            # WHEN.
+            # The limit stops the runner if the broken task is claimed again.
+            result = run_tasks(nm, jobs=2, limit=50)
+
+            # THEN.
+            self.assertEqual(result.counts, {"SUCCESS": 4, "FAIL": 1})
+            self.assertEqual(nm.claim_tasks(1), [])
+            storage.engine.dispose()
+
+    def test_run_tasks_interrupted(self) -> None:
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # GIVEN.
+            storage = SakTaskStorage(Path(tmp_dir))
+            storage._ga_drv = FakeGitAnnexDriver()  # type: ignore
+            nm = SakTasksNamespace("interrupted", storage, BulkParam, BulkTask)
+            BulkTask.nm = nm
+            nm.create_tasks(BulkParam(f"task{i}", i + 10) for i in range(10))
+
+            # WHEN.
+            with mock.patch("saklib.saktask_run.wait", side_effect=KeyboardInterrupt):
+                result = run_tasks(nm, jobs=4)
+
+            # THEN.
+            session = storage.scoped_session_obj()
+            statuses = [x.status for x in session.query(SakTaskDb).all()]
+            self.assertTrue(result.interrupted)
+            self.assertNotIn(SakTaskStatus.RUNNING, statuses)
+            self.assertEqual(
+                statuses.count(SakTaskStatus.SUCCESS), sum(result.counts.values())
+            )
+            self.assertEqual(len(nm.claim_tasks(10)), 10 - sum(result.counts.values()))
+            storage.engine.dispose()
@@ -0,0 +1,84 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from saklib import saktiming
+
+
+class SakTimingTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.old_timings = saktiming.timings
+        saktiming.timings = saktiming.SakTimings()
+
+    def tearDown(self) -> None:
+        saktiming.timings = self.old_timings
+
+    def test_timing_disabled(self) -> None:
+        # WHEN.
+        with saktiming.timing("startup", "step"):
+            pass
+
+        # THEN.
+        self.assertEqual(saktiming.timings.records, [])
+
+    def test_report(self) -> None:
+        # GIVEN.
+        saktiming.timings.enabled = True
+
+        # WHEN.
+        with saktiming.timing("startup", "loadPlugins"):
+            with saktiming.timing("plugin", "dummy sak_config.py"):
+                pass
+        report = saktiming.get_report(["qa", "-h"])
+
+        # THEN.
+        self.assertEqual(
+            [(x["name"], x["depth"]) for x in report["steps"]],
+            [("loadPlugins", 0), ("dummy sak_config.py", 1)],
+        )
+        self.assertEqual(list(report["plugins"].keys()), ["dummy"])
+        self.assertIn("plugin: dummy sak_config.py", saktiming.report_to_table(report))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            history_path = Path(tmp_dir) / "startup.jsonl"
+            saktiming.save_report(history_path, report)
+            saktiming.save_report(history_path, report)
+            self.assertEqual(len(saktiming.load_history(history_path)), 2)
+
+    def test_trace(self) -> None:
+        # GIVEN.
+        saktiming.timings.enabled = True
+        saktiming.timings.command = "sak dummy run"
+
+        # WHEN.
+        with saktiming.span("fetch", url="http://localhost"):
+            with saktiming.span("parse"):
+                pass
+        entry = saktiming.get_trace_entry(["dummy", "run"], status=0)
+
+        # THEN.
+        self.assertEqual(entry["cmd"], "sak dummy run")
+        self.assertEqual([x["name"] for x in entry["spans"]], ["fetch", "parse"])
+        self.assertEqual(entry["spans"][0]["attrs"], {"url": "http://localhost"})
+        self.assertLessEqual(entry["spans"][0]["self"], entry["spans"][0]["duration"])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # WHEN.
+            trace_path = Path(tmp_dir) / "trace.jsonl"
+            for _ in range(5):
+                saktiming.save_trace(trace_path, entry, max_size=1, backups=2)
+
+            # THEN. Each entry rotated the previous one, two backups are kept.
+            self.assertEqual(len(saktiming.load_trace(trace_path)), 3)
+            table = saktiming.trace_to_table(saktiming.load_trace(trace_path))
+            self.assertIn("Command: sak dummy run (3 runs)", table)
+            self.assertIn("span: fetch", table)
+
+    def test_percentile(self) -> None:
+        # GIVEN.
+        values = [float(x) for x in range(1, 101)]
+
+        # THEN.
+        self.assertEqual(saktiming.percentile(values, 50), 50.0)
+        self.assertEqual(saktiming.percentile(values, 95), 95.0)
+        self.assertEqual(saktiming.percentile([3.0], 95), 3.0)